@@ -0,0 +1,156 @@
+import time
+import asyncio
+import logging
+import inspect
+import paho.mqtt.client as mqtt
+import mqtt_connector
+from car import Car, CarManager
+from typing import Callable
+from HTCSPythonUtil import config
+
+logger = logging.getLogger("Async_MQTT_Connector")
+
+ZOMBIE_INTERVAL_SEC = mqtt_connector.ZOMBIE_PRECISION_SEC
+ZOMBIE_THRESHOLD_SEC = mqtt_connector.ZOMBIE_THRESHOLD_SEC
+
+tasks = []
+
+
+class AsyncioHelper:
+    """
+    Drives the network traffic of a paho client from the asyncio event loop, instead of a loop_start thread.
+    Based on the loop_asyncio example of paho-mqtt, the callbacks of the client are called from the event loop.
+    """
+    def __init__(self, loop: asyncio.AbstractEventLoop, client: mqtt.Client):
+        self.loop = loop
+        self.client = client
+        self.misc_task = None
+        self.client.on_socket_open = self.on_socket_open
+        self.client.on_socket_close = self.on_socket_close
+        self.client.on_socket_register_write = self.on_socket_register_write
+        self.client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def on_socket_open(self, client, userdata, sock):
+        self.loop.add_reader(sock, client.loop_read)
+        self.misc_task = self.loop.create_task(self.misc_loop())
+
+    def on_socket_close(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+        if self.misc_task is not None:
+            self.misc_task.cancel()
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.loop.add_writer(sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.remove_writer(sock)
+
+    async def misc_loop(self):
+        # keepalive and retries
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+
+def enqueue_to(message_queue: asyncio.Queue):
+    """
+    :return: a paho callback, which only puts its arguments into the queue, to be handled by a coroutine
+    """
+    def callback(*args):
+        message_queue.put_nowait(args)
+    return callback
+
+
+async def handle_join_messages(message_queue: asyncio.Queue):
+    while True:
+        client, user_data, msg = await message_queue.get()
+        mqtt_connector.on_join_message(client, user_data, msg)
+
+
+async def handle_state_messages(message_queue: asyncio.Queue):
+    while True:
+        client, user_data, msg = await message_queue.get()
+        mqtt_connector.on_state_message(client, user_data, msg)
+
+
+async def handle_unsubscribes(message_queue: asyncio.Queue):
+    while True:
+        client, car_ids_mids, message_id = await message_queue.get()
+        mqtt_connector.remove_unsubscribed_car(client, car_ids_mids, message_id)
+
+
+async def handle_obituaries(message_queue: asyncio.Queue, on_terminate: Callable):
+    while True:
+        client, user_data, msg = await message_queue.get()
+        result = on_terminate(client, user_data, msg)
+        if inspect.isawaitable(result):
+            await result
+
+
+async def reap_zombies(interval_sec=ZOMBIE_INTERVAL_SEC, threshold_sec=ZOMBIE_THRESHOLD_SEC):
+    while True:
+        await asyncio.sleep(interval_sec)
+        mqtt_connector.kill_zombies(threshold_sec)
+
+
+async def run_periodically(tick: Callable, interval_sec: float, overload_message: str):
+    """
+    Calls tick every interval_sec seconds on the event loop, giving the remaining time to the other tasks
+    """
+    while True:
+        time_start = time.time()
+        tick()
+        logger.debug(f"{tick.__name__} took {time.time() - time_start} seconds")
+        remaining_sec = time_start + interval_sec - time.time()
+        if remaining_sec <= 0:
+            logger.warning(overload_message)
+        await asyncio.sleep(max(0.0, remaining_sec))
+
+
+async def setup_connector(_local_cars: CarManager, _model_class=Car, on_terminate=None,
+                          _coalesce_states=bool(config.get("coalesce_states"))):
+    """
+    Asyncio variant of mqtt_connector.setup_connector, all clients and handlers run on the current event loop.
+    It sets up the state of mqtt_connector, so its functions and its main client can be used as usual.
+    Only the pool ingest mode is supported.
+    """
+    loop = asyncio.get_running_loop()
+    mqtt_connector.setup_state(_local_cars, _model_class, mqtt_connector.INGEST_POOL, _coalesce_states)
+
+    join_queue = asyncio.Queue()
+    state_queue = asyncio.Queue()
+    unsubscribe_queue = asyncio.Queue()
+    tasks.append(loop.create_task(handle_join_messages(join_queue)))
+    tasks.append(loop.create_task(handle_state_messages(state_queue)))
+    tasks.append(loop.create_task(handle_unsubscribes(unsubscribe_queue)))
+    tasks.append(loop.create_task(reap_zombies()))
+
+    logger.info(f"Setting up main client and {mqtt_connector.state_client_pool_size} state clients on the event loop")
+    for i in range(mqtt_connector.state_client_pool_size):
+        state_client, car_ids_mids = mqtt_connector.create_state_client(i)
+        state_client.on_message = enqueue_to(state_queue)
+        state_client.on_unsubscribe = enqueue_to(unsubscribe_queue)
+        AsyncioHelper(loop, state_client)
+        mqtt_connector.state_client_pool.append((state_client, car_ids_mids))
+        state_client.connect(config["address"])
+
+    client_1 = mqtt_connector.client_1
+    client_1.username_pw_set(username=config["username"], password=config["password"])
+    client_1.on_connect = mqtt_connector.on_connect
+    client_1.on_disconnect = mqtt_connector.on_disconnect
+    AsyncioHelper(loop, client_1)
+    client_1.connect(config["address"])
+    client_1.message_callback_add(config["base_topic"] + "/+/join", enqueue_to(join_queue))
+    client_1.subscribe(topic=config["base_topic"] + "/+/join", qos=config["quality_of_service"])
+    if on_terminate:
+        obituary_queue = asyncio.Queue()
+        tasks.append(loop.create_task(handle_obituaries(obituary_queue, on_terminate)))
+        client_1.message_callback_add(config["base_topic"] + "/obituary", enqueue_to(obituary_queue))
+        client_1.subscribe(topic=config["base_topic"] + "/obituary", qos=config["quality_of_service"])
+
+
+def cleanup_connector():
+    for task in tasks:
+        task.cancel()
+    mqtt_connector.client_1.disconnect()
+    for client, _ in mqtt_connector.state_client_pool:
+        client.disconnect()
@@ -0,0 +1,174 @@
+import numpy as np
+from typing import Tuple
+from car import Command, Lane, AccelerationState
+from fleet_store import FleetSnapshot
+
+# commands are represented by their integer value in the decision arrays
+NO_COMMAND = -1
+ACCELERATE = int(Command.ACCELERATE.value)
+BRAKE = int(Command.BRAKE.value)
+CHANGE_LANE = int(Command.CHANGE_LANE.value)
+command_of_code = {int(command.value): command for command in Command}
+
+
+def neighbour_indices(snapshot: FleetSnapshot, lane: Lane) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Vectorized DetailedCarTracker.car_directly_behind_in_effective_lane and car_directly_ahead_in_effective_lane
+    :return: index of the car directly behind and directly ahead in the given effective lane for every car, -1 if none
+    """
+    in_lane = np.flatnonzero(snapshot.effective_lane == lane)
+    ranks = np.arange(len(snapshot))
+    if len(in_lane) == 0:
+        return np.full(len(snapshot), -1), np.full(len(snapshot), -1)
+    behind_position = np.searchsorted(in_lane, ranks, side="left") - 1
+    ahead_position = np.searchsorted(in_lane, ranks, side="right")
+    behind = np.where(behind_position >= 0, in_lane[np.maximum(behind_position, 0)], -1)
+    ahead = np.where(ahead_position < len(in_lane), in_lane[np.minimum(ahead_position, len(in_lane) - 1)], -1)
+    return behind, ahead
+
+
+def follow_distance(speed, braking_power, safety_factor=1.0):
+    """
+    Vectorized Car.follow_distance
+    """
+    return safety_factor * ((speed / 2.0) * (speed / braking_power))
+
+
+def match_speed_distance_change(speed, acceleration, braking_power, other_speed, safety_factor=1.0):
+    """
+    Vectorized Car.match_speed_distance_change, the operations are done in the same order to get the same results
+    """
+    speeding_up = speed < other_speed
+    distance_traveled = np.where(speeding_up,
+                                 (other_speed + speed) / 2 * (other_speed - speed) / acceleration,
+                                 (other_speed + speed) / 2 * (speed - other_speed) / braking_power)
+    time_to_speed = np.where(speeding_up,
+                             other_speed - speed / acceleration,
+                             speed - other_speed / braking_power)
+    return safety_factor * (distance_traveled - time_to_speed * other_speed)
+
+
+class Neighbour:
+    """
+    Arrays of a neighbouring car for every car, the values of missing neighbours are meaningless
+    """
+    def __init__(self, snapshot: FleetSnapshot, indices: np.ndarray):
+        self.exists = indices >= 0
+        safe_indices = np.where(self.exists, indices, 0)
+        self.distance_taken = snapshot.distance_taken[safe_indices]
+        self.speed = snapshot.speed[safe_indices]
+        self.preferred_speed = snapshot.preferred_speed[safe_indices]
+        self.acceleration = snapshot.acceleration[safe_indices]
+        self.braking_power = snapshot.braking_power[safe_indices]
+        self.size = snapshot.size[safe_indices]
+
+
+def blocked_ahead(s: FleetSnapshot, ahead: Neighbour, gap_ahead):
+    # if there is a faster vehicle there, we only check not to hit it immediately
+    # else we check if we can brake while changing lanes
+    return ahead.exists & np.where(ahead.speed > s.speed,
+                                   ahead.distance_taken - ahead.size < s.distance_taken,
+                                   match_speed_distance_change(s.speed, s.acceleration, s.braking_power,
+                                                               ahead.speed, safety_factor=2.0) > gap_ahead)
+
+
+def can_overtake(s: FleetSnapshot, express_behind: Neighbour, express_ahead: Neighbour):
+    """
+    Vectorized DetailedCarTracker.can_overtake
+    """
+    cuts_path = express_behind.exists \
+        & (express_behind.speed > s.speed) \
+        & (match_speed_distance_change(express_behind.speed, express_behind.acceleration,
+                                       express_behind.braking_power, s.speed, safety_factor=2.0)
+           > np.abs(express_behind.distance_taken - s.distance_taken))
+    return (s.lane == Lane.TRAFFIC_LANE) \
+        & ~blocked_ahead(s, express_ahead, np.abs(s.distance_taken - express_ahead.distance_taken)) \
+        & ~cuts_path
+
+
+def can_merge_in(s: FleetSnapshot, traffic_behind: Neighbour, traffic_ahead: Neighbour):
+    """
+    Vectorized DetailedCarTracker.can_merge_in
+    """
+    cuts_path = traffic_behind.exists \
+        & (traffic_behind.speed > s.speed) \
+        & (match_speed_distance_change(traffic_behind.speed, traffic_behind.acceleration,
+                                       traffic_behind.braking_power, s.speed, safety_factor=2.0) * 2
+           > s.distance_taken - traffic_behind.distance_taken)
+    return (s.lane == Lane.MERGE_LANE) \
+        & ~(s.speed < s.preferred_speed * 0.7) \
+        & ~blocked_ahead(s, traffic_ahead, traffic_ahead.distance_taken - s.distance_taken) \
+        & ~cuts_path
+
+
+def can_return_to_traffic_lane(s: FleetSnapshot, traffic_behind: Neighbour, traffic_ahead: Neighbour):
+    """
+    Vectorized DetailedCarTracker.can_return_to_traffic_lane
+    """
+    # Have at least 50 meters between us and the car behind us when we change back
+    too_close_behind = traffic_behind.exists & (traffic_behind.distance_taken + 50 > s.distance_taken)
+    slow_ahead = traffic_ahead.exists \
+        & (traffic_ahead.speed < s.preferred_speed) \
+        & (traffic_ahead.distance_taken - s.distance_taken
+           < follow_distance(s.speed, s.braking_power, safety_factor=1.3))
+    return (s.lane == Lane.EXPRESS_LANE) & ~(s.speed < s.preferred_speed) & ~too_close_behind & ~slow_ahead
+
+
+def decide_commands(s: FleetSnapshot) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Makes the decisions of htcs_controller.control_traffic for the whole fleet at once.
+    The scalar controller may give two commands to a car in one iteration, a lane change first, then a speed command,
+    so there are two arrays of decisions, which should be given in this order.
+    :return: lane change commands and speed commands for every car of the snapshot, NO_COMMAND where nothing is given
+    """
+    behind = {}
+    ahead = {}
+    ahead_indices = {}
+    for lane in (Lane.MERGE_LANE, Lane.TRAFFIC_LANE, Lane.EXPRESS_LANE):
+        behind_indices, ahead_indices[lane] = neighbour_indices(s, lane)
+        behind[lane] = Neighbour(s, behind_indices)
+        ahead[lane] = Neighbour(s, ahead_indices[lane])
+    # the car directly ahead in the car's own effective lane
+    own_ahead_indices = np.select([s.effective_lane == Lane.MERGE_LANE, s.effective_lane == Lane.TRAFFIC_LANE],
+                                  [ahead_indices[Lane.MERGE_LANE], ahead_indices[Lane.TRAFFIC_LANE]],
+                                  ahead_indices[Lane.EXPRESS_LANE])
+    own_ahead = Neighbour(s, own_ahead_indices)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        overtake_possible = can_overtake(s, behind[Lane.EXPRESS_LANE], ahead[Lane.EXPRESS_LANE])
+        merge_possible = can_merge_in(s, behind[Lane.TRAFFIC_LANE], ahead[Lane.TRAFFIC_LANE])
+        return_possible = can_return_to_traffic_lane(s, behind[Lane.TRAFFIC_LANE], ahead[Lane.TRAFFIC_LANE])
+
+        # in the traffic lane we slow down if we are over our preferred speed. in this case, we also do nothing else
+        over_speed_in_traffic = (s.speed > s.preferred_speed * 1.05) & (s.effective_lane == Lane.TRAFFIC_LANE)
+
+        lane_commands = np.where(~over_speed_in_traffic
+                                 & (((s.lane == Lane.EXPRESS_LANE) & return_possible)
+                                    | ((s.lane == Lane.MERGE_LANE) & merge_possible)),
+                                 CHANGE_LANE, NO_COMMAND)
+
+        too_close = own_ahead.exists \
+            & (own_ahead.distance_taken - s.distance_taken
+               < 1 * follow_distance(s.speed, s.braking_power, safety_factor=1.2))
+        # decide_brake_or_overtake
+        worth_overtaking = (s.speed > own_ahead.speed) \
+            & (s.preferred_speed > own_ahead.preferred_speed) \
+            & overtake_possible
+        brake_or_change = np.select([s.effective_lane == Lane.EXPRESS_LANE, s.effective_lane == Lane.MERGE_LANE],
+                                    [BRAKE, np.where(merge_possible, CHANGE_LANE, BRAKE)],
+                                    np.where(worth_overtaking, CHANGE_LANE, BRAKE))
+        far_enough = ~own_ahead.exists \
+            | (own_ahead.distance_taken - s.distance_taken > follow_distance(s.speed, s.braking_power, safety_factor=2)) \
+            | (own_ahead.speed > s.preferred_speed)
+        should_accelerate = (s.acceleration_state != AccelerationState.ACCELERATING.value) & far_enough
+
+        speed_commands = np.select([over_speed_in_traffic,
+                                    too_close,
+                                    s.speed < s.preferred_speed,
+                                    (s.lane == Lane.EXPRESS_LANE) & (s.speed < s.max_speed)],
+                                   [BRAKE,
+                                    brake_or_change,
+                                    np.where(should_accelerate, ACCELERATE, NO_COMMAND),
+                                    ACCELERATE],
+                                   NO_COMMAND)
+    return lane_commands, speed_commands
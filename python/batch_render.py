@@ -0,0 +1,165 @@
+import os
+import cv2
+import logging
+import argparse
+import multiprocessing
+import numpy as np
+from typing import List, Tuple
+from HTCSPythonUtil import config
+from fleet_timeline import FleetTimeline
+from fleet_snapshot import FrameSnapshot
+
+logger = logging.getLogger(__name__)
+
+# the cars are drawn this long after their last state, so the terminated cars are seen exploding
+LINGER_SEC = 1.0
+# consecutive frames rendered by the same worker, so the layers of the camera are reused between them
+FRAMES_PER_TASK = 16
+
+
+class CameraPath:
+    """
+    Offsets of the visible region at key times of the session, interpolated linearly between them.
+    While follow_car_id is on the road, the camera follows it instead, like after clicking the car in the window.
+    """
+    def __init__(self, keyframes: List[Tuple[float, float]], region_width_meter: float, follow_car_id: str = None):
+        self.times = np.array([time for time, _ in keyframes], dtype=np.float64)
+        self.offsets = np.array([offset for _, offset in keyframes], dtype=np.float64)
+        self.region_width_meter = region_width_meter
+        self.follow_car_id = follow_car_id
+
+    def offset_at(self, session_sec: float) -> float:
+        return float(np.interp(session_sec, self.times, self.offsets))
+
+    @staticmethod
+    def parse_keyframes(text: str) -> List[Tuple[float, float]]:
+        """
+        :param text: comma separated time:offset pairs in seconds of the session and meters, e.g. 0:0,60:2000
+        """
+        keyframes = [tuple(float(value) for value in keyframe.split(":")) for keyframe in text.split(",")]
+        return sorted(keyframes)
+
+
+# the state of a rendering process, see start_worker
+timeline: FleetTimeline or None = None
+camera: CameraPath or None = None
+visu = None
+car_appearance: List[Tuple[tuple, tuple]] = []
+car_colors: np.ndarray = np.zeros((0, 3), np.uint8)
+
+
+def start_worker(timeline_path: str, camera_path: CameraPath, window_width: int):
+    """
+    Loads the timeline and the visualizer in a rendering process. The visualizer takes its resolution from the
+    config when it is imported, so it is imported here, after the width of the frames is set.
+    """
+    global timeline, camera, visu, car_appearance, car_colors
+    config["window_width"] = window_width
+    import visu as visu_module
+    import visu_res as vis
+    visu = visu_module
+    timeline = FleetTimeline.load(timeline_path)
+    camera = camera_path
+    visu.set_region_width(camera.region_width_meter)
+    sprite_kinds = [vis.sprite_kind_of(car_id, size) for car_id, size in zip(timeline.ids, timeline.size)]
+    car_colors = np.array([vis.colors_of_kind[kind][0] for kind in sprite_kinds], dtype=np.uint8).reshape(-1, 3)
+    # the appearance of every car, before and after its termination, see visu.appearance_of
+    car_appearance = [((kind, tuple(color), False), (kind, tuple(color), True))
+                      for kind, color in zip(sprite_kinds, car_colors.tolist())]
+
+
+def snapshot_at(at: float) -> FrameSnapshot:
+    """
+    :return: the cars on the road at the given time, ordered by their distance like in the window,
+    their positions are interpolated between their states before and after the time
+    """
+    cars, last, following = timeline.states_at(at, LINGER_SEC)
+    order = np.argsort(timeline.distance_taken[last], kind="stable")
+    cars, last, following = cars[order], last[order], following[order]
+    exploded = timeline.terminated_at[cars] <= at
+    return FrameSnapshot(at, tuple(timeline.ids[car] for car in cars), timeline.lane[last],
+                         timeline.distance_taken[last], timeline.speed[last], timeline.size[cars],
+                         tuple(car_appearance[car][int(is_exploded)] for car, is_exploded in zip(cars, exploded)),
+                         {"minimap_colors": car_colors[cars]}, timeline.time[following],
+                         timeline.distance_taken[following], timeline.time[last], timeline.distance_taken[last])
+
+
+def render_frame(frame: Tuple[int, float, str or None]) -> np.ndarray or None:
+    """
+    :param frame: the index of the frame, its time in the session and the image file to write it to, if any
+    :return: the image of the frame, if it is not written to a file
+    """
+    index, at, image_path = frame
+    session_sec = at - timeline.start
+    visu.set_offset(camera.offset_at(session_sec))
+    visu.focused_car_id = camera.follow_car_id
+    image = visu.compose_frame(snapshot_at(at), at, f"{session_sec:.1f} s")
+    if image_path is not None:
+        cv2.imwrite(image_path, image)
+        return None
+    return image
+
+
+def render(timeline_path: str, output: str, camera_path: CameraPath, fps=30.0, window_width=1920,
+           start_sec=0.0, end_sec: float = None, processes: int = None) -> int:
+    """
+    Renders the frames of a recorded timeline in a pool of processes, and writes them in order to an MP4 video,
+    or to a directory of PNG images, if output is not an .mp4 file. The PNG images are written by the processes.
+    :param start_sec: the time of the first frame in seconds of the session
+    :param end_sec: the time of the last frame in seconds of the session, the end of the session by default
+    :return: the number of frames rendered
+    """
+    recorded = FleetTimeline.load(timeline_path)
+    end_sec = recorded.end - recorded.start if end_sec is None else end_sec
+    frame_times = recorded.start + np.arange(start_sec, end_sec, 1 / fps)
+    to_video = output.lower().endswith(".mp4")
+    if not to_video:
+        os.makedirs(output, exist_ok=True)
+    frames = [(index, at, None if to_video else os.path.join(output, f"frame_{index:06d}.png"))
+              for index, at in enumerate(frame_times)]
+    processes = processes or os.cpu_count()
+    logger.info(f"Rendering {len(frames)} frames of {len(recorded.ids)} cars with {processes} processes")
+    writer = None
+    pool = None
+    if processes > 1:
+        pool = multiprocessing.Pool(processes, start_worker, (timeline_path, camera_path, window_width))
+        images = pool.imap(render_frame, frames, FRAMES_PER_TASK)
+    else:
+        start_worker(timeline_path, camera_path, window_width)
+        images = map(render_frame, frames)
+    try:
+        # the frames arrive in order, even if they are rendered by different processes
+        for image in images:
+            if not to_video:
+                continue
+            if writer is None:
+                writer = cv2.VideoWriter(output, cv2.VideoWriter_fourcc(*"mp4v"), fps,
+                                         (image.shape[1], image.shape[0]))
+            writer.write(image)
+    finally:
+        if writer is not None:
+            writer.release()
+        if pool is not None:
+            pool.close()
+            pool.join()
+    logger.info(f"{len(frames)} frames written to {output}")
+    return len(frames)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Renders a recorded timeline of the fleet without a display")
+    parser.add_argument("timeline", help="timeline file, see simulator.record_session")
+    parser.add_argument("output", help="MP4 file, or directory of PNG images")
+    parser.add_argument("--fps", type=float, default=30.0)
+    parser.add_argument("--width", type=int, default=1920, help="width of the frames in pixels")
+    parser.add_argument("--region-width", type=float, default=200.0, help="width of the visible region in meters")
+    parser.add_argument("--camera", default="0:0", help="time:offset keyframes of the camera, e.g. 0:0,60:2000")
+    parser.add_argument("--follow", help="id of a car to follow with the camera while it is on the road")
+    parser.add_argument("--start", type=float, default=0.0, help="start of the rendering in seconds of the session")
+    parser.add_argument("--end", type=float, help="end of the rendering in seconds of the session")
+    parser.add_argument("--processes", type=int, help="number of rendering processes, the number of CPUs by default")
+    args = parser.parse_args()
+
+    render(args.timeline, args.output,
+           CameraPath(CameraPath.parse_keyframes(args.camera), args.region_width, args.follow),
+           args.fps, args.width, args.start, args.end, args.processes)
@@ -0,0 +1,205 @@
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import platform
+import datetime
+import numpy as np
+from typing import Callable, Dict, List
+import state_codec
+import mqtt_connector
+import htcs_controller
+import terminator
+from car import Car, DetailedCarTracker, Lane
+from fleet_store import ColumnarCarManager
+from generator import generate_random_cars
+
+logger = logging.getLogger(__name__)
+
+FLEET_SIZES = [100, 1000, 10000, 50000]
+SEED = 2020
+# a regression is reported, if a measurement got slower than the baseline by more than this ratio
+REGRESSION_TOLERANCE = 0.2
+# measurements are repeated until this many seconds, but at least MIN_RUNS times
+TIME_BUDGET_SEC = 2.0
+MIN_RUNS = 5
+
+
+class DiscardingClient:
+    """
+    Takes the place of mqtt_connector.client_1, so the commands are not sent anywhere
+    """
+    def publish(self, topic, payload, qos=0, retain=False):
+        pass
+
+
+def measure_latency(function: Callable, setup: Callable = None) -> Dict[str, float]:
+    """
+    Calls function repeatedly, setup is called before every call and is not measured
+    :return: percentiles of the latency in milliseconds
+    """
+    latencies = []
+    budget_end = time.perf_counter() + TIME_BUDGET_SEC
+    while len(latencies) < MIN_RUNS or time.perf_counter() < budget_end:
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        latencies.append(time.perf_counter() - start)
+    latencies_ms = np.array(latencies) * 1000
+    return {"runs": len(latencies),
+            "p50_ms": float(np.percentile(latencies_ms, 50)),
+            "p99_ms": float(np.percentile(latencies_ms, 99)),
+            "mean_ms": float(latencies_ms.mean())}
+
+
+def measure_throughput(function: Callable, operation_count: int) -> Dict[str, float]:
+    """
+    :param function: performs operation_count operations when called
+    """
+    latency = measure_latency(function)
+    return {"runs": latency["runs"], "operations_per_sec": operation_count / (latency["p50_ms"] / 1000)}
+
+
+def tracker_of(cars: List[Car], tracker_class=DetailedCarTracker):
+    tracker = tracker_class()
+    for car in cars:
+        tracker[car.id] = car
+    return tracker
+
+
+def bench_tracker(cars: List[Car], rng: random.Random) -> Dict[str, Dict]:
+    tracker = tracker_of(cars)
+    tracked = tracker.get_all()
+    updates = [(car.id, (int(car.lane), car.distance_taken + rng.random() * 3, car.speed, 0)) for car in tracked]
+
+    def update_all():
+        for car_id, state in updates:
+            tracker.update_car(car_id, state)
+
+    def query_all():
+        for car in tracked:
+            tracker.car_directly_ahead_in_effective_lane(car, Lane.TRAFFIC_LANE)
+            tracker.car_directly_behind_in_effective_lane(car, Lane.EXPRESS_LANE)
+
+    # 200 m windows along the road, like the visible region of the visualizer
+    windows = [(car.distance_taken, car.distance_taken + 200.0) for car in tracked[::max(len(tracked) // 100, 1)]]
+
+    def overlap_all():
+        for start, end in windows:
+            tracker.cars_overlapping(start, end)
+
+    return {"update_car": measure_throughput(update_all, len(updates)),
+            "ahead_behind_query": measure_throughput(query_all, 2 * len(tracked)),
+            "overlap_query": measure_throughput(overlap_all, len(windows))}
+
+
+def forget_commands(tracker):
+    """
+    Makes the cars forget the last command they were given, so every tick publishes the commands again,
+    instead of dropping them as repeated ones after the first tick
+    """
+    for car in tracker.get_all():
+        car.last_command = None
+        car.lane_when_last_command = car.lane
+
+
+def bench_controller(cars: List[Car]) -> Dict[str, Dict]:
+    mqtt_connector.client_1 = DiscardingClient()
+    results = {}
+    tracker = htcs_controller.local_cars = tracker_of(cars)
+    results["control_traffic"] = measure_latency(htcs_controller.control_traffic, lambda: forget_commands(tracker))
+    columnar = htcs_controller.local_cars = tracker_of(cars, ColumnarCarManager)
+    results["control_traffic_batch"] = measure_latency(htcs_controller.control_traffic_batch,
+                                                       lambda: forget_commands(columnar))
+    return results
+
+
+def bench_terminator(cars: List[Car]) -> Dict[str, Dict]:
+    return {"find_collisions": measure_latency(lambda: terminator.find_collisions(cars))}
+
+
+def bench_state_parsing(message_count: int, rng: random.Random) -> Dict[str, Dict]:
+    payloads = [f"{rng.randint(0, 5)},{rng.random() * 10000:.4f},{rng.random() * 50:.4f},{rng.randint(0, 2)}"
+                .encode("utf-8") for _ in range(message_count)]
+    return {"decode_state": measure_throughput(lambda: [state_codec.decode_state(p) for p in payloads],
+                                               message_count),
+            "decode_states": measure_throughput(lambda: state_codec.decode_states(payloads), message_count)}
+
+
+def bench_visu_frame(cars: List[Car]) -> Dict[str, Dict]:
+    try:
+        import visu
+        import visu_res
+    except Exception as e:
+        # the visualizer needs OpenCV
+        return {"compose_frame": {"skipped": f"{type(e).__name__}: {e}"}}
+    tracker = DetailedCarTracker()
+    for car in cars:
+        tracker[car.id] = visu_res.CarImage(car.id, car.specs, (int(car.lane), car.distance_taken, car.speed, 0))
+    visu.local_cars = tracker
+    visu.focused_car_id = None
+    return {"compose_frame": measure_latency(visu.compose_frame)}
+
+
+def run(fleet_sizes: List[int], seed=SEED) -> Dict:
+    results = {"metadata": {"timestamp": datetime.datetime.now().isoformat(),
+                            "python": sys.version.split()[0],
+                            "numpy": np.__version__,
+                            "platform": platform.platform(),
+                            "seed": seed},
+               "fleets": {}}
+    for fleet_size in fleet_sizes:
+        logger.info(f"Measuring fleet of {fleet_size} cars")
+        rng = random.Random(seed)
+        fleet_results = {}
+        fleet_results.update(bench_tracker(generate_random_cars(fleet_size, seed), rng))
+        fleet_results.update(bench_controller(generate_random_cars(fleet_size, seed)))
+        fleet_results.update(bench_terminator(generate_random_cars(fleet_size, seed)))
+        fleet_results.update(bench_state_parsing(fleet_size, rng))
+        fleet_results.update(bench_visu_frame(generate_random_cars(fleet_size, seed)))
+        results["fleets"][str(fleet_size)] = fleet_results
+    return results
+
+
+def find_regressions(results: Dict, baseline: Dict, tolerance=REGRESSION_TOLERANCE) -> List[str]:
+    """
+    :return: description of every measurement that got slower than the baseline by more than the tolerance
+    """
+    regressions = []
+    for fleet_size, fleet_results in results["fleets"].items():
+        for name, measurement in fleet_results.items():
+            base = baseline.get("fleets", {}).get(fleet_size, {}).get(name)
+            if base is None or "skipped" in base or "skipped" in measurement:
+                continue
+            if "p50_ms" in measurement and measurement["p50_ms"] > base["p50_ms"] * (1 + tolerance):
+                regressions.append(f"{fleet_size} cars, {name}: p50 {base['p50_ms']:.3f} ms -> "
+                                   f"{measurement['p50_ms']:.3f} ms")
+            elif "operations_per_sec" in measurement \
+                    and measurement["operations_per_sec"] < base["operations_per_sec"] / (1 + tolerance):
+                regressions.append(f"{fleet_size} cars, {name}: {base['operations_per_sec']:.0f} ops/s -> "
+                                   f"{measurement['operations_per_sec']:.0f} ops/s")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark of the hot paths of the python modules")
+    parser.add_argument("--sizes", type=int, nargs="+", default=FLEET_SIZES, help="fleet sizes to measure")
+    parser.add_argument("--seed", type=int, default=SEED)
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON file to write the results to")
+    parser.add_argument("--baseline", help="JSON file of an earlier run to compare with")
+    args = parser.parse_args()
+
+    benchmark_results = run(args.sizes, args.seed)
+    with open(args.output, "w") as output_file:
+        json.dump(benchmark_results, output_file, indent=2)
+    logger.info(f"Results written to {args.output}")
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            found_regressions = find_regressions(benchmark_results, json.load(baseline_file))
+        for regression in found_regressions:
+            logger.warning(f"Regression: {regression}")
+        if found_regressions:
+            sys.exit(1)
@@ -1,6 +1,8 @@
+import math
 import time
+import bisect
 import threading
-from typing import List, Tuple
+from typing import Dict, Iterable, List, Tuple
 from enum import Enum, IntEnum
 
 
@@ -34,6 +36,9 @@ effective_lanes = [Lane.MERGE_LANE,
                    Lane.TRAFFIC_LANE,
                    Lane.EXPRESS_LANE]
 
+# the state of a car is extrapolated at most this long after its last state message, see Car.extrapolated_state
+MAX_EXTRAPOLATION_SEC = 2.0
+
 
 class CarSpecs:
     def __init__(self, specs: Tuple[float, float, float, float, float]):
@@ -74,6 +79,9 @@ class Car:
         self.distance_taken: float = state[1]
         self.speed: float = state[2]
         self.acceleration_state: AccelerationState = AccelerationState(state[3])
+        # distance_taken and speed may be overwritten by extrapolation, these are the values of the last state message
+        self.reported_distance_taken: float = state[1]
+        self.reported_speed: float = state[2]
         self.last_command: Command or None = None
         self.lane_when_last_command: Lane = self.lane
         self.last_state_update: float = time.time()
@@ -90,9 +98,35 @@ class Car:
         self.lane = Lane(state[0])
         self.distance_taken = state[1]
         self.speed = state[2]
-        self.acceleration_state = state[3]
+        self.acceleration_state = AccelerationState(state[3])
+        self.reported_distance_taken = state[1]
+        self.reported_speed = state[2]
         self.last_state_update: float = time.time()
 
+    def extrapolated_state(self, at: float, max_elapsed_sec=MAX_EXTRAPOLATION_SEC) -> Tuple[float, float]:
+        """
+        Dead reckoning from the last reported state, following adjustState in htcs-vehicle/src/state.c
+        :param at: the time to extrapolate to, like time.time()
+        :param max_elapsed_sec: the state is not extrapolated further than this after the last state message
+        :return: distance taken and speed
+        """
+        elapsed = min(max(at - self.last_state_update, 0.0), max_elapsed_sec)
+        distance, speed = self.reported_distance_taken, self.reported_speed
+        if self.acceleration_state == AccelerationState.ACCELERATING:
+            # in the express lane the car accelerates up to its max speed, elsewhere up to its preferred speed
+            top_speed = self.specs.max_speed if self.lane == Lane.EXPRESS_LANE else self.specs.preferred_speed
+            top_speed = max(top_speed, speed)
+            accelerating_sec = min(elapsed, (top_speed - speed) / self.specs.acceleration)
+            new_speed = speed + self.specs.acceleration * accelerating_sec
+            return distance + (speed + new_speed) / 2 * accelerating_sec + new_speed * (elapsed - accelerating_sec), \
+                new_speed
+        if self.acceleration_state == AccelerationState.BRAKING:
+            # the car stops at zero speed
+            braking_sec = min(elapsed, speed / self.specs.braking_power)
+            new_speed = speed - self.specs.braking_power * braking_sec
+            return distance + (speed + new_speed) / 2 * braking_sec, new_speed
+        return distance + speed * elapsed, speed
+
     def signed_distance_between(self, other_car):
         if other_car is None:
             return float('nan')
@@ -172,76 +206,154 @@ class CarManager:
         with self.lock:
             return [car for car in self.as_dict.values()]
 
+    def extrapolate(self, at: float, max_elapsed_sec=MAX_EXTRAPOLATION_SEC):
+        """
+        Sets the distance taken and the speed of every car to their extrapolated values, see Car.extrapolated_state
+        """
+        with self.lock:
+            for car in self.as_dict.values():
+                car.distance_taken, car.speed = car.extrapolated_state(at, max_elapsed_sec)
+
 
 class DetailedCarTracker(CarManager):
+    """
+    Keeps the cars ordered along the road, both all together and separately in every effective lane.
+    A car is ordered by the key (distance_taken, sequence number), where the sequence number is given at insertion,
+    so cars with the same distance also have a strict order. The key and the effective lane a car was indexed with
+    are stored in the slots dictionary, so the car can be found by bisection even after its state has been updated.
+    The sizes of the cars are kept sorted as well, so the cars overlapping a range of the road can be found
+    by bisection too, see cars_overlapping.
+    """
     def __init__(self):
         super().__init__()
         self.full_list: List[Car] = []
+        self.full_keys: List[Tuple[float, int]] = []
+        self.lane_lists: Dict[Lane, List[Car]] = {lane: [] for lane in set(effective_lanes)}
+        self.lane_keys: Dict[Lane, List[Tuple[float, int]]] = {lane: [] for lane in set(effective_lanes)}
+        self.slots: Dict[str, Tuple[Tuple[float, int], Lane]] = {}
+        self.sorted_sizes: List[float] = []
+        self.sequence = 0
 
     def __getitem__(self, key):
-        for car in self.full_list:
-            if car.id == key:
-                return car
-        raise KeyError
+        return self.as_dict[key]
 
     def get(self, key):
-        for car in self.full_list:
-            if car.id == key:
-                return car
-        return None
+        return self.as_dict.get(key)
 
     def __setitem__(self, key, value: Car):
-        self.put_into_full_list(value)
-
-    def put_into_full_list(self, value: Car):
-        for index_with_bigger_dist in range(0, len(self.full_list)):
-            if self.full_list[index_with_bigger_dist].distance_taken > value.distance_taken:
-                self.full_list.insert(index_with_bigger_dist, value)
-                return
-        self.full_list.append(value)
+        with self.lock:
+            if key in self.as_dict:
+                self._remove_car(key)
+            self.as_dict[key] = value
+            self.sequence += 1
+            self._insert_into_index(key, value, self.sequence)
+            # the size of a car does not change with its state, so it is only kept here and in _remove_car
+            bisect.insort(self.sorted_sizes, value.specs.size)
+
+    def _insert_into_index(self, key, car: Car, sequence: int):
+        sort_key = (car.distance_taken, sequence)
+        lane = car.effective_lane()
+        index = bisect.bisect_left(self.full_keys, sort_key)
+        self.full_keys.insert(index, sort_key)
+        self.full_list.insert(index, car)
+        index = bisect.bisect_left(self.lane_keys[lane], sort_key)
+        self.lane_keys[lane].insert(index, sort_key)
+        self.lane_lists[lane].insert(index, car)
+        self.slots[key] = (sort_key, lane)
+
+    def _remove_from_index(self, key):
+        sort_key, lane = self.slots.pop(key)
+        index = bisect.bisect_left(self.full_keys, sort_key)
+        del self.full_keys[index]
+        del self.full_list[index]
+        index = bisect.bisect_left(self.lane_keys[lane], sort_key)
+        del self.lane_keys[lane][index]
+        del self.lane_lists[lane][index]
+        return sort_key[1]
+
+    def _remove_car(self, key):
+        self._remove_from_index(key)
+        del self.sorted_sizes[bisect.bisect_left(self.sorted_sizes, self.as_dict[key].specs.size)]
 
     def update_car(self, car_id, state):
-        car = self[car_id]
-        car.update_state(state)
-        index_now = self.full_list.index(car)
-        if index_now < len(self.full_list) - 1 and self.full_list[index_now + 1].distance_taken < car.distance_taken:
-            with self.lock:
-                self.full_list[index_now], self.full_list[index_now + 1] = \
-                    self.full_list[index_now + 1], self.full_list[index_now]
-        # we do not have to check the other swap, since the car could not have moved backwards
+        with self.lock:
+            car = self.as_dict[car_id]
+            car.update_state(state)
+            sequence = self._remove_from_index(car_id)
+            self._insert_into_index(car_id, car, sequence)
 
     def pop(self, key, default_value=None):
-        for i in range(0, len(self.full_list)):
-            if self.full_list[i].id == key:
-                return self.full_list.pop(i)
-        return default_value
+        with self.lock:
+            if key not in self.as_dict:
+                return default_value
+            self._remove_car(key)
+            return self.as_dict.pop(key)
 
     def get_all(self) -> List[Car]:
         # this is a new list of object pointers
         with self.lock:
             return [car for car in self.full_list]
 
-    def car_directly_behind_in_effective_lane(self, car_in_focus: Car, lane: Lane):
-        try:
-            index = self.full_list.index(car_in_focus) - 1
-        except ValueError:
+    def extrapolate(self, at: float, max_elapsed_sec=MAX_EXTRAPOLATION_SEC):
+        with self.lock:
+            for car in self.full_list:
+                car.distance_taken, car.speed = car.extrapolated_state(at, max_elapsed_sec)
+            # the cars keep their sequence numbers, but may overtake each other
+            entries = sorted(((car.distance_taken, self.slots[car.id][0][1]), car) for car in self.full_list)
+            self.full_keys = [sort_key for sort_key, _ in entries]
+            self.full_list = [car for _, car in entries]
+            for lane in self.lane_lists:
+                self.lane_keys[lane] = []
+                self.lane_lists[lane] = []
+            for sort_key, car in entries:
+                lane = car.effective_lane()
+                self.lane_keys[lane].append(sort_key)
+                self.lane_lists[lane].append(car)
+                self.slots[car.id] = (sort_key, lane)
+
+    def cars_overlapping(self, start: float, end: float, lanes: Iterable[Lane] = None) -> List[Car]:
+        """
+        Finds the cars in O(log n + k) by bisection, since a car overlapping the range is ahead of start,
+        but at most the size of the longest car ahead of end
+        :param lanes: the effective lanes to search in, all cars by default
+        :return: the cars, whose body (distance_taken - size, distance_taken) overlaps (start, end),
+        ordered along the road
+        """
+        with self.lock:
+            longest = self.sorted_sizes[-1] if self.sorted_sizes else 0.0
+            sources = [(self.full_keys, self.full_list)] if lanes is None \
+                else [(self.lane_keys[lane], self.lane_lists[lane]) for lane in set(lanes)]
+            found = []
+            for keys, cars in sources:
+                first = bisect.bisect_right(keys, (start, math.inf))
+                last = bisect.bisect_left(keys, (end + longest, -math.inf))
+                found.extend((keys[index], cars[index]) for index in range(first, last)
+                             if keys[index][0] - cars[index].specs.size < end)
+            if len(sources) > 1:
+                found.sort(key=lambda entry: entry[0])
+            return [car for _, car in found]
+
+    def _sort_key_of(self, car_in_focus: Car):
+        # the car has to be the very same object that is tracked, just like list.index would require
+        if self.as_dict.get(car_in_focus.id) is not car_in_focus:
             return None
-        while index >= 0:
-            if self.full_list[index].effective_lane() == lane:
-                return self.full_list[index]
-            index -= 1
-        return None
+        return self.slots[car_in_focus.id][0]
+
+    def car_directly_behind_in_effective_lane(self, car_in_focus: Car, lane: Lane):
+        with self.lock:
+            sort_key = self._sort_key_of(car_in_focus)
+            if sort_key is None:
+                return None
+            index = bisect.bisect_left(self.lane_keys[lane], sort_key) - 1
+            return self.lane_lists[lane][index] if index >= 0 else None
 
     def car_directly_ahead_in_effective_lane(self, car_in_focus: Car, lane: Lane):
-        try:
-            index = self.full_list.index(car_in_focus) + 1
-        except ValueError:
-            return None
-        while index < len(self.full_list):
-            if self.full_list[index].effective_lane() == lane:
-                return self.full_list[index]
-            index += 1
-        return None
+        with self.lock:
+            sort_key = self._sort_key_of(car_in_focus)
+            if sort_key is None:
+                return None
+            index = bisect.bisect_right(self.lane_keys[lane], sort_key)
+            return self.lane_lists[lane][index] if index < len(self.lane_lists[lane]) else None
 
     def can_overtake(self, car_in_focus: Car):
         if car_in_focus.lane != Lane.TRAFFIC_LANE:
@@ -308,3 +420,120 @@ class DetailedCarTracker(CarManager):
                 and car_ahead_if_return.distance_taken - car_in_focus.distance_taken < car_in_focus.follow_distance(safety_factor=1.3):
             return False
         return True
+
+
+class IncrementalCarTracker(DetailedCarTracker):
+    """
+    DetailedCarTracker, which also collects the cars whose control decision may have changed (dirty cars).
+    A state update is significant, if the lane, the acceleration state or the speed of the car changed, or it got
+    new neighbours in its lane. A significant update marks the car dirty, together with its former and new neighbours
+    in its lane, and the cars of the other lanes within watch distance which have it as their neighbour there,
+    since these are the cars that may look at it when deciding.
+    Cars with unchanged states only need to be evaluated again while their gaps to their neighbours change
+    within watch distance, see is_steady.
+    """
+    def __init__(self, watch_distance_meter=100.0, speed_epsilon=0.01):
+        super().__init__()
+        self.watch_distance_meter = watch_distance_meter
+        self.speed_epsilon = speed_epsilon
+        self.dirty = set()
+
+    def _neighbourhood_of(self, key):
+        """
+        :return: the car behind and the car ahead in its effective lane, and the range of sort keys between them
+        """
+        sort_key, lane = self.slots[key]
+        keys = self.lane_keys[lane]
+        index = bisect.bisect_left(keys, sort_key)
+        behind = self.lane_lists[lane][index - 1] if index > 0 else None
+        ahead = self.lane_lists[lane][index + 1] if index + 1 < len(keys) else None
+        low_key = keys[index - 1] if index > 0 else None
+        high_key = keys[index + 1] if index + 1 < len(keys) else None
+        return behind, ahead, low_key, high_key, sort_key[0]
+
+    def _mark_neighbourhood(self, neighbourhood):
+        behind, ahead, low_key, high_key, distance = neighbourhood
+        for neighbour in (behind, ahead):
+            if neighbour is not None:
+                self.dirty.add(neighbour.id)
+        # the cars of every lane between the neighbours, but not further than the watch distance
+        low_key = max(low_key or (float('-inf'), 0), (distance - self.watch_distance_meter, 0))
+        high_key = min(high_key or (float('inf'), 0), (distance + self.watch_distance_meter, 0))
+        start = bisect.bisect_right(self.full_keys, low_key)
+        end = bisect.bisect_left(self.full_keys, high_key)
+        self.dirty.update(car.id for car in self.full_list[start:end])
+
+    def __setitem__(self, key, value: Car):
+        super().__setitem__(key, value)
+        with self.lock:
+            self.dirty.add(key)
+            self._mark_neighbourhood(self._neighbourhood_of(key))
+
+    def update_car(self, car_id, state):
+        with self.lock:
+            car = self.as_dict[car_id]
+            lane, acceleration_state, speed = car.lane, car.acceleration_state, car.speed
+            before = self._neighbourhood_of(car_id)
+            car.update_state(state)
+            sequence = self._remove_from_index(car_id)
+            self._insert_into_index(car_id, car, sequence)
+            after = self._neighbourhood_of(car_id)
+            if car.lane != lane or car.acceleration_state != acceleration_state \
+                    or abs(car.speed - speed) > self.speed_epsilon \
+                    or before[0] is not after[0] or before[1] is not after[1]:
+                self.dirty.add(car_id)
+                self._mark_neighbourhood(before)
+                self._mark_neighbourhood(after)
+
+    def pop(self, key, default_value=None):
+        with self.lock:
+            if key not in self.as_dict:
+                return default_value
+            self._mark_neighbourhood(self._neighbourhood_of(key))
+            self.dirty.discard(key)
+            self._remove_car(key)
+            return self.as_dict.pop(key)
+
+    def take_dirty(self) -> List[Car]:
+        """
+        :return: the dirty cars in the order along the road, and they are no longer dirty
+        """
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+            return [self.as_dict[key] for key in sorted(dirty, key=lambda k: self.slots[k][0])
+                    if key in self.as_dict]
+
+    def mark_dirty(self, car: Car):
+        with self.lock:
+            if car.id in self.as_dict:
+                self.dirty.add(car.id)
+
+    def is_steady(self, car: Car, lookahead_sec: float) -> bool:
+        """
+        A car is steady, if its decision can not change in the next lookahead_sec seconds without a significant update,
+        because it maintains its speed, and the gaps to the neighbours it looks at stay constant or stay
+        out of the watch distance, or out of the largest distance the decisions compare with the gap, if that is longer
+        """
+        if car.acceleration_state != AccelerationState.MAINTAINING_SPEED:
+            return False
+        lanes = {car.effective_lane()}
+        if car.lane in (Lane.MERGE_LANE, Lane.EXPRESS_LANE):
+            lanes.add(Lane.TRAFFIC_LANE)
+        elif car.lane == Lane.TRAFFIC_LANE:
+            lanes.add(Lane.EXPRESS_LANE)
+        for lane in lanes:
+            for neighbour in (self.car_directly_behind_in_effective_lane(car, lane),
+                              self.car_directly_ahead_in_effective_lane(car, lane)):
+                if neighbour is None:
+                    continue
+                relative_speed = abs(neighbour.speed - car.speed)
+                if relative_speed <= self.speed_epsilon:
+                    continue
+                # the largest distances compared with the gap by the decisions
+                watch_distance = max(self.watch_distance_meter,
+                                     2 * car.follow_distance(), 2 * neighbour.follow_distance(),
+                                     car.match_speed_distance_change(neighbour, safety_factor=4.0),
+                                     neighbour.match_speed_distance_change(car, safety_factor=4.0))
+                if car.distance_between(neighbour) - relative_speed * lookahead_sec < watch_distance:
+                    return False
+        return True
@@ -0,0 +1,56 @@
+import threading
+from typing import Dict, List, Set
+
+
+class DeadlineWheel:
+    """
+    Timing wheel of deadlines: every key is kept in the bucket of its deadline, and every bucket covers
+    resolution_sec seconds. Expiring takes only the buckets that are due, so its cost is proportional to the number
+    of buckets and of the expired keys, not to the number of keys.
+    A key is returned by the first expire call at or after the start of the bucket of its deadline, so at most
+    resolution_sec seconds before its deadline, and after it by up to the interval of the expire calls.
+    """
+    def __init__(self, resolution_sec=1.0):
+        self.resolution_sec = resolution_sec
+        self.lock = threading.Lock()
+        self.buckets: Dict[int, Set[str]] = {}
+        self.bucket_of_key: Dict[str, int] = {}
+
+    def __len__(self):
+        return len(self.bucket_of_key)
+
+    def schedule(self, key: str, deadline: float):
+        """
+        Sets the deadline of the key, replacing its earlier deadline
+        """
+        bucket = int(deadline // self.resolution_sec)
+        with self.lock:
+            self._remove(key)
+            self.buckets.setdefault(bucket, set()).add(key)
+            self.bucket_of_key[key] = bucket
+
+    def cancel(self, key: str):
+        with self.lock:
+            self._remove(key)
+
+    def _remove(self, key: str):
+        bucket = self.bucket_of_key.pop(key, None)
+        if bucket is not None:
+            keys = self.buckets[bucket]
+            keys.discard(key)
+            if not keys:
+                del self.buckets[bucket]
+
+    def expire(self, now: float) -> List[str]:
+        """
+        :return: the keys whose bucket is due at the given time, they are removed from the wheel
+        """
+        current_bucket = int(now // self.resolution_sec)
+        expired = []
+        with self.lock:
+            for bucket in [b for b in self.buckets if b <= current_bucket]:
+                keys = self.buckets.pop(bucket)
+                for key in keys:
+                    del self.bucket_of_key[key]
+                expired.extend(keys)
+        return expired
@@ -0,0 +1,151 @@
+import threading
+import numpy as np
+from typing import Callable, Dict, Iterable, List, Tuple
+from car import Car
+
+# a car is extrapolated at most this many times the time between its last two states after its last state,
+# in case its next state message is late
+MAX_RATIO = 2.0
+
+
+def read_only(array: np.ndarray) -> np.ndarray:
+    array.flags.writeable = False
+    return array
+
+
+class FrameSnapshot:
+    """
+    Immutable copy of the state of the fleet at taken_at, so it can be read by other threads while the cars change.
+    It is drawn by the visualizer, the controller decides on the columns of fleet_store.FleetSnapshot instead.
+    The columns are read-only numpy arrays with a row for every car, appearance holds a tuple for every car
+    (e.g. its sprite and color), and extras any other immutable data of the producer (e.g. the focused car's stats).
+    The last two different states reported by every car (the time and distance of its state messages) are kept,
+    so its position can be interpolated between them.
+    The cars are indexed by the part of the road they can be drawn on at any time, see rows_overlapping.
+    """
+    def __init__(self, taken_at: float, ids: Tuple[str, ...], lane: np.ndarray, distance_taken: np.ndarray,
+                 speed: np.ndarray, size: np.ndarray, appearance: Tuple[tuple, ...], extras: Dict[str, object],
+                 state_time: np.ndarray, state_distance: np.ndarray,
+                 previous_state_time: np.ndarray, previous_state_distance: np.ndarray):
+        self.taken_at = taken_at
+        self.ids = ids
+        self.row_of_id = {car_id: row for row, car_id in enumerate(ids)}
+        self.lane = read_only(lane)
+        self.distance_taken = read_only(distance_taken)
+        self.speed = read_only(speed)
+        self.size = read_only(size)
+        self.appearance = appearance
+        self.extras = extras
+        self.state_time = read_only(state_time)
+        self.state_distance = read_only(state_distance)
+        # nan for the cars, which have reported only one state so far
+        self.previous_state_time = read_only(previous_state_time)
+        self.previous_state_distance = read_only(previous_state_distance)
+        self.index_interval_starts()
+
+    def index_interval_starts(self):
+        # the body of a car is between the lowest distance it is drawn at minus its size and the highest distance
+        with np.errstate(invalid="ignore"):
+            farthest = self.previous_state_distance + (self.state_distance - self.previous_state_distance) * MAX_RATIO
+        interpolated = self.state_time - self.previous_state_time > 0
+        lowest = np.where(interpolated, np.fmin(self.previous_state_distance, farthest), self.distance_taken)
+        highest = np.where(interpolated, np.fmax(self.previous_state_distance, farthest), self.distance_taken)
+        starts = lowest - self.size
+        self.rows_by_start = read_only(np.argsort(starts, kind="stable"))
+        self.sorted_starts = read_only(starts[self.rows_by_start])
+        self.longest_interval = float(np.max(highest - starts)) if len(self.ids) > 0 else 0.0
+
+    def __len__(self):
+        return len(self.ids)
+
+    @staticmethod
+    def of(cars: List[Car], taken_at: float, previous: "FrameSnapshot" = None,
+           appearance_of: Callable[[Car], tuple] = None, extras: Dict[str, object] = None,
+           state_of: Callable[[Car], Tuple[float, float]] = None) -> "FrameSnapshot":
+        """
+        :param previous: the snapshot before this one, the earlier states of the cars are taken from it
+        :param appearance_of: returns the immutable appearance of a car
+        :param state_of: returns the distance taken and the speed of a car, e.g. extrapolated to taken_at,
+        the current ones of the car by default
+        """
+        count = len(cars)
+        ids = tuple(car.id for car in cars)
+        state_time = np.fromiter((car.last_state_update for car in cars), dtype=np.float64, count=count)
+        state_distance = np.fromiter((car.reported_distance_taken for car in cars), dtype=np.float64, count=count)
+        previous_state_time = np.full(count, np.nan)
+        previous_state_distance = np.full(count, np.nan)
+        if previous is not None and count > 0:
+            previous_rows = np.fromiter((previous.row_of_id.get(car_id, -1) for car_id in ids), dtype=np.int64,
+                                        count=count)
+            known = np.nonzero(previous_rows >= 0)[0]
+            rows = previous_rows[known]
+            # a car without a new state message keeps its earlier state
+            changed = previous.state_time[rows] != state_time[known]
+            previous_state_time[known] = np.where(changed, previous.state_time[rows],
+                                                  previous.previous_state_time[rows])
+            previous_state_distance[known] = np.where(changed, previous.state_distance[rows],
+                                                      previous.previous_state_distance[rows])
+        if state_of is not None:
+            states = np.array([state_of(car) for car in cars], dtype=np.float64).reshape(-1, 2)
+            distance_taken, speed = states[:, 0], states[:, 1]
+        else:
+            distance_taken = np.fromiter((car.distance_taken for car in cars), dtype=np.float64, count=count)
+            speed = np.fromiter((car.speed for car in cars), dtype=np.float64, count=count)
+        return FrameSnapshot(taken_at, ids,
+                             np.fromiter((car.lane for car in cars), dtype=np.int8, count=count),
+                             distance_taken, speed,
+                             np.fromiter((car.specs.size for car in cars), dtype=np.float64, count=count),
+                             tuple(appearance_of(car) for car in cars) if appearance_of is not None else (),
+                             dict(extras or {}), state_time, state_distance,
+                             previous_state_time, previous_state_distance)
+
+    def distance_at(self, at: float, rows: np.ndarray = None) -> np.ndarray:
+        """
+        :param rows: the rows of the cars, all cars by default
+        :return: the distances interpolated between the last two states of the cars at the given time,
+        or extrapolated from them for a while after the last one,
+        the cars with a single state are at their distance in the snapshot
+        """
+        rows = slice(None) if rows is None else rows
+        previous_state_time = self.previous_state_time[rows]
+        previous_state_distance = self.previous_state_distance[rows]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            span = self.state_time[rows] - previous_state_time
+            interpolated = span > 0
+            ratio = np.clip((at - previous_state_time) / span, 0.0, MAX_RATIO)
+            distance = previous_state_distance + (self.state_distance[rows] - previous_state_distance) * ratio
+        return np.where(interpolated, distance, self.distance_taken[rows])
+
+    def rows_overlapping(self, start: float, end: float, at: float, lanes: Iterable[int] = None):
+        """
+        Finds the cars in O(log n + k) by bisection of the indexed interval starts, since a car can only overlap
+        the range if its interval starts at most the longest interval before start
+        :param lanes: the lanes to search in, all lanes by default
+        :return: the rows of the cars, whose body (distance - size, distance) overlaps (start, end) at the given time,
+        in the order of the snapshot, and their distances
+        """
+        first, last = np.searchsorted(self.sorted_starts, [start - self.longest_interval, end])
+        rows = np.sort(self.rows_by_start[first:last])
+        if lanes is not None:
+            rows = rows[np.isin(self.lane[rows], list(lanes))]
+        distance = self.distance_at(at, rows)
+        overlapping = (start < distance) & (distance - self.size[rows] < end)
+        return rows[overlapping], distance[overlapping]
+
+
+class SnapshotBuffer:
+    """
+    Double buffer of snapshots: the producer publishes a new snapshot while the consumers keep reading the one they
+    took. The snapshots are never modified, so swapping the reference under the lock is enough.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latest: FrameSnapshot or None = None
+
+    def publish(self, snapshot: FrameSnapshot):
+        with self.lock:
+            self.latest = snapshot
+
+    def take(self) -> FrameSnapshot or None:
+        with self.lock:
+            return self.latest
@@ -0,0 +1,311 @@
+import time
+import numpy as np
+from typing import Dict, List
+from car import Car, CarSpecs, CarManager, Lane, AccelerationState, effective_lanes, MAX_EXTRAPOLATION_SEC
+
+INITIAL_CAPACITY = 64
+
+# effective lane of every lane value, usable as a lookup table on a lane column
+effective_lane_table = np.array([lane.value for lane in effective_lanes], dtype=np.int8)
+
+
+class FleetColumns:
+    """
+    Struct of arrays holding the whole fleet, every car occupies the same index (slot) in each array
+    """
+    float_columns = ["distance_taken", "speed", "preferred_speed", "max_speed",
+                     "acceleration", "braking_power", "size", "last_state_update",
+                     "reported_distance_taken", "reported_speed"]
+    small_int_columns = ["lane", "acceleration_state"]
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.ids = np.empty(capacity, dtype=object)
+        self.active = np.zeros(capacity, dtype=bool)
+        for name in self.small_int_columns:
+            setattr(self, name, np.zeros(capacity, dtype=np.int8))
+        for name in self.float_columns:
+            setattr(self, name, np.zeros(capacity, dtype=np.float64))
+
+    def grow(self, capacity: int):
+        """
+        Reallocates every column with the new capacity, keeping the content of the existing slots
+        """
+        for name in ["ids", "active"] + self.small_int_columns + self.float_columns:
+            old_column = getattr(self, name)
+            new_column = np.zeros(capacity, dtype=old_column.dtype) if old_column.dtype != object \
+                else np.empty(capacity, dtype=object)
+            new_column[:self.capacity] = old_column
+            setattr(self, name, new_column)
+        self.capacity = capacity
+
+    def copy_slot(self, slot: int):
+        """
+        :return: new columns of capacity 1, containing only the given slot
+        """
+        single = FleetColumns(1)
+        for name in ["ids", "active"] + self.small_int_columns + self.float_columns:
+            getattr(single, name)[0] = getattr(self, name)[slot]
+        return single
+
+
+class CarSpecsView(CarSpecs):
+    """
+    CarSpecs reading and writing the columns of a fleet store instead of own attributes
+    """
+    def __init__(self, columns: FleetColumns, slot: int):
+        self._columns = columns
+        self._slot = slot
+
+    def _column_property(name):
+        return property(lambda self: float(getattr(self._columns, name)[self._slot]),
+                        lambda self, value: getattr(self._columns, name).__setitem__(self._slot, value))
+
+    preferred_speed = _column_property("preferred_speed")
+    max_speed = _column_property("max_speed")
+    acceleration = _column_property("acceleration")
+    braking_power = _column_property("braking_power")
+    size = _column_property("size")
+    del _column_property
+
+
+class CarView(Car):
+    """
+    Lightweight Car whose state lives in the columns of a ColumnarCarManager.
+    Only the bookkeeping of the controller (last command) is stored in the object itself.
+    """
+    def __init__(self, car_id: str, columns: FleetColumns, slot: int):
+        self.id: str = car_id
+        self._columns = columns
+        self._slot = slot
+        self.specs = CarSpecsView(columns, slot)
+        self.last_command = None
+        self.lane_when_last_command: Lane = self.lane
+
+    def _detach(self):
+        # the slot is going to be reused, so the view keeps a private copy of its last state
+        self._columns = self._columns.copy_slot(self._slot)
+        self._slot = 0
+        self.specs = CarSpecsView(self._columns, 0)
+
+    @property
+    def lane(self) -> Lane:
+        return Lane(int(self._columns.lane[self._slot]))
+
+    @lane.setter
+    def lane(self, value):
+        self._columns.lane[self._slot] = int(value)
+
+    @property
+    def distance_taken(self) -> float:
+        return float(self._columns.distance_taken[self._slot])
+
+    @distance_taken.setter
+    def distance_taken(self, value):
+        self._columns.distance_taken[self._slot] = value
+
+    @property
+    def speed(self) -> float:
+        return float(self._columns.speed[self._slot])
+
+    @speed.setter
+    def speed(self, value):
+        self._columns.speed[self._slot] = value
+
+    @property
+    def acceleration_state(self) -> AccelerationState:
+        return AccelerationState(int(self._columns.acceleration_state[self._slot]))
+
+    @acceleration_state.setter
+    def acceleration_state(self, value):
+        self._columns.acceleration_state[self._slot] = value.value if isinstance(value, AccelerationState) else value
+
+    @property
+    def last_state_update(self) -> float:
+        return float(self._columns.last_state_update[self._slot])
+
+    @last_state_update.setter
+    def last_state_update(self, value):
+        self._columns.last_state_update[self._slot] = value
+
+    @property
+    def reported_distance_taken(self) -> float:
+        return float(self._columns.reported_distance_taken[self._slot])
+
+    @reported_distance_taken.setter
+    def reported_distance_taken(self, value):
+        self._columns.reported_distance_taken[self._slot] = value
+
+    @property
+    def reported_speed(self) -> float:
+        return float(self._columns.reported_speed[self._slot])
+
+    @reported_speed.setter
+    def reported_speed(self, value):
+        self._columns.reported_speed[self._slot] = value
+
+
+class ColumnarCarManager(CarManager):
+    """
+    CarManager keeping the state and the specs of the cars in contiguous NumPy arrays.
+    The arrays double their capacity when they are full, and the slots of the departed cars are reused.
+    The values of the dictionary are CarView objects, so code written for Car objects keeps working.
+    Only the Car fields are kept from the inserted objects, subclasses (e.g. CarImage) lose their extra attributes.
+    """
+    def __init__(self, capacity: int = INITIAL_CAPACITY):
+        super().__init__()
+        self.columns = FleetColumns(capacity)
+        self.as_dict: Dict[str, CarView] = {}
+        self.views_by_slot: List[CarView or None] = [None] * capacity
+        self.free_slots: List[int] = []
+        # every slot above this index is unused
+        self.high_water = 0
+
+    def _allocate_slot(self) -> int:
+        if self.free_slots:
+            return self.free_slots.pop()
+        if self.high_water == self.columns.capacity:
+            self.columns.grow(2 * self.columns.capacity)
+            self.views_by_slot.extend([None] * (self.columns.capacity - len(self.views_by_slot)))
+        self.high_water += 1
+        return self.high_water - 1
+
+    def __setitem__(self, key, value: Car):
+        with self.lock:
+            view = self.as_dict.get(key)
+            slot = view._slot if view is not None else self._allocate_slot()
+            columns = self.columns
+            columns.ids[slot] = key
+            columns.active[slot] = True
+            columns.preferred_speed[slot] = value.specs.preferred_speed
+            columns.max_speed[slot] = value.specs.max_speed
+            columns.acceleration[slot] = value.specs.acceleration
+            columns.braking_power[slot] = value.specs.braking_power
+            columns.size[slot] = value.specs.size
+            columns.lane[slot] = int(value.lane)
+            columns.distance_taken[slot] = value.distance_taken
+            columns.speed[slot] = value.speed
+            columns.acceleration_state[slot] = AccelerationState(value.acceleration_state).value
+            columns.last_state_update[slot] = value.last_state_update
+            columns.reported_distance_taken[slot] = value.reported_distance_taken
+            columns.reported_speed[slot] = value.reported_speed
+            view = CarView(key, columns, slot)
+            view.last_command = value.last_command
+            view.lane_when_last_command = value.lane_when_last_command
+            self.as_dict[key] = view
+            self.views_by_slot[slot] = view
+
+    def update_car(self, car_id, state):
+        with self.lock:
+            slot = self.as_dict[car_id]._slot
+            columns = self.columns
+            columns.lane[slot] = int(state[0])
+            columns.distance_taken[slot] = state[1]
+            columns.speed[slot] = state[2]
+            columns.acceleration_state[slot] = int(state[3])
+            columns.reported_distance_taken[slot] = state[1]
+            columns.reported_speed[slot] = state[2]
+            columns.last_state_update[slot] = time.time()
+
+    def pop(self, key, default_value=None):
+        with self.lock:
+            view = self.as_dict.pop(key, None)
+            if view is None:
+                return default_value
+            slot = view._slot
+            view._detach()
+            self.columns.active[slot] = False
+            self.columns.ids[slot] = None
+            self.views_by_slot[slot] = None
+            self.free_slots.append(slot)
+            return view
+
+    def extrapolate(self, at: float, max_elapsed_sec=MAX_EXTRAPOLATION_SEC):
+        """
+        Vectorized CarManager.extrapolate, same as Car.extrapolated_state for every car
+        """
+        with self.lock:
+            slots = self.active_slots()
+            columns = self.columns
+            elapsed = np.clip(at - columns.last_state_update[slots], 0.0, max_elapsed_sec)
+            distance = columns.reported_distance_taken[slots]
+            speed = columns.reported_speed[slots]
+            acceleration = columns.acceleration[slots]
+            braking_power = columns.braking_power[slots]
+            accelerating = columns.acceleration_state[slots] == AccelerationState.ACCELERATING.value
+            braking = columns.acceleration_state[slots] == AccelerationState.BRAKING.value
+            top_speed = np.maximum(np.where(columns.lane[slots] == Lane.EXPRESS_LANE,
+                                            columns.max_speed[slots], columns.preferred_speed[slots]), speed)
+            # the time spent accelerating or braking until reaching the top speed or stopping
+            changing_sec = np.where(accelerating, np.minimum(elapsed, (top_speed - speed) / acceleration),
+                                    np.where(braking, np.minimum(elapsed, speed / braking_power), 0.0))
+            new_speed = speed + np.where(accelerating, acceleration, np.where(braking, -braking_power, 0.0)) \
+                * changing_sec
+            columns.distance_taken[slots] = distance + (speed + new_speed) / 2 * changing_sec \
+                + new_speed * (elapsed - changing_sec)
+            columns.speed[slots] = new_speed
+
+    def active_slots(self) -> np.ndarray:
+        """
+        :return: indexes of the occupied slots in increasing order
+        """
+        return np.flatnonzero(self.columns.active[:self.high_water])
+
+    def snapshot(self):
+        """
+        :return: copy of the current state of the fleet, ordered by distance taken
+        """
+        with self.lock:
+            slots = self.active_slots()
+            columns = self.columns
+            return FleetSnapshot([self.views_by_slot[slot] for slot in slots],
+                                 columns.lane[slots], columns.distance_taken[slots], columns.speed[slots],
+                                 columns.acceleration_state[slots], columns.preferred_speed[slots],
+                                 columns.max_speed[slots], columns.acceleration[slots],
+                                 columns.braking_power[slots], columns.size[slots])
+
+
+class FleetSnapshot:
+    """
+    Immutable copy of the fleet for vectorized processing. Index i of every array belongs to cars[i],
+    and the cars are ordered by distance taken, cars with equal distance keep their original order.
+    """
+    def __init__(self, cars: List[Car], lane, distance_taken, speed, acceleration_state,
+                 preferred_speed, max_speed, acceleration, braking_power, size):
+        order = np.argsort(distance_taken, kind="stable")
+        self.cars: List[Car] = [cars[i] for i in order]
+        self.lane: np.ndarray = np.asarray(lane, dtype=np.int8)[order]
+        self.effective_lane: np.ndarray = effective_lane_table[self.lane]
+        self.distance_taken: np.ndarray = np.asarray(distance_taken, dtype=np.float64)[order]
+        self.speed: np.ndarray = np.asarray(speed, dtype=np.float64)[order]
+        self.acceleration_state: np.ndarray = np.asarray(acceleration_state, dtype=np.int8)[order]
+        self.preferred_speed: np.ndarray = np.asarray(preferred_speed, dtype=np.float64)[order]
+        self.max_speed: np.ndarray = np.asarray(max_speed, dtype=np.float64)[order]
+        self.acceleration: np.ndarray = np.asarray(acceleration, dtype=np.float64)[order]
+        self.braking_power: np.ndarray = np.asarray(braking_power, dtype=np.float64)[order]
+        self.size: np.ndarray = np.asarray(size, dtype=np.float64)[order]
+
+    def __len__(self):
+        return len(self.cars)
+
+    @classmethod
+    def from_cars(cls, cars: List[Car]):
+        return cls(cars,
+                   [int(c.lane) for c in cars],
+                   [c.distance_taken for c in cars],
+                   [c.speed for c in cars],
+                   [AccelerationState(c.acceleration_state).value for c in cars],
+                   [c.specs.preferred_speed for c in cars],
+                   [c.specs.max_speed for c in cars],
+                   [c.specs.acceleration for c in cars],
+                   [c.specs.braking_power for c in cars],
+                   [c.specs.size for c in cars])
+
+    @classmethod
+    def of(cls, car_manager: CarManager):
+        """
+        Columnar managers are copied column by column, any other manager car by car
+        """
+        if isinstance(car_manager, ColumnarCarManager):
+            return car_manager.snapshot()
+        return cls.from_cars(car_manager.get_all())
@@ -0,0 +1,168 @@
+import os
+import numpy as np
+from typing import Dict, List, Sequence, Tuple
+from car import Car, CarSpecs, AccelerationState, Command
+
+
+class FleetTimeline:
+    """
+    Recorded states of a fleet, a row for every state of a car, ordered by the car and the time,
+    so the states of a car are a contiguous range of rows, see car_rows.
+    The cars are the indexes of ids and of the car columns, terminated_at is nan for the cars, which were not terminated,
+    and the specs are nan for the cars, whose join message was not recorded.
+    The commands sent to the cars are kept in the command columns, ordered by the time.
+    """
+    state_columns = {"car": np.int32, "time": np.float64, "lane": np.int8, "distance_taken": np.float64,
+                     "speed": np.float64, "acceleration_state": np.int8}
+    car_columns = {"size": np.float64, "terminated_at": np.float64, "preferred_speed": np.float64,
+                   "max_speed": np.float64, "acceleration": np.float64, "braking_power": np.float64}
+    command_columns = {"command_car": np.int32, "command_time": np.float64, "command": np.int8}
+
+    def __init__(self, ids: Sequence[str], columns: Dict[str, np.ndarray], ordered=False):
+        """
+        :param columns: the columns by name, the missing ones are filled with zeros or nan
+        :param ordered: the rows are already ordered, e.g. the columns were saved by a timeline, so they are not copied
+        """
+        self.ids = list(ids)
+        state_count = len(columns["time"])
+        for name, dtype in self.state_columns.items():
+            setattr(self, name, np.asarray(columns[name], dtype=dtype) if name in columns
+                    else np.zeros(state_count, dtype=dtype))
+        for name, dtype in self.car_columns.items():
+            setattr(self, name, np.asarray(columns[name], dtype=dtype) if name in columns
+                    else np.full(len(self.ids), np.nan))
+        for name, dtype in self.command_columns.items():
+            setattr(self, name, np.asarray(columns.get(name, np.zeros(0)), dtype=dtype))
+        if not ordered:
+            order = np.lexsort((self.time, self.car))
+            for name in self.state_columns:
+                setattr(self, name, getattr(self, name)[order])
+            order = np.argsort(self.command_time, kind="stable")
+            for name in self.command_columns:
+                setattr(self, name, getattr(self, name)[order])
+        # the rows of car i are car_rows[i]: car_rows[i + 1]
+        self.car_rows = np.searchsorted(self.car, np.arange(len(self.ids) + 1))
+        self.start = float(self.time.min()) if len(self.time) > 0 else 0.0
+        self.end = float(self.time.max()) if len(self.time) > 0 else 0.0
+        # the times shifted by car, so the states of every car can be searched at once in a single sorted array
+        self.stride = self.end - self.start + 1.0
+        self.search_keys = self.car * self.stride + (self.time - self.start)
+
+    def __len__(self):
+        return len(self.time)
+
+    def states_at(self, at: float, linger_sec=0.0) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        :param linger_sec: a car is present this long after its last state
+        :return: the cars present at the given time, the row of their last state at the time,
+        and the row of their next state, which is the same row for the cars after their last state
+        """
+        has_states = self.car_rows[1:] > self.car_rows[:-1]
+        cars = np.flatnonzero(has_states)
+        # kept within the stride, so the search does not reach the states of the next car
+        elapsed = min(max(at - self.start, -0.5), self.stride - 0.5)
+        last = np.searchsorted(self.search_keys, cars * self.stride + elapsed, side="right") - 1
+        first_row, end_row = self.car_rows[cars], self.car_rows[cars + 1]
+        present = (last >= first_row) & (at <= self.time[end_row - 1] + linger_sec)
+        cars, last, end_row = cars[present], last[present], end_row[present]
+        return cars, last, np.minimum(last + 1, end_row - 1)
+
+    def columns(self) -> Dict[str, np.ndarray]:
+        return {name: getattr(self, name)
+                for name in list(self.state_columns) + list(self.car_columns) + list(self.command_columns)}
+
+    def save(self, path: str):
+        """
+        Saves the timeline to a compressed .npz file, or to a directory of .npy files, if path is not an .npz file.
+        The .npy files can be memory-mapped by load.
+        """
+        if path.endswith(".npz"):
+            np.savez_compressed(path, ids=np.array(self.ids, dtype=str), **self.columns())
+            return
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "ids.npy"), np.array(self.ids, dtype=str))
+        for name, column in self.columns().items():
+            np.save(os.path.join(path, name + ".npy"), column)
+
+    @staticmethod
+    def load(path: str) -> "FleetTimeline":
+        """
+        :param path: .npz file or directory of .npy files saved by save, the .npy files are memory-mapped
+        """
+        if os.path.isdir(path):
+            columns = {name[:-len(".npy")]: np.load(os.path.join(path, name), mmap_mode="r")
+                       for name in os.listdir(path) if name.endswith(".npy")}
+            return FleetTimeline(columns.pop("ids").tolist(), columns, ordered=True)
+        with np.load(path) as saved:
+            columns = {name: saved[name] for name in saved.files}
+        return FleetTimeline(columns.pop("ids").tolist(), columns, ordered=True)
+
+
+class TimelineRecorder:
+    """
+    Collects the states of a fleet into a FleetTimeline. The states are appended as arrays per call,
+    so recording a tick of a large fleet costs a few array copies.
+    """
+    def __init__(self):
+        self.ids: List[str] = []
+        self.index_of_id: Dict[str, int] = {}
+        self.sizes: List[float] = []
+        self.terminated_at: Dict[int, float] = {}
+        self.specs: Dict[int, CarSpecs] = {}
+        self.commands: List[Tuple[int, float, int]] = []
+        self.chunks: List[Tuple[np.ndarray, ...]] = []
+
+    def index_of(self, car_id: str, size: float) -> int:
+        index = self.index_of_id.get(car_id)
+        if index is None:
+            index = self.index_of_id[car_id] = len(self.ids)
+            self.ids.append(car_id)
+            self.sizes.append(size)
+        return index
+
+    def record(self, ids: Sequence[str], size: Sequence[float], lane, distance_taken, speed, acceleration_state,
+               at: float):
+        """
+        Records the states of the given cars at the given time, the arguments are columns with a row for every car
+        """
+        car = np.fromiter((self.index_of(car_id, car_size) for car_id, car_size in zip(ids, size)), dtype=np.int32,
+                          count=len(ids))
+        self.chunks.append((car, np.full(len(ids), at), np.array(lane, dtype=np.int8),
+                            np.array(distance_taken, dtype=np.float64), np.array(speed, dtype=np.float64),
+                            np.array(acceleration_state, dtype=np.int8)))
+
+    def record_cars(self, cars: List[Car], at: float):
+        self.record([car.id for car in cars], [car.specs.size for car in cars], [int(car.lane) for car in cars],
+                    [car.distance_taken for car in cars], [car.speed for car in cars],
+                    [AccelerationState(car.acceleration_state).value for car in cars], at)
+
+    def set_specs(self, car_id: str, specs: CarSpecs):
+        self.specs[self.index_of(car_id, specs.size)] = specs
+
+    def command(self, car_id: str, command: Command, at: float):
+        index = self.index_of_id.get(car_id)
+        if index is not None:
+            self.commands.append((index, at, int(command.value)))
+
+    def terminate(self, car_id: str, at: float):
+        index = self.index_of_id.get(car_id)
+        if index is not None:
+            self.terminated_at.setdefault(index, at)
+
+    def timeline(self) -> FleetTimeline:
+        terminated_at = np.full(len(self.ids), np.nan)
+        for index, at in self.terminated_at.items():
+            terminated_at[index] = at
+        names = ["car", "time", "lane", "distance_taken", "speed", "acceleration_state"]
+        chunks = self.chunks or [tuple(np.zeros(0) for _ in names)]
+        columns = {name: np.concatenate(column) for name, column in zip(names, zip(*chunks))}
+        columns["size"] = np.array(self.sizes)
+        columns["terminated_at"] = terminated_at
+        for name in ["preferred_speed", "max_speed", "acceleration", "braking_power"]:
+            columns[name] = np.full(len(self.ids), np.nan)
+            for index, specs in self.specs.items():
+                columns[name][index] = getattr(specs, name)
+        for name, values in zip(["command_car", "command_time", "command"], zip(*self.commands) if self.commands
+                                else [(), (), ()]):
+            columns[name] = np.array(values)
+        return FleetTimeline(self.ids, columns)
@@ -7,7 +7,7 @@ import pathlib
 import zipfile
 import datetime
 import subprocess
-from car import CarSpecs
+from car import Car, CarSpecs
 from typing import List, Tuple
 from HTCSPythonUtil import config
 
@@ -89,16 +89,36 @@ class GraveDigger:
             _process.terminate()
 
 
-def generate_random_specs():
-    pref_speed: float = random.random() * PREF_SPEED_INTERVAL_WIDTH + PREF_SPEED_INTERVAL_MIN
-    max_speed: float = max(pref_speed, random.random() * MAX_SPEED_INTERVAL_WIDTH + MAX_SPEED_INTERVAL_MIN)
-    acceleration: float = random.random() * ACCELERATION_INTERVAL_WIDTH + ACCELERATION_INTERVAL_MIN
-    brake: float = random.random() * BRAKING_POWER_INTERVAL_WIDTH + BRAKING_POWER_INTERVAL_MIN
-    size: float = random.random() * SIZE_INTERVAL_WIDTH + SIZE_INTERVAL_MIN
+def generate_random_specs(rng=random):
+    pref_speed: float = rng.random() * PREF_SPEED_INTERVAL_WIDTH + PREF_SPEED_INTERVAL_MIN
+    max_speed: float = max(pref_speed, rng.random() * MAX_SPEED_INTERVAL_WIDTH + MAX_SPEED_INTERVAL_MIN)
+    acceleration: float = rng.random() * ACCELERATION_INTERVAL_WIDTH + ACCELERATION_INTERVAL_MIN
+    brake: float = rng.random() * BRAKING_POWER_INTERVAL_WIDTH + BRAKING_POWER_INTERVAL_MIN
+    size: float = rng.random() * SIZE_INTERVAL_WIDTH + SIZE_INTERVAL_MIN
     # input has to be a tuple
     return CarSpecs((pref_speed, max_speed, acceleration, brake, size))
 
 
+def generate_random_cars(count: int, seed=None, road_length=config["position_bound"]) -> List[Car]:
+    """
+    Generates cars spread along the road, without any vehicle process, for simulations and benchmarks.
+    The specs are converted to SI units the same way as the vehicle does it, see initializeState in
+    htcs-vehicle/src/state.c, so they look like the specs arriving in join messages.
+    :param seed: the same seed always generates the same cars
+    """
+    rng = random.Random(seed)
+    cars = []
+    for i in range(count):
+        raw = generate_random_specs(rng)
+        specs = CarSpecs((raw.preferred_speed / 3.6, raw.max_speed / 3.6, 1 / (0.036 * raw.acceleration),
+                          1 / (0.036 * raw.braking_power), raw.size))
+        lane = rng.choice([0, 0, 1, 2, 2, 2, 3, 4, 5, 5])
+        speed = specs.preferred_speed * (rng.random() * 0.6 + 0.5)
+        state = (lane, rng.random() * road_length, speed, rng.randint(0, 2))
+        cars.append(Car(str(i), specs, state))
+    return cars
+
+
 def generate_params_string(current_id):
     specs = generate_random_specs()
     entry_dist = 0
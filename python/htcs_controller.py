@@ -1,9 +1,16 @@
 import time
+import asyncio
 import logging
 import threading
+import numpy as np
+import metrics
 import mqtt_connector
+import batch_controller
+import async_mqtt_connector
+from sharded_controller import ShardedController
 from HTCSPythonUtil import config
-from car import Car, DetailedCarTracker, Lane, AccelerationState, Command
+from fleet_store import ColumnarCarManager, FleetSnapshot
+from car import Car, DetailedCarTracker, IncrementalCarTracker, Lane, AccelerationState, Command, MAX_EXTRAPOLATION_SEC
 
 
 logger = logging.getLogger(__name__)
@@ -11,6 +18,33 @@ logger = logging.getLogger(__name__)
 
 lock = threading.Lock()
 INTERVAL_MS = 100
+# decide for the whole fleet at once with batch_controller instead of car by car
+BATCH_CONTROL = bool(config.get("batch_control"))
+# if positive, the road is split into this many segments, decided by the batch controller in parallel processes
+CONTROLLER_WORKERS = config.get("controller_workers") or 0
+sharded_controller: ShardedController or None = None
+# only evaluate the cars marked dirty by IncrementalCarTracker, and every car in every FULL_SWEEP_TICKS-th iteration
+INCREMENTAL_CONTROL = bool(config.get("incremental_control"))
+FULL_SWEEP_TICKS = config.get("full_sweep_ticks") or 50
+tick_count = 0
+# estimate the current state of the cars from their last state message before deciding, see Car.extrapolated_state
+DEAD_RECKONING = bool(config.get("dead_reckoning"))
+MAX_EXTRAPOLATION_SEC = config.get("max_extrapolation_sec") or MAX_EXTRAPOLATION_SEC
+
+tick_seconds = metrics.histogram("controller_tick_seconds", "Duration of the control iterations")
+tick_budget_ratio = metrics.gauge("controller_tick_budget_ratio",
+                                  "Duration of the last control iteration divided by its interval")
+# in the car by car mode the commands are given during the decide phase
+phase_seconds = {phase: metrics.histogram("controller_phase_seconds",
+                                          "Duration of the phases of the control iterations", phase=phase)
+                 for phase in ["drain", "extrapolate", "snapshot", "decide", "command"]}
+publish_seconds = metrics.histogram("controller_publish_seconds", "Duration of publishing a command")
+commands_sent = {command: metrics.counter("controller_commands_total", "Commands sent to the cars",
+                                          command=command.name)
+                 for command in Command}
+evaluated_cars = metrics.gauge("controller_evaluated_cars", "Number of cars evaluated in the last iteration")
+unnecessary_commands = metrics.counter("controller_unnecessary_commands_total",
+                                       "Commands not sent, because the car is already doing it")
 
 
 def give_command(car: Car, command: Command):
@@ -20,10 +54,13 @@ def give_command(car: Car, command: Command):
     # Maybe not good logic if car gets several commands in one iteration
     if unnecessary_command(car, command):
         logger.debug(f"Unnecessary command {command} for {car}")
+        unnecessary_commands.inc()
         return
     topic = config["base_topic"] + "/" + str(car.id) + "/command"
     logger.debug(f"{command.name} sent to car with id {car.id}")
-    mqtt_connector.client_1.publish(topic, command.value, config["quality_of_service"])
+    with publish_seconds.time():
+        mqtt_connector.client_1.publish(topic, command.value, config["quality_of_service"])
+    commands_sent[command].inc()
     car.last_command = command
     car.lane_when_last_command = car.lane
 
@@ -38,35 +75,62 @@ def control_traffic():
     #logger.error("iteration start")
     # for car in local_cars.get_all():
     #     logger.warning(f"car id = {car.id} distance = {car.distance_taken}, lane = {car.lane}")
-    for car in local_cars.get_all():
-        # in the traffic lane we slow down if we are over our preferred speed. in this case, we also do nothing else
-        if car.speed > car.specs.preferred_speed * 1.05 and car.effective_lane() == Lane.TRAFFIC_LANE:
-            give_command(car, Command.BRAKE)
-            continue
+    with phase_seconds["snapshot"].time():
+        cars = local_cars.get_all()
+    with phase_seconds["decide"].time():
+        for car in cars:
+            control_car(car)
+    evaluated_cars.set(len(cars))
 
-        # try to get back to traffic lane
-        if car.lane == Lane.EXPRESS_LANE and local_cars.can_return_to_traffic_lane(car):
-            give_command(car, Command.CHANGE_LANE)
-        # try to get into traffic lane
-        elif car.lane == Lane.MERGE_LANE and local_cars.can_merge_in(car):
-            give_command(car, Command.CHANGE_LANE)
 
-        # if we are too close to the one ahead us
-        car_directly_ahead = local_cars.car_directly_ahead_in_effective_lane(car, car.effective_lane())
-        if car_directly_ahead is not None \
-                and car_directly_ahead.distance_taken - car.distance_taken < 1 * car.follow_distance(safety_factor=1.2):
-            decide_brake_or_overtake(car, car_directly_ahead)
-        # if we aren't too close we accelerate if we are far enough, otherwise try to overtake
-        # this is needed, so cars do not get stuck behind each other, and also, who has already switched lanes,
-        # into express, should accelerate
-        elif car.speed < car.specs.preferred_speed:
-            if car.acceleration_state != AccelerationState.ACCELERATING \
-                    and (car_directly_ahead is None
-                         or car_directly_ahead.distance_taken - car.distance_taken > car.follow_distance(safety_factor=2)
-                         or car_directly_ahead.speed > car.specs.preferred_speed):
-                give_command(car, Command.ACCELERATE)
-        elif car.lane == Lane.EXPRESS_LANE and car.speed < car.specs.max_speed:
+def control_traffic_incremental():
+    global tick_count
+    with phase_seconds["snapshot"].time():
+        if tick_count % FULL_SWEEP_TICKS == 0:
+            # safety sweep, in case a change was missed
+            local_cars.take_dirty()
+            cars = local_cars.get_all()
+        else:
+            cars = local_cars.take_dirty()
+    tick_count += 1
+    lookahead_sec = FULL_SWEEP_TICKS * INTERVAL_MS / 1000
+    with phase_seconds["decide"].time():
+        for car in cars:
+            control_car(car)
+            if not local_cars.is_steady(car, lookahead_sec):
+                local_cars.mark_dirty(car)
+    evaluated_cars.set(len(cars))
+
+
+def control_car(car: Car):
+    # in the traffic lane we slow down if we are over our preferred speed. in this case, we also do nothing else
+    if car.speed > car.specs.preferred_speed * 1.05 and car.effective_lane() == Lane.TRAFFIC_LANE:
+        give_command(car, Command.BRAKE)
+        return
+
+    # try to get back to traffic lane
+    if car.lane == Lane.EXPRESS_LANE and local_cars.can_return_to_traffic_lane(car):
+        give_command(car, Command.CHANGE_LANE)
+    # try to get into traffic lane
+    elif car.lane == Lane.MERGE_LANE and local_cars.can_merge_in(car):
+        give_command(car, Command.CHANGE_LANE)
+
+    # if we are too close to the one ahead us
+    car_directly_ahead = local_cars.car_directly_ahead_in_effective_lane(car, car.effective_lane())
+    if car_directly_ahead is not None \
+            and car_directly_ahead.distance_taken - car.distance_taken < 1 * car.follow_distance(safety_factor=1.2):
+        decide_brake_or_overtake(car, car_directly_ahead)
+    # if we aren't too close we accelerate if we are far enough, otherwise try to overtake
+    # this is needed, so cars do not get stuck behind each other, and also, who has already switched lanes,
+    # into express, should accelerate
+    elif car.speed < car.specs.preferred_speed:
+        if car.acceleration_state != AccelerationState.ACCELERATING \
+                and (car_directly_ahead is None
+                     or car_directly_ahead.distance_taken - car.distance_taken > car.follow_distance(safety_factor=2)
+                     or car_directly_ahead.speed > car.specs.preferred_speed):
             give_command(car, Command.ACCELERATE)
+    elif car.lane == Lane.EXPRESS_LANE and car.speed < car.specs.max_speed:
+        give_command(car, Command.ACCELERATE)
 
 
 def decide_brake_or_overtake(car: Car, car_ahead: Car):
@@ -91,17 +155,71 @@ def decide_brake_or_overtake(car: Car, car_ahead: Car):
             give_command(car, Command.BRAKE)
 
 
-if __name__ == "__main__":
-    local_cars = DetailedCarTracker()
-    mqtt_connector.setup_connector(local_cars)
-    time.sleep(1)
-    interval_sec = INTERVAL_MS / 1000
-    while True:
-        time_start = time.time()
+def control_traffic_batch(decide_commands=batch_controller.decide_commands):
+    with phase_seconds["snapshot"].time():
+        snapshot = FleetSnapshot.of(local_cars)
+    with phase_seconds["decide"].time():
+        lane_commands, speed_commands = decide_commands(snapshot)
+    with phase_seconds["command"].time():
+        # the commands are given in the same order as control_traffic would give them
+        for index in np.flatnonzero((lane_commands != batch_controller.NO_COMMAND)
+                                    | (speed_commands != batch_controller.NO_COMMAND)):
+            car = snapshot.cars[index]
+            if lane_commands[index] != batch_controller.NO_COMMAND:
+                give_command(car, batch_controller.command_of_code[lane_commands[index]])
+            if speed_commands[index] != batch_controller.NO_COMMAND:
+                give_command(car, batch_controller.command_of_code[speed_commands[index]])
+
+
+def control_tick():
+    time_start = time.perf_counter()
+    with phase_seconds["drain"].time():
+        mqtt_connector.drain_mailbox()
+    if DEAD_RECKONING:
+        with phase_seconds["extrapolate"].time():
+            local_cars.extrapolate(time.time(), MAX_EXTRAPOLATION_SEC)
+    if sharded_controller is not None:
+        control_traffic_batch(sharded_controller.decide_commands)
+    elif BATCH_CONTROL:
+        control_traffic_batch()
+    elif INCREMENTAL_CONTROL:
+        control_traffic_incremental()
+    else:
         control_traffic()
-        logger.debug(f"controlling took {time.time() - time_start} seconds")
-        remaining_sec = time_start + interval_sec - time.time()
-        if remaining_sec <= 0:
-            logger.warning("Controller is feeling overloaded, it has no time to sleep! :(")
-        else:
-            time.sleep(remaining_sec)
+    elapsed_sec = time.perf_counter() - time_start
+    tick_seconds.record(elapsed_sec)
+    tick_budget_ratio.set(elapsed_sec / (INTERVAL_MS / 1000))
+
+
+async def run_async():
+    await async_mqtt_connector.setup_connector(local_cars)
+    await asyncio.sleep(1)
+    await async_mqtt_connector.run_periodically(control_tick, INTERVAL_MS / 1000,
+                                                "Controller is feeling overloaded, it has no time to sleep! :(")
+
+
+if __name__ == "__main__":
+    if BATCH_CONTROL or CONTROLLER_WORKERS > 0:
+        local_cars = ColumnarCarManager()
+    elif INCREMENTAL_CONTROL:
+        local_cars = IncrementalCarTracker()
+    else:
+        local_cars = DetailedCarTracker()
+    metrics.start_exporter("controller")
+    if CONTROLLER_WORKERS > 0:
+        sharded_controller = ShardedController(CONTROLLER_WORKERS)
+    if config.get("asyncio_connector"):
+        asyncio.run(run_async())
+    else:
+        mqtt_connector.setup_connector(local_cars)
+        time.sleep(1)
+        interval_sec = INTERVAL_MS / 1000
+        while True:
+            time_start = time.time()
+            control_tick()
+            logger.debug(f"controlling ({'batch' if BATCH_CONTROL else 'scalar'}) took {time.time() - time_start} seconds")
+            remaining_sec = time_start + interval_sec - time.time()
+            if remaining_sec <= 0:
+                logger.warning("Controller is feeling overloaded, it has no time to sleep! :(")
+            else:
+                time.sleep(remaining_sec)
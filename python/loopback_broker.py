@@ -0,0 +1,369 @@
+import re
+import time
+import queue
+import logging
+import threading
+import paho.mqtt.client as mqtt
+from typing import Callable, Dict, Pattern, Tuple
+
+logger = logging.getLogger("Loopback_Broker")
+
+
+def compile_filter(topic_filter: str) -> Pattern:
+    """
+    :return: a regular expression matching the same topics as the filter with the + and # wildcards,
+    see mqtt.topic_matches_sub
+    """
+    if topic_filter == '#':
+        return re.compile(".*", re.DOTALL)
+    pattern = re.escape(topic_filter).replace(r"\+", "[^/]*")
+    if pattern.endswith("/\\#"):
+        # the parent level itself is matched as well
+        pattern = pattern[:-len("/\\#")] + "(/.*)?"
+    return re.compile(pattern, re.DOTALL)
+
+
+def remove_subscriber(subscriptions: Dict[str, Dict["LoopbackClient", int]], topic_filter: str,
+                      client: "LoopbackClient"):
+    subscribers = subscriptions.get(topic_filter)
+    if subscribers is not None:
+        subscribers.pop(client, None)
+        if not subscribers:
+            del subscriptions[topic_filter]
+
+
+class LoopbackBroker:
+    """
+    In-process MQTT broker for the LoopbackClients, without any network traffic.
+    It supports the + and # wildcards, retained messages, and acknowledges the subscribes, unsubscribes and
+    publishes of every QoS level, so the callbacks of mqtt_connector are called the same way as with a real broker.
+    Every client gets at most one copy of a message, with the highest QoS of its matching subscriptions.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # subscriptions without wildcards are looked up by their topic
+        self.exact_subscriptions: Dict[str, Dict["LoopbackClient", int]] = {}
+        self.wildcard_subscriptions: Dict[str, Dict["LoopbackClient", int]] = {}
+        self.wildcard_patterns: Dict[str, Pattern] = {}
+        self.retained: Dict[str, mqtt.MQTTMessage] = {}
+        self.published_count = 0
+        self.delivered_count = 0
+
+    def subscribe(self, client: "LoopbackClient", topic_filter: str, qos: int):
+        with self.lock:
+            if '+' in topic_filter or '#' in topic_filter:
+                subscriptions = self.wildcard_subscriptions
+                self.wildcard_patterns[topic_filter] = compile_filter(topic_filter)
+            else:
+                subscriptions = self.exact_subscriptions
+            subscriptions.setdefault(topic_filter, {})[client] = qos
+            if subscriptions is self.exact_subscriptions:
+                retained = [self.retained[topic_filter]] if topic_filter in self.retained else []
+            else:
+                pattern = self.wildcard_patterns[topic_filter]
+                retained = [message for topic, message in self.retained.items() if pattern.fullmatch(topic)]
+        for message in retained:
+            client.deliver(message, min(qos, message.qos))
+
+    def unsubscribe(self, client: "LoopbackClient", topic_filter: str):
+        with self.lock:
+            for subscriptions in (self.exact_subscriptions, self.wildcard_subscriptions):
+                remove_subscriber(subscriptions, topic_filter, client)
+
+    def disconnect(self, client: "LoopbackClient"):
+        with self.lock:
+            for subscriptions in (self.exact_subscriptions, self.wildcard_subscriptions):
+                for topic_filter in [f for f, subscribers in subscriptions.items() if client in subscribers]:
+                    remove_subscriber(subscriptions, topic_filter, client)
+
+    def publish(self, topic: str, payload: bytes, qos: int, retain: bool):
+        message = mqtt.MQTTMessage(topic=topic.encode("utf-8"))
+        message.payload = payload
+        message.qos = qos
+        receivers: Dict[LoopbackClient, int] = {}
+        with self.lock:
+            self.published_count += 1
+            if retain:
+                # an empty retained message clears the retained message of the topic
+                if payload:
+                    retained = mqtt.MQTTMessage(topic=message._topic)
+                    retained.payload = payload
+                    retained.qos = qos
+                    retained.retain = True
+                    self.retained[topic] = retained
+                else:
+                    self.retained.pop(topic, None)
+            for client, sub_qos in self.exact_subscriptions.get(topic, {}).items():
+                receivers[client] = sub_qos
+            for topic_filter, subscribers in self.wildcard_subscriptions.items():
+                if self.wildcard_patterns[topic_filter].fullmatch(topic):
+                    for client, sub_qos in subscribers.items():
+                        receivers[client] = max(sub_qos, receivers.get(client, 0))
+            self.delivered_count += len(receivers)
+        for client, sub_qos in receivers.items():
+            client.deliver(message, min(qos, sub_qos))
+
+
+# the broker of the clients, which are created without one
+default_broker = LoopbackBroker()
+
+
+class LoopbackClient:
+    """
+    Stand-in for mqtt.Client (paho-mqtt 1.x), connected to a LoopbackBroker instead of a real one.
+    Like with paho, the callbacks run on the client's own thread started by loop_start, or in the calls of loop.
+    Only the parts of the paho API used by the modules are implemented.
+    """
+    def __init__(self, client_id="", broker: LoopbackBroker = None):
+        self._client_id = client_id
+        self.broker = broker or default_broker
+        self._userdata = None
+        self.inbox = queue.SimpleQueue()
+        self.thread = None
+        self.last_mid = 0
+        self.mid_lock = threading.Lock()
+        self.message_callbacks: Dict[str, Tuple[Pattern, Callable]] = {}
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_message = None
+        self.on_publish = None
+        self.on_subscribe = None
+        self.on_unsubscribe = None
+
+    def __repr__(self):
+        return f"LoopbackClient({self._client_id})"
+
+    def next_mid(self) -> int:
+        with self.mid_lock:
+            self.last_mid = self.last_mid % 65535 + 1
+            return self.last_mid
+
+    def user_data_set(self, userdata):
+        self._userdata = userdata
+
+    def username_pw_set(self, username, password=None):
+        pass
+
+    def connect(self, host="", port=1883, keepalive=60):
+        self.inbox.put((self.call_on_connect, ()))
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def disconnect(self):
+        self.broker.disconnect(self)
+        self.inbox.put((self.call_on_disconnect, ()))
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def message_callback_add(self, sub: str, callback: Callable):
+        self.message_callbacks[sub] = (compile_filter(sub), callback)
+
+    def message_callback_remove(self, sub: str):
+        self.message_callbacks.pop(sub, None)
+
+    def subscribe(self, topic: str, qos=0) -> Tuple[int, int]:
+        mid = self.next_mid()
+        # the retained messages follow the acknowledgement
+        self.inbox.put((self.call_on_subscribe, (mid, (qos,))))
+        self.broker.subscribe(self, topic, qos)
+        return mqtt.MQTT_ERR_SUCCESS, mid
+
+    def unsubscribe(self, topic: str) -> Tuple[int, int]:
+        mid = self.next_mid()
+        self.broker.unsubscribe(self, topic)
+        # the messages received before the unsubscribe are handled before its acknowledgement
+        self.inbox.put((self.call_on_unsubscribe, (mid,)))
+        return mqtt.MQTT_ERR_SUCCESS, mid
+
+    def publish(self, topic: str, payload=None, qos=0, retain=False) -> mqtt.MQTTMessageInfo:
+        if payload is None:
+            payload = b""
+        elif isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        elif isinstance(payload, (int, float)):
+            payload = str(payload).encode("ascii")
+        info = mqtt.MQTTMessageInfo(self.next_mid())
+        info.rc = mqtt.MQTT_ERR_SUCCESS
+        self.broker.publish(topic, payload, qos, retain)
+        info._set_as_published()
+        self.inbox.put((self.call_on_publish, (info.mid,)))
+        return info
+
+    def deliver(self, message: mqtt.MQTTMessage, qos: int):
+        """
+        Called by the broker, the message is handled on the client's thread
+        """
+        if message.qos != qos:
+            copy = mqtt.MQTTMessage(topic=message._topic)
+            copy.payload = message.payload
+            copy.retain = message.retain
+            copy.qos = qos
+            message = copy
+        self.inbox.put((self.call_on_message, (message,)))
+
+    def call_on_connect(self):
+        if self.on_connect:
+            self.on_connect(self, self._userdata, {"session present": 0}, mqtt.CONNACK_ACCEPTED)
+
+    def call_on_disconnect(self):
+        if self.on_disconnect:
+            self.on_disconnect(self, self._userdata, mqtt.MQTT_ERR_SUCCESS)
+
+    def call_on_subscribe(self, mid: int, granted_qos: Tuple[int]):
+        if self.on_subscribe:
+            self.on_subscribe(self, self._userdata, mid, granted_qos)
+
+    def call_on_unsubscribe(self, mid: int):
+        if self.on_unsubscribe:
+            self.on_unsubscribe(self, self._userdata, mid)
+
+    def call_on_publish(self, mid: int):
+        if self.on_publish:
+            self.on_publish(self, self._userdata, mid)
+
+    def call_on_message(self, message: mqtt.MQTTMessage):
+        topic = message.topic
+        matched = False
+        for pattern, callback in list(self.message_callbacks.values()):
+            if pattern.fullmatch(topic):
+                matched = True
+                callback(self, self._userdata, message)
+        if not matched and self.on_message:
+            self.on_message(self, self._userdata, message)
+
+    def handle(self, item) -> bool:
+        if item is None:
+            return False
+        callback, args = item
+        try:
+            callback(*args)
+        except Exception as e:
+            logger.error(f"Exception in a callback of {self}: {e}")
+        return True
+
+    def loop(self, timeout=1.0):
+        """
+        Handles the pending messages and acknowledgements, waiting at most timeout seconds for the first one
+        """
+        try:
+            item = self.inbox.get(timeout=timeout)
+        except queue.Empty:
+            return mqtt.MQTT_ERR_SUCCESS
+        while self.handle(item):
+            try:
+                item = self.inbox.get_nowait()
+            except queue.Empty:
+                break
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def loop_forever(self):
+        while self.handle(self.inbox.get()):
+            pass
+
+    def loop_start(self):
+        if self.thread is not None:
+            return mqtt.MQTT_ERR_INVAL
+        self.thread = threading.Thread(target=self.loop_forever, daemon=True)
+        self.thread.start()
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def loop_stop(self):
+        if self.thread is None:
+            return mqtt.MQTT_ERR_INVAL
+        self.inbox.put(None)
+        if threading.current_thread() != self.thread:
+            self.thread.join()
+        self.thread = None
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def backlog(self) -> int:
+        """
+        :return: the number of messages and acknowledgements waiting to be handled
+        """
+        return self.inbox.qsize()
+
+
+def load_test(car_count=10000, state_rounds=20):
+    """
+    Pushes the join and state messages of car_count cars through the loopback broker into the callbacks of
+    mqtt_connector, as fast as a single publisher can, and prints the rate at which they were published and
+    the rate at which the connector processed them. The ingest mode is set in the configuration.
+    """
+    import mqtt_connector
+    # the connector's clients are connected to the broker of the imported module, not to the one of __main__
+    import loopback_broker
+    from car import DetailedCarTracker
+    from HTCSPythonUtil import config
+
+    mqtt_connector.use_transport(mqtt_connector.TRANSPORT_LOOPBACK)
+    local_cars = DetailedCarTracker()
+    mqtt_connector.setup_connector(local_cars)
+    clients = [mqtt_connector.client_1] + [client for client, _ in mqtt_connector.state_client_pool]
+
+    consumer_lock = threading.Lock()
+
+    def consume():
+        # the consumer of the mailbox, if the states are coalesced, like the loop of a module would
+        while True:
+            with consumer_lock:
+                mqtt_connector.drain_mailbox()
+            time.sleep(0.1)
+
+    threading.Thread(target=consume, daemon=True).start()
+
+    def backlog():
+        waiting = sum(client.backlog() for client in clients) \
+            + sum(shard_queue.qsize() for shard_queue in mqtt_connector.shard_queues)
+        if mqtt_connector.mailbox is not None:
+            waiting += mqtt_connector.mailbox.events.qsize() + len(mqtt_connector.mailbox.latest_payloads)
+        return waiting
+
+    def wait_until_processed(start: float) -> Tuple[float, int]:
+        peak_backlog = 0
+        idle_polls = 0
+        # the last message taken from a queue may still be in process at the first empty poll
+        while idle_polls < 2:
+            with consumer_lock:
+                current_backlog = backlog()
+            peak_backlog = max(peak_backlog, current_backlog)
+            idle_polls = idle_polls + 1 if current_backlog == 0 else 0
+            time.sleep(0.001)
+        return time.perf_counter() - start, peak_backlog
+
+    publisher = loopback_broker.LoopbackClient("load_test_publisher")
+    topic_prefix = config["base_topic"] + "/"
+    qos = config["quality_of_service"] or 0
+    car_ids = [f"load_test_{i}" for i in range(car_count)]
+
+    start = time.perf_counter()
+    for i, car_id in enumerate(car_ids):
+        publisher.publish(topic_prefix + car_id + "/join",
+                          f"33.3333,41.6667,9.2593,13.8889,4.5000|{i % 3},{i * 0.5:.4f},30.0000,0", qos, retain=True)
+    published_sec = time.perf_counter() - start
+    processed_sec, peak_backlog = wait_until_processed(start)
+    print(f"{car_count} joins: published {car_count / published_sec:,.0f}/s, "
+          f"processed {car_count / processed_sec:,.0f}/s, peak backlog {peak_backlog}, "
+          f"{len(local_cars.as_dict)} cars joined")
+
+    message_count = car_count * state_rounds
+    start = time.perf_counter()
+    for state_round in range(state_rounds):
+        for i, car_id in enumerate(car_ids):
+            publisher.publish(topic_prefix + car_id + "/state",
+                              f"{i % 3},{i * 0.5 + state_round:.4f},30.0000,0", qos)
+    published_sec = time.perf_counter() - start
+    processed_sec, peak_backlog = wait_until_processed(start)
+    up_to_date = sum(1 for i, car_id in enumerate(car_ids)
+                     if local_cars[car_id].distance_taken == round(i * 0.5 + state_rounds - 1, 4))
+    print(f"{message_count} states: published {message_count / published_sec:,.0f}/s, "
+          f"processed {message_count / processed_sec:,.0f}/s, peak backlog {peak_backlog}, "
+          f"{up_to_date} cars up to date")
+
+    start = time.perf_counter()
+    for car_id in car_ids:
+        publisher.publish(topic_prefix + car_id + "/join", b"", qos, retain=True)
+    processed_sec, _ = wait_until_processed(start)
+    print(f"{car_count} exits processed in {processed_sec:.2f} s, {len(local_cars.as_dict)} cars left")
+    mqtt_connector.cleanup_connector()
+
+
+if __name__ == "__main__":
+    load_test()
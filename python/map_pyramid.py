@@ -0,0 +1,109 @@
+import os
+import cv2
+import math
+import logging
+import numpy as np
+from typing import List
+
+logger = logging.getLogger(__name__)
+
+# the smallest levels are at least this many pixels high or wide
+MIN_LEVEL_PIXEL = 2
+
+
+class MapPyramid:
+    """
+    Pyramid of the map, halved separately in width and in height (a ripmap), since the detailed view is scaled much
+    more vertically than horizontally: levels[y][x] is 2 ** x times narrower and 2 ** y times lower than the map.
+    A region of the map is drawn from the level closest to the output resolution with a single resize,
+    so drawing costs about the same at every zoom level.
+    """
+    def __init__(self, levels: List[List[np.ndarray]], length_meter: float):
+        self.levels = levels
+        self.length_meter = length_meter
+
+    @staticmethod
+    def build(image: np.ndarray, length_meter: float) -> "MapPyramid":
+        row = [image]
+        while row[-1].shape[1] >= 2 * MIN_LEVEL_PIXEL:
+            row.append(cv2.resize(row[-1], (row[-1].shape[1] // 2, image.shape[0]), interpolation=cv2.INTER_AREA))
+        levels = [row]
+        while levels[-1][0].shape[0] >= 2 * MIN_LEVEL_PIXEL:
+            levels.append([cv2.resize(level, (level.shape[1], level.shape[0] // 2), interpolation=cv2.INTER_AREA)
+                           for level in levels[-1]])
+        return MapPyramid(levels, length_meter)
+
+    @staticmethod
+    def level_index(ratio: float, level_count: int) -> int:
+        """
+        :param ratio: source pixels of the map per output pixel
+        :return: index of the smallest level, which still has at least as many pixels as the output
+        """
+        if ratio <= 1:
+            return 0
+        return min(int(math.log2(ratio)), level_count - 1)
+
+    def draw_region(self, offset_meter: float, width_meter: float, dst: np.ndarray):
+        """
+        Resizes the region of the map between offset_meter and offset_meter + width_meter into dst
+        """
+        height_pixel, width_pixel = dst.shape[:2]
+        map_height, map_width = self.levels[0][0].shape[:2]
+        x_ratio = width_meter / self.length_meter * map_width / width_pixel
+        y_level = self.levels[self.level_index(map_height / height_pixel, len(self.levels))]
+        level = y_level[self.level_index(x_ratio, len(y_level))]
+        x_scale = level.shape[1] / self.length_meter
+        x_start = min(int(offset_meter * x_scale), level.shape[1] - 1)
+        x_end = max(int((offset_meter + width_meter) * x_scale), x_start + 1)
+        # enlarged by nearest neighbour like before, so the lane markings stay sharp
+        interpolation = cv2.INTER_NEAREST if x_ratio < 1 else cv2.INTER_LINEAR
+        cv2.resize(level[:, x_start:x_end, :], (width_pixel, height_pixel), dst=dst, interpolation=interpolation)
+
+    def save(self, path: str, source_signature: str):
+        # written to a temporary file first, so an interrupted write does not leave a broken cache
+        temporary_path = path + ".tmp.npz"
+        levels = {f"level_{y}_{x}": level for y, row in enumerate(self.levels) for x, level in enumerate(row)}
+        np.savez_compressed(temporary_path, source_signature=np.array(source_signature), **levels)
+        os.replace(temporary_path, path)
+
+    @staticmethod
+    def load(path: str, source_signature: str, length_meter: float) -> "MapPyramid" or None:
+        """
+        :return: the pyramid saved at path, or None if it is missing or was built from a different map
+        """
+        if not os.path.isfile(path):
+            return None
+        with np.load(path) as saved:
+            if str(saved["source_signature"]) != source_signature:
+                return None
+            shape = max(tuple(int(index) for index in name.split("_")[1:]) for name in saved.files
+                        if name.startswith("level_"))
+            return MapPyramid([[saved[f"level_{y}_{x}"] for x in range(shape[1] + 1)] for y in range(shape[0] + 1)],
+                              length_meter)
+
+
+def signature_of(path: str) -> str:
+    stat = os.stat(path)
+    return f"{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def load_map_pyramid(map_path: str, length_meter: float, cache_directory: str) -> MapPyramid:
+    """
+    :return: the pyramid of the map image at map_path, from the cache directory if it was built before
+    """
+    cache_path = os.path.join(cache_directory, os.path.splitext(os.path.basename(map_path))[0] + "_pyramid.npz")
+    source_signature = signature_of(map_path)
+    try:
+        pyramid = MapPyramid.load(cache_path, source_signature, length_meter)
+        if pyramid is not None:
+            return pyramid
+    except (OSError, ValueError, KeyError) as e:
+        logger.warning(f"Could not load the map pyramid from {cache_path}: {e}")
+    pyramid = MapPyramid.build(cv2.imread(map_path), length_meter)
+    try:
+        os.makedirs(cache_directory, exist_ok=True)
+        pyramid.save(cache_path, source_signature)
+        logger.info(f"Map pyramid of {len(pyramid.levels)} x {len(pyramid.levels[0])} levels saved to {cache_path}")
+    except OSError as e:
+        logger.warning(f"Could not save the map pyramid to {cache_path}: {e}")
+    return pyramid
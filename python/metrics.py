@@ -0,0 +1,281 @@
+import os
+import math
+import json
+import time
+import logging
+import threading
+from typing import Dict, List, Tuple
+from HTCSPythonUtil import config
+
+logger = logging.getLogger(__name__)
+
+# the exported quantiles of the histograms
+QUANTILES = [0.5, 0.9, 0.99, 0.999]
+EXPORT_INTERVAL_SEC = 10
+
+
+def format_labels(labels: Tuple[Tuple[str, str], ...], extra: Dict[str, str] = None) -> str:
+    pairs = list(labels) + list((extra or {}).items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, description: str, labels: Tuple[Tuple[str, str], ...]):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.lock = threading.Lock()
+
+
+class Counter(Metric):
+    """
+    Monotonically increasing count, e.g. of the messages received
+    """
+    kind = "counter"
+
+    def __init__(self, name: str, description: str, labels: Tuple[Tuple[str, str], ...]):
+        super().__init__(name, description, labels)
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def prometheus_lines(self) -> List[str]:
+        return [f"{self.name}{format_labels(self.labels)} {self.value}"]
+
+    def as_json(self):
+        return self.value
+
+
+class Gauge(Metric):
+    """
+    The last value set, e.g. the ratio of the tick budget used by the last iteration
+    """
+    kind = "gauge"
+
+    def __init__(self, name: str, description: str, labels: Tuple[Tuple[str, str], ...]):
+        super().__init__(name, description, labels)
+        self.value = 0.0
+
+    def set(self, value: float):
+        self.value = value
+
+    def prometheus_lines(self) -> List[str]:
+        return [f"{self.name}{format_labels(self.labels)} {self.value}"]
+
+    def as_json(self):
+        return self.value
+
+
+class Timer:
+    """
+    Context manager recording the time spent in it into a histogram, in seconds
+    """
+    def __init__(self, histogram: "Histogram"):
+        self.histogram = histogram
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.histogram.record(time.perf_counter() - self.start)
+
+
+class Histogram(Metric):
+    """
+    Log-linear histogram like HdrHistogram: every power of two is split into sub_bucket_count equal buckets,
+    so the quantiles have a relative error of at most 1 / sub_bucket_count, for values of any magnitude.
+    Only the buckets that were hit are stored, and it is exported as a Prometheus summary.
+    """
+    kind = "summary"
+
+    def __init__(self, name: str, description: str, labels: Tuple[Tuple[str, str], ...], sub_bucket_count=64):
+        super().__init__(name, description, labels)
+        self.sub_bucket_count = sub_bucket_count
+        self.buckets: Dict[int, int] = {}
+        # values that are not positive are counted separately, and reported as 0
+        self.zero_count = 0
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def bucket_of(self, value: float) -> int:
+        # value = mantissa * 2 ** exponent, where 0.5 <= mantissa < 1
+        mantissa, exponent = math.frexp(value)
+        return exponent * self.sub_bucket_count + int((mantissa - 0.5) * 2 * self.sub_bucket_count)
+
+    def value_of(self, bucket: int) -> float:
+        """
+        :return: the middle of the bucket's range
+        """
+        exponent, sub_bucket = divmod(bucket, self.sub_bucket_count)
+        return (0.5 + (sub_bucket + 0.5) / (2 * self.sub_bucket_count)) * 2.0 ** exponent
+
+    def record(self, value: float):
+        with self.lock:
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+            if value <= 0:
+                self.zero_count += 1
+            else:
+                bucket = self.bucket_of(value)
+                self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def time(self) -> Timer:
+        return Timer(self)
+
+    def quantiles(self, quantiles: List[float] = QUANTILES) -> Dict[float, float]:
+        with self.lock:
+            buckets = sorted(self.buckets.items())
+            zero_count = self.zero_count
+            count = self.count
+            maximum = self.max
+        result = {}
+        for quantile in quantiles:
+            rank = quantile * count
+            seen = zero_count
+            value = 0.0
+            if seen < rank:
+                for bucket, bucket_count in buckets:
+                    seen += bucket_count
+                    if seen >= rank:
+                        value = min(self.value_of(bucket), maximum)
+                        break
+            result[quantile] = value
+        return result
+
+    def prometheus_lines(self) -> List[str]:
+        lines = [f"{self.name}{format_labels(self.labels, {'quantile': str(quantile)})} {value}"
+                 for quantile, value in self.quantiles().items()]
+        lines.append(f"{self.name}_sum{format_labels(self.labels)} {self.sum}")
+        lines.append(f"{self.name}_count{format_labels(self.labels)} {self.count}")
+        return lines
+
+    def as_json(self):
+        result = {f"p{quantile * 100:g}": value for quantile, value in self.quantiles().items()}
+        result.update({"count": self.count, "sum": self.sum, "max": self.max})
+        return result
+
+
+class MetricsRegistry:
+    """
+    The metrics of a process. A metric is identified by its name and labels, and is created at the first request.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], Metric] = {}
+
+    def get(self, metric_class, name: str, description: str, labels: Dict[str, str], **kwargs):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            metric = self.metrics.get(key)
+            if metric is None:
+                metric = metric_class(name, description, key[1], **kwargs)
+                self.metrics[key] = metric
+            return metric
+
+    def counter(self, name: str, description: str, **labels) -> Counter:
+        return self.get(Counter, name, description, labels)
+
+    def gauge(self, name: str, description: str, **labels) -> Gauge:
+        return self.get(Gauge, name, description, labels)
+
+    def histogram(self, name: str, description: str, **labels) -> Histogram:
+        return self.get(Histogram, name, description, labels)
+
+    def to_prometheus(self) -> str:
+        """
+        :return: the metrics in the Prometheus text exposition format
+        """
+        with self.lock:
+            metrics = sorted(self.metrics.values(), key=lambda m: (m.name, m.labels))
+        lines = []
+        described = set()
+        for metric in metrics:
+            if metric.name not in described:
+                described.add(metric.name)
+                lines.append(f"# HELP {metric.name} {metric.description}")
+                lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.prometheus_lines())
+        return "\n".join(lines) + "\n"
+
+    def to_json(self) -> Dict[str, any]:
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return {metric.name + format_labels(metric.labels): metric.as_json() for metric in metrics}
+
+
+# the registry of the process, the modules create their metrics in it
+registry = MetricsRegistry()
+counter = registry.counter
+gauge = registry.gauge
+histogram = registry.histogram
+
+
+class MetricsExporter(threading.Thread):
+    """
+    Periodically writes the metrics of the registry into <directory>/<name>.prom in the Prometheus text format
+    (e.g. for the textfile collector of node_exporter), and appends them to <directory>/<name>.jsonl as one line.
+    The JSON lines also contain the rate of every counter per second since the previous export.
+    """
+    def __init__(self, name: str, directory: str, interval_sec=EXPORT_INTERVAL_SEC,
+                 metrics_registry: MetricsRegistry = registry):
+        super().__init__(daemon=True)
+        self.registry = metrics_registry
+        self.interval_sec = interval_sec
+        self.prometheus_path = os.path.join(directory, name + ".prom")
+        self.json_path = os.path.join(directory, name + ".jsonl")
+        self.previous_counts: Dict[str, int] = {}
+        self.previous_time = time.time()
+        os.makedirs(directory, exist_ok=True)
+
+    def export(self):
+        now = time.time()
+        # written to a temporary file first, so the file is never read half-written
+        temporary_path = self.prometheus_path + ".tmp"
+        with open(temporary_path, "w") as prometheus_file:
+            prometheus_file.write(self.registry.to_prometheus())
+        os.replace(temporary_path, self.prometheus_path)
+
+        values = self.registry.to_json()
+        with self.registry.lock:
+            counters = [m for m in self.registry.metrics.values() if isinstance(m, Counter)]
+        rates = {}
+        for metric in counters:
+            key = metric.name + format_labels(metric.labels)
+            rates[key] = (metric.value - self.previous_counts.get(key, 0)) / max(now - self.previous_time, 1e-9)
+            self.previous_counts[key] = metric.value
+        self.previous_time = now
+        with open(self.json_path, "a") as json_file:
+            json_file.write(json.dumps({"timestamp": now, "metrics": values, "rates_per_sec": rates}) + "\n")
+
+    def run(self) -> None:
+        while True:
+            time.sleep(self.interval_sec)
+            try:
+                self.export()
+            except OSError as e:
+                logger.error(f"Could not export the metrics: {e}")
+
+
+def start_exporter(name: str) -> MetricsExporter or None:
+    """
+    Starts exporting the metrics of the process, if a metrics directory is set in the configuration
+    :param name: name of the exported files, e.g. the name of the module
+    """
+    directory = config.get("metrics_directory")
+    if not directory:
+        return None
+    exporter = MetricsExporter(name, directory, config.get("metrics_interval_sec") or EXPORT_INTERVAL_SEC)
+    exporter.start()
+    logger.info(f"Exporting metrics to {exporter.prometheus_path} and {exporter.json_path}")
+    return exporter
@@ -0,0 +1,80 @@
+import cv2
+import numpy as np
+from typing import List
+
+# the color of a single car in the density layer, so it can be seen next to the densest column too
+MIN_DENSITY_LEVEL = 64
+
+
+def disk_offsets(radius: int):
+    """
+    :return: the row and column offsets of the pixels of a filled disk around its center
+    """
+    dy, dx = np.mgrid[-radius: radius + 1, -radius: radius + 1]
+    inside = dx ** 2 + dy ** 2 <= radius ** 2
+    return dy[inside], dx[inside]
+
+
+class MinimapLayer:
+    """
+    Draws the cars on the minimap with array operations instead of a call per car.
+    Small fleets are drawn as dots of the colors of the cars, which are scattered into the image at once.
+    Fleets above density_fleet_size are drawn as a heatmap of the number of cars per pixel column of every lane,
+    where single dots could not be told apart anyway.
+    """
+    def __init__(self, lane_rows: List[int], width: int, height: int, point_size: int, density_fleet_size: int,
+                 colormap=cv2.COLORMAP_HOT):
+        """
+        :param lane_rows: the center row of every lane on the minimap, indexed by the lane
+        """
+        self.width = width
+        self.height = height
+        self.point_size = point_size
+        self.density_fleet_size = density_fleet_size
+        self.lane_rows = np.array(lane_rows, dtype=np.int64)
+        # lanes sharing the same row are counted together
+        self.band_rows, self.band_of_lane = np.unique(self.lane_rows, return_inverse=True)
+        self.dot_dy, self.dot_dx = disk_offsets(point_size)
+        self.heat_colors = cv2.applyColorMap(np.arange(256, dtype=np.uint8).reshape(-1, 1), colormap).reshape(-1, 3)
+
+    def columns_of(self, distance_pixel: np.ndarray) -> np.ndarray:
+        return np.clip(distance_pixel.astype(np.int64), 0, self.width - 1)
+
+    def draw(self, image: np.ndarray, lane: np.ndarray, distance_pixel: np.ndarray, colors: np.ndarray):
+        """
+        :param lane: the lane of every car
+        :param distance_pixel: the distance taken by every car in pixels of the minimap
+        :param colors: the BGR color of every car, a row for every car
+        """
+        if len(lane) == 0:
+            return
+        columns = self.columns_of(distance_pixel)
+        if len(lane) > self.density_fleet_size:
+            self.draw_density(image, lane, columns)
+        else:
+            self.draw_dots(image, lane, columns, colors)
+
+    def draw_dots(self, image: np.ndarray, lane: np.ndarray, columns: np.ndarray, colors: np.ndarray):
+        # every pixel of every dot at once, the later cars are on top like with drawing them one by one
+        y = np.clip(self.lane_rows[lane][:, None] + self.dot_dy, 0, self.height - 1)
+        x = np.clip(columns[:, None] + self.dot_dx, 0, self.width - 1)
+        image[y, x] = colors[:, None, :]
+
+    def density_of(self, lane: np.ndarray, columns: np.ndarray) -> np.ndarray:
+        """
+        :return: the number of cars in every pixel column of every band of lanes, a row for every band
+        """
+        bands = self.band_of_lane[lane]
+        return np.bincount(bands * self.width + columns,
+                           minlength=len(self.band_rows) * self.width).reshape(len(self.band_rows), self.width)
+
+    def draw_density(self, image: np.ndarray, lane: np.ndarray, columns: np.ndarray):
+        density = self.density_of(lane, columns)
+        # scaled to the densest column of the frame
+        levels = MIN_DENSITY_LEVEL + (255 - MIN_DENSITY_LEVEL) * (density - 1) // max(int(density.max()) - 1, 1)
+        levels = np.clip(levels, 0, 255)
+        heat = self.heat_colors[levels]
+        for band, row in enumerate(self.band_rows):
+            occupied = density[band] > 0
+            image[max(row - self.point_size, 0): min(row + self.point_size + 1, self.height), occupied] = \
+                heat[band, occupied]
@@ -1,9 +1,14 @@
-import ast
+import zlib
 import uuid
 import time
+import queue
 import logging
-from threading import Thread
+from threading import Thread, Lock
 import paho.mqtt.client as mqtt
+import metrics
+import state_codec
+from deadline_wheel import DeadlineWheel
+from state_mailbox import StateMailbox, JOIN, EXIT, STATE
 from car import Car, CarSpecs, CarManager
 from typing import List, Tuple, Dict, Callable
 from HTCSPythonUtil import config
@@ -12,18 +17,59 @@ logger = logging.getLogger("MQTT_Connector")
 local_cars: CarManager
 model_class: Callable[[str, CarSpecs, Tuple[int, float, float, int]], Car]
 
-client_1 = mqtt.Client("main_client_" + str(uuid.uuid4()))
+# mqtt: paho clients connected to the broker at config["address"]
+# loopback: clients of the in-process broker of loopback_broker, for load testing without a real broker
+TRANSPORT_MQTT = "mqtt"
+TRANSPORT_LOOPBACK = "loopback"
+
+
+def client_class_of(transport: str):
+    if transport == TRANSPORT_LOOPBACK:
+        import loopback_broker
+        return loopback_broker.LoopbackClient
+    return mqtt.Client
+
+
+client_class = client_class_of(config.get("transport") or TRANSPORT_MQTT)
+client_1 = client_class("main_client_" + str(uuid.uuid4()))
 state_client_pool: List[Tuple[mqtt.Client, Dict[str, int]]] = []
 state_client_pool_size = 8
 
+# pool: every car's state topic is subscribed by one client of the state client pool
+# wildcard: the main client subscribes to the state topic of every car, and the messages are sharded to workers
+# replay: recorded messages are fed to the callbacks, the cars are added and removed without any subscription
+INGEST_POOL = "pool"
+INGEST_WILDCARD = "wildcard"
+INGEST_REPLAY = "replay"
+ingest_mode = INGEST_POOL
+shard_queues: List[queue.Queue] = []
+# if set, the callbacks only post to the mailbox, and the consumer applies the changes by calling drain_mailbox
+mailbox: StateMailbox or None = None
+
 rr_counter = 0
+# the pool client subscribed to the state topic of every car, and the car of every pending unsubscribe,
+# keyed by the client and the message id, so an unsubscribe is completed without scanning the pool
+client_of_car: Dict[str, Tuple[mqtt.Client, Dict[str, int]]] = {}
+unsubscribing_cars: Dict[Tuple[mqtt.Client, int], str] = {}
+subscription_lock = Lock()
+
+# a car is only checked for being a zombie, when its deadline is due
+ZOMBIE_THRESHOLD_SEC = 5
+ZOMBIE_PRECISION_SEC = config.get("zombie_precision_sec") or 1
+zombie_deadlines = DeadlineWheel(ZOMBIE_PRECISION_SEC)
+
+# state messages received by every client of the pool, and by the main client in wildcard mode
+state_message_counters: Dict[object, metrics.Counter] = {}
+join_messages = metrics.counter("connector_join_messages_total", "Join and exit messages received")
 
 
 def round_robin_state_subscribe(car_id: str):
     global rr_counter
     client, _car_ids_mids = state_client_pool[rr_counter]
     client.subscribe(topic=config["base_topic"] + "/" + car_id + "/state", qos=config["quality_of_service"])
-    _car_ids_mids[car_id] = 0
+    with subscription_lock:
+        _car_ids_mids[car_id] = 0
+        client_of_car[car_id] = (client, _car_ids_mids)
     logger.debug(f"Car {car_id} joined client {rr_counter}")
     rr_counter += 1
     if rr_counter >= state_client_pool_size:
@@ -31,42 +77,116 @@ def round_robin_state_subscribe(car_id: str):
 
 
 def unsubscribe_pool(car_id: str):
-    for client, _car_ids_mids in state_client_pool:
-        if car_id in _car_ids_mids.keys():
-            _, _mid = client.unsubscribe(config["base_topic"] + "/" + car_id + "/state")
-            _car_ids_mids[car_id] = _mid
+    # the lock is held until the message id is stored, so the acknowledgement can not be handled before that
+    with subscription_lock:
+        if car_id not in client_of_car:
             return
+        client, _car_ids_mids = client_of_car[car_id]
+        _, _mid = client.unsubscribe(config["base_topic"] + "/" + car_id + "/state")
+        _car_ids_mids[car_id] = _mid
+        unsubscribing_cars[(client, _mid)] = car_id
+
+
+def track_car(car_id: str):
+    # checked at the next zombie check, which moves its deadline to the end of the threshold after its last state
+    zombie_deadlines.schedule(car_id, time.time())
+
+
+def shard_of(car_id: str):
+    # crc32 is stable between runs, unlike hash
+    return zlib.crc32(car_id.encode("utf-8")) % len(shard_queues)
+
+
+def add_car(car_id: str, car: Car):
+    """
+    Adds the joined car, unless a car with the same id exists, and subscribes its state topic in INGEST_POOL mode
+    """
+    if local_cars.get(car_id) is not None:
+        logger.warning(f"Car with already existing id ({car_id}) sent a join message")
+        return
+    local_cars[car_id] = car
+    track_car(car_id)
+    if ingest_mode == INGEST_POOL:
+        round_robin_state_subscribe(car_id)
 
 
 def on_join_message(client, user_data, msg):
-    message = msg.payload.decode("utf-8")
+    join_messages.inc()
     car_id = msg.topic.split('/')[-2]
     car = local_cars.get(car_id)
+    if mailbox is not None:
+        # existence is checked and the state topic is subscribed when the events are applied,
+        # so an exit applied in the same drain does not unsubscribe the car joining again
+        if msg.payload:
+            specs, state = state_codec.decode_join(msg.payload)
+            mailbox.post_join(car_id, model_class(car_id, CarSpecs(specs), state))
+        else:
+            mailbox.post_exit(car_id)
+    elif ingest_mode == INGEST_WILDCARD:
+        # the joins go through the shard of the car like its exits, so a car joining again is added after it exited
+        shard_queues[shard_of(car_id)].put((JOIN if msg.payload else EXIT, car_id, msg.payload))
     # non-empty message - joinTraffic
-    if message:
+    elif msg.payload:
         if car is None:
-            [specs_part, state_part] = message.split('|')
-            specs = ast.literal_eval(specs_part)
-            state = ast.literal_eval(state_part)
-            local_cars[car_id] = model_class(car_id, CarSpecs(specs), state)
-            round_robin_state_subscribe(car_id)
+            specs, state = state_codec.decode_join(msg.payload)
+            add_car(car_id, model_class(car_id, CarSpecs(specs), state))
         else:
             logger.warning(f"Car with already existing id ({car_id}) sent a join message")
     # empty message - exitTraffic
     elif car is not None:
-        unsubscribe_pool(car_id)
+        if ingest_mode == INGEST_POOL:
+            unsubscribe_pool(car_id)
+        else:
+            local_cars.pop(car_id)
 
 
-def on_state_message(client, user_data, msg):
-    car_id = msg.topic.split('/')[-2]
+def apply_state(car_id: str, payload: bytes):
+    if mailbox is not None:
+        mailbox.post_state(car_id, payload)
+        return
     car = local_cars.get(car_id)
     if car is None:
         logger.warning(f"Car with unrecognized id ({car_id}) sent a state message")
     else:
-        state = ast.literal_eval(msg.payload.decode("utf-8"))
+        state = state_codec.decode_state(payload)
         local_cars.update_car(car_id, state)
 
 
+def on_state_message(client, user_data, msg):
+    state_message_counters[client].inc()
+    apply_state(msg.topic.split('/')[-2], msg.payload)
+
+
+def on_wildcard_state_message(client, user_data, msg):
+    state_message_counters[client].inc()
+    car_id = msg.topic.split('/')[-2]
+    shard_queues[shard_of(car_id)].put((STATE, car_id, msg.payload))
+
+
+class IngestWorker(Thread):
+    """
+    Applies the joins, state messages and exits of the cars belonging to one shard, in the order they arrived
+    """
+    def __init__(self, shard_queue: queue.Queue):
+        super().__init__(daemon=True)
+        self.shard_queue = shard_queue
+
+    def run(self) -> None:
+        while True:
+            kind, car_id, payload = self.shard_queue.get()
+            try:
+                if kind == STATE:
+                    apply_state(car_id, payload)
+                elif kind == JOIN:
+                    specs, state = state_codec.decode_join(payload)
+                    add_car(car_id, model_class(car_id, CarSpecs(specs), state))
+                elif local_cars.get(car_id) is not None:
+                    local_cars.pop(car_id)
+                    logger.debug(f"Car {car_id} exited")
+            except Exception as e:
+                logger.error(f"Could not process message of car {car_id}: {e}")
+
+
 def on_connect(client, user_data, flags, rc):
     if rc == 0:
         client.connected_flag = True
@@ -81,50 +201,167 @@ def on_disconnect(client, user_data, rc):
 
 
 def remove_unsubscribed_car(client, _car_ids_mids, message_id):
-    for car_id, mid in _car_ids_mids.items():
-        if mid == message_id:
-            local_cars.pop(car_id)
-            _car_ids_mids.pop(car_id)
-            logger.debug(f"Unsubscribed car {car_id}")
+    with subscription_lock:
+        car_id = unsubscribing_cars.pop((client, message_id), None)
+        # only the last unsubscribe of a car completes it
+        if car_id is None or _car_ids_mids.get(car_id) != message_id:
             return
+        _car_ids_mids.pop(car_id)
+        if client_of_car.get(car_id, (None,))[0] is client:
+            client_of_car.pop(car_id)
+    # with a mailbox the car was already removed when its exit was applied
+    if mailbox is None:
+        local_cars.pop(car_id)
+    logger.debug(f"Unsubscribed car {car_id}")
 
         
 class ZombieKiller(Thread):
     def __init__(self):
-        super().__init__()
-        self.interval = 5
-        self.threshold = 5
+        # does not keep the process alive after the module's loop exits
+        super().__init__(daemon=True)
+        self.interval = ZOMBIE_PRECISION_SEC
+        self.threshold = ZOMBIE_THRESHOLD_SEC
 
     def run(self) -> None:
         while True:
             time.sleep(self.interval)
-            now = time.time()
-            for c in local_cars.get_all():
-                if c.last_state_update < now - self.threshold:
-                    logger.info(f"Zombie killed killed {c}")
-                    unsubscribe_pool(c.id)
-                    local_cars.pop(c.id)
+            kill_zombies(self.threshold)
+
+
+def kill_zombies(threshold):
+    """
+    Removes the cars which have not sent a state message in the last threshold seconds.
+    Only the cars with a due deadline are checked, and the deadline of a living car is moved to the end of the
+    threshold after its last state message, so the state messages do not touch the deadlines.
+    """
+    now = time.time()
+    for car_id in zombie_deadlines.expire(now):
+        c = local_cars.get(car_id)
+        if c is None:
+            continue
+        if c.last_state_update + threshold > now:
+            zombie_deadlines.schedule(car_id, c.last_state_update + threshold)
+            continue
+        logger.info(f"Zombie killed killed {c}")
+        if mailbox is not None:
+            mailbox.post_exit(c.id)
+        else:
+            unsubscribe_pool(c.id)
+            local_cars.pop(c.id)
+
+
+def drain_mailbox():
+    """
+    Applies the join and exit events and the newest state of every car collected by the mailbox.
+    The consumer of the cars should call it at the beginning of every iteration, it does nothing without a mailbox.
+    """
+    if mailbox is None:
+        return
+    events, payloads = mailbox.take()
+    for kind, car_id, car in events:
+        if kind == JOIN:
+            add_car(car_id, car)
+        elif local_cars.get(car_id) is not None:
+            unsubscribe_pool(car_id)
+            local_cars.pop(car_id)
+    discarded = 0
+    for car_id, payload in payloads.items():
+        if local_cars.get(car_id) is None:
+            discarded += 1
+        else:
+            local_cars.update_car(car_id, state_codec.decode_state(payload))
+    logger.debug(f"Mailbox drained: {len(events)} events, {len(payloads)} states, {discarded} of unknown cars, "
+                 f"{mailbox.coalesced_count} of {mailbox.received_count} states coalesced so far")
+
+
+def create_state_client(index: int) -> Tuple[mqtt.Client, Dict[str, int]]:
+    """
+    :return: a new, not yet connected client of the state client pool, and its dictionary of car ids and message ids
+    """
+    client_id = "state_client_" + str(index) + "-" + str(uuid.uuid4())
+    state_client = client_class(client_id)
 
+    car_ids_mids = {}
+    state_client.user_data_set(car_ids_mids)
+    state_message_counters[state_client] = metrics.counter("connector_state_messages_total",
+                                                           "State messages received by a client", client=str(index))
 
-def setup_connector(_local_cars: CarManager, _model_class=Car, on_terminate=None, _state_client_pool_size=8):
-    global model_class, local_cars, state_client_pool_size
+    state_client.username_pw_set(username=config["username"], password=config["password"])
+    state_client.on_connect = on_connect
+    state_client.on_message = on_state_message
+    state_client.on_unsubscribe = remove_unsubscribed_car
+    state_client.on_disconnect = on_disconnect
+    return state_client, car_ids_mids
+
+
+def use_transport(transport: str):
+    """
+    Replaces the transport set in the configuration, has to be called before setup_connector
+    """
+    global client_class, client_1
+    client_class = client_class_of(transport)
+    client_1 = client_class("main_client_" + str(uuid.uuid4()))
+
+
+def setup_state(_local_cars: CarManager, _model_class, _ingest_mode: str, _coalesce_states: bool):
+    """
+    Sets the module level state used by the callbacks, without creating any clients
+    """
+    global model_class, local_cars, ingest_mode, mailbox
     model_class = _model_class
     local_cars = _local_cars
+    ingest_mode = _ingest_mode
+    if _coalesce_states:
+        mailbox = StateMailbox()
 
-    logger.info(f"Setting up main client and {state_client_pool_size} state clients")
-    for i in range(state_client_pool_size):
-        client_id = "state_client_" + str(i) + "-" + str(uuid.uuid4())
-        state_client = mqtt.Client(client_id)
 
-        car_ids_mids = {}
-        state_client.user_data_set(car_ids_mids)
+def setup_replay(_local_cars: CarManager, replay_client, _model_class=Car, _coalesce_states=False):
+    """
+    Sets the module level state for feeding recorded messages to the callbacks, without connecting any clients
+    :param replay_client: the client passed to the callbacks, see recorder.SessionReplayer
+    """
+    setup_state(_local_cars, _model_class, INGEST_REPLAY, _coalesce_states)
+    state_message_counters[replay_client] = metrics.counter("connector_state_messages_total",
+                                                            "State messages received by a client", client="replay")
 
-        state_client.username_pw_set(username=config["username"], password=config["password"])
-        state_client.on_connect = on_connect
-        state_client.on_message = on_state_message
-        state_client.on_unsubscribe = remove_unsubscribed_car
-        state_client.on_disconnect = on_disconnect
 
+def setup_listener(on_message, topics: List[str]):
+    """
+    Connects the main client and subscribes it to the topics with a single callback, without tracking any cars,
+    e.g. for recording the traffic
+    """
+    client_1.username_pw_set(username=config["username"], password=config["password"])
+    client_1.on_connect = on_connect
+    client_1.on_disconnect = on_disconnect
+    client_1.on_message = on_message
+    client_1.connect(config["address"])
+    client_1.loop_start()
+    for topic in topics:
+        client_1.subscribe(topic=topic, qos=config["quality_of_service"])
+
+
+def setup_connector(_local_cars: CarManager, _model_class=Car, on_terminate=None, _state_client_pool_size=8,
+                    _ingest_mode=config.get("ingest_mode") or INGEST_POOL,
+                    _ingest_worker_count=config.get("ingest_workers") or 4,
+                    _coalesce_states=bool(config.get("coalesce_states"))):
+    """
+    :param _ingest_mode: INGEST_POOL or INGEST_WILDCARD, see their description
+    :param _ingest_worker_count: number of worker threads applying the state messages in INGEST_WILDCARD mode
+    :param _coalesce_states: collect the changes in a mailbox, which the consumer applies with drain_mailbox
+    """
+    setup_state(_local_cars, _model_class, _ingest_mode, _coalesce_states)
+
+    if ingest_mode == INGEST_WILDCARD:
+        logger.info(f"Setting up main client with {_ingest_worker_count} ingest workers")
+        for i in range(_ingest_worker_count):
+            shard_queues.append(queue.Queue())
+            IngestWorker(shard_queues[-1]).start()
+        state_client_count = 0
+    else:
+        logger.info(f"Setting up main client and {state_client_pool_size} state clients")
+        state_client_count = state_client_pool_size
+    for i in range(state_client_count):
+        state_client, car_ids_mids = create_state_client(i)
         state_client_pool.append((state_client, car_ids_mids))
 
         state_client.connect(config["address"])
@@ -136,9 +373,15 @@ def setup_connector(_local_cars: CarManager, _model_class=Car, on_terminate=None
 
     client_1.connect(config["address"])
     client_1.loop_start()
-    if state_client_pool_size > 0:
+    if state_client_count > 0 or ingest_mode == INGEST_WILDCARD:
         client_1.message_callback_add(config["base_topic"] + "/+/join", on_join_message)
         client_1.subscribe(topic=config["base_topic"] + "/+/join", qos=config["quality_of_service"])
+    if ingest_mode == INGEST_WILDCARD:
+        # the same client receives the join and the state messages, so the join of a car is processed before its states
+        state_message_counters[client_1] = metrics.counter("connector_state_messages_total",
+                                                           "State messages received by a client", client="main")
+        client_1.message_callback_add(config["base_topic"] + "/+/state", on_wildcard_state_message)
+        client_1.subscribe(topic=config["base_topic"] + "/+/state", qos=config["quality_of_service"])
     if on_terminate:
         client_1.message_callback_add(config["base_topic"] + "/obituary", on_terminate)
         client_1.subscribe(topic=config["base_topic"] + "/obituary", qos=config["quality_of_service"])
@@ -0,0 +1,257 @@
+import os
+import mmap
+import time
+import struct
+import logging
+import argparse
+from threading import Lock
+from typing import BinaryIO, Callable, Dict, Iterator, List, Tuple
+import metrics
+from HTCSPythonUtil import config
+
+logger = logging.getLogger(__name__)
+
+# a segment file starts with MAGIC, followed by records of a fixed width header and a payload of payload_length bytes
+MAGIC = b"HTCSREC1"
+# time of arrival in seconds since the epoch, car index, kind, payload length
+RECORD_HEADER = struct.Struct("<dIBxH")
+MAX_PAYLOAD_BYTES = 0xFFFF
+SEGMENT_PREFIX = "segment_"
+SEGMENT_SUFFIX = ".htcsrec"
+# a segment is closed and a new one is started above this size
+SEGMENT_BYTES = int((config.get("recorder_segment_mb") or 64) * 1024 * 1024)
+
+# the kinds of the records, the ids of the cars are interned per segment: an ID record with the car id as payload
+# defines the index of the car before the first record of the car in the segment
+ID, JOIN, STATE, COMMAND, OBITUARY = range(5)
+kind_of_topic_suffix = {"join": JOIN, "state": STATE, "command": COMMAND}
+topic_suffix_of_kind = {kind: suffix for suffix, kind in kind_of_topic_suffix.items()}
+
+Record = Tuple[float, int, str, bytes]
+
+
+def segment_paths(directory: str) -> List[str]:
+    """
+    :return: the segment files of the directory, in the order they were written
+    """
+    if not os.path.isdir(directory):
+        return []
+    return [os.path.join(directory, name) for name in sorted(os.listdir(directory))
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX)]
+
+
+class SessionRecorder:
+    """
+    Appends the received messages to segment files of a binary log, see read_segment for the format.
+    New segments are started after the existing ones, so recording into the same directory again continues the log.
+    """
+    def __init__(self, directory: str, segment_bytes=SEGMENT_BYTES):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.lock = Lock()
+        self.file: BinaryIO or None = None
+        self.file_bytes = 0
+        self.index_of_id: Dict[str, int] = {}
+        self.segment_count = len(segment_paths(directory))
+        self.records = metrics.counter("recorder_records_total", "Records appended to the log")
+        self.obituary_topic = config["base_topic"] + "/obituary"
+        os.makedirs(directory, exist_ok=True)
+
+    def start_segment(self):
+        if self.file is not None:
+            self.file.close()
+        path = os.path.join(self.directory, f"{SEGMENT_PREFIX}{self.segment_count:06d}{SEGMENT_SUFFIX}")
+        self.segment_count += 1
+        self.file = open(path, "xb", buffering=1024 * 1024)
+        self.file.write(MAGIC)
+        self.file_bytes = len(MAGIC)
+        self.index_of_id = {}
+        logger.info(f"Recording to {path}")
+
+    def write(self, at: float, car: int, kind: int, payload: bytes):
+        self.file.write(RECORD_HEADER.pack(at, car, kind, len(payload)))
+        self.file.write(payload)
+        self.file_bytes += RECORD_HEADER.size + len(payload)
+
+    def append(self, kind: int, car_id: str, payload: bytes = b"", at: float = None):
+        """
+        :param at: time of the message, now by default
+        """
+        at = time.time() if at is None else at
+        if len(payload) > MAX_PAYLOAD_BYTES:
+            logger.warning(f"Message of {len(payload)} bytes of car {car_id} is too long to be recorded")
+            return
+        with self.lock:
+            if self.file is None or self.file_bytes >= self.segment_bytes:
+                self.start_segment()
+            car = self.index_of_id.get(car_id)
+            if car is None:
+                car = self.index_of_id[car_id] = len(self.index_of_id)
+                self.write(at, car, ID, car_id.encode("utf-8"))
+            self.write(at, car, kind, payload)
+        self.records.inc()
+
+    def on_message(self, client, user_data, msg):
+        if msg.topic == self.obituary_topic:
+            # the payload is the id of the car
+            self.append(OBITUARY, msg.payload.decode("utf-8"))
+            return
+        parts = msg.topic.split('/')
+        kind = kind_of_topic_suffix.get(parts[-1])
+        if kind is not None:
+            self.append(kind, parts[-2], msg.payload)
+
+    def flush(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+def read_segment(path: str) -> Iterator[Record]:
+    """
+    Reads the records of a memory-mapped segment file. A record cut off at the end of the file
+    (e.g. by a crash of the recorder) ends the segment.
+    :return: time, kind, car id and payload of every record, except the ID records
+    """
+    with open(path, "rb") as segment_file:
+        if os.fstat(segment_file.fileno()).st_size <= len(MAGIC):
+            return
+        with mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if data[:len(MAGIC)] != MAGIC:
+                raise ValueError(f"{path} is not a segment of a recording")
+            ids: List[str] = []
+            offset = len(MAGIC)
+            end = len(data)
+            while offset + RECORD_HEADER.size <= end:
+                at, car, kind, payload_length = RECORD_HEADER.unpack_from(data, offset)
+                offset += RECORD_HEADER.size
+                if offset + payload_length > end:
+                    logger.warning(f"The last record of {path} is incomplete")
+                    return
+                payload = data[offset: offset + payload_length]
+                offset += payload_length
+                if kind == ID:
+                    ids.append(payload.decode("utf-8"))
+                else:
+                    yield at, kind, ids[car], payload
+
+
+class ReplayedMessage:
+    """
+    Recorded message with the attributes of paho's MQTTMessage used by the callbacks
+    """
+    def __init__(self, topic: str, payload: bytes):
+        self.topic = topic
+        self.payload = payload
+        self.qos = 0
+        self.retain = False
+
+
+class SessionReplayer:
+    """
+    Feeds a recorded session to the callbacks of a module, e.g. mqtt_connector.on_join_message, in the order and
+    at the pace the messages were recorded. The replayer is passed to the callbacks as the client,
+    see mqtt_connector.setup_replay.
+    """
+    def __init__(self, directory: str):
+        self.paths = segment_paths(directory)
+        if not self.paths:
+            raise FileNotFoundError(f"No recorded segments in {directory}")
+        self.base_topic = config["base_topic"]
+
+    def records(self) -> Iterator[Record]:
+        for path in self.paths:
+            yield from read_segment(path)
+
+    def message_of(self, kind: int, car_id: str, payload: bytes) -> ReplayedMessage:
+        if kind == OBITUARY:
+            return ReplayedMessage(self.base_topic + "/obituary", car_id.encode("utf-8"))
+        return ReplayedMessage(f"{self.base_topic}/{car_id}/{topic_suffix_of_kind[kind]}", payload)
+
+    def replay(self, on_join_message: Callable = None, on_state_message: Callable = None,
+               on_terminate: Callable = None, on_command: Callable = None, speed=1.0,
+               ticks: List[Tuple[Callable[[], None], float]] = (), user_data=None) -> int:
+        """
+        :param speed: times the recorded pace, 0 replays as fast as possible
+        :param ticks: functions called every interval seconds of the recording, with their intervals in seconds,
+        before the messages recorded after the tick, so e.g. terminator.terminate_tick can be profiled on the
+        same messages at every run regardless of the replay speed
+        :return: the number of messages replayed
+        """
+        callbacks = {JOIN: on_join_message, STATE: on_state_message, COMMAND: on_command, OBITUARY: on_terminate}
+        replay_start = time.time()
+        recording_start = None
+        next_ticks = []
+        count = 0
+        for at, kind, car_id, payload in self.records():
+            if recording_start is None:
+                recording_start = at
+                next_ticks = [at + interval_sec for _, interval_sec in ticks]
+            for index, (tick, interval_sec) in enumerate(ticks):
+                while next_ticks[index] <= at:
+                    tick()
+                    next_ticks[index] += interval_sec
+            if speed > 0:
+                remaining_sec = replay_start + (at - recording_start) / speed - time.time()
+                if remaining_sec > 0:
+                    time.sleep(remaining_sec)
+            callback = callbacks.get(kind)
+            if callback is not None:
+                callback(self, user_data, self.message_of(kind, car_id, payload))
+                count += 1
+        return count
+
+
+def record(directory: str):
+    """
+    Records the join, state, command and obituary messages of every car until interrupted
+    """
+    import mqtt_connector
+    session_recorder = SessionRecorder(directory)
+    base_topic = config["base_topic"]
+    mqtt_connector.setup_listener(session_recorder.on_message, [base_topic + "/+/join", base_topic + "/+/state",
+                                                                base_topic + "/+/command", base_topic + "/obituary"])
+    try:
+        while True:
+            time.sleep(1)
+            session_recorder.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        mqtt_connector.client_1.loop_stop()
+        session_recorder.close()
+
+
+def replay_into_tracker(directory: str, speed: float):
+    """
+    Replays a recorded session into the callbacks of mqtt_connector, and logs the fleet it ends with
+    """
+    import mqtt_connector
+    from car import DetailedCarTracker
+    replayer = SessionReplayer(directory)
+    local_cars = DetailedCarTracker()
+    mqtt_connector.setup_replay(local_cars, replayer)
+    start = time.perf_counter()
+    count = replayer.replay(mqtt_connector.on_join_message, mqtt_connector.on_state_message, speed=speed)
+    elapsed_sec = time.perf_counter() - start
+    logger.info(f"{count} messages replayed in {elapsed_sec:.2f} s, {len(local_cars.as_dict)} cars at the end")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Records the HTCS topics to a binary log, or replays a recording")
+    parser.add_argument("directory", help="directory of the segment files")
+    parser.add_argument("--replay", action="store_true", help="replay the recording instead of recording")
+    parser.add_argument("--speed", type=float, default=1.0, help="times the recorded pace, 0 is as fast as possible")
+    args = parser.parse_args()
+
+    if args.replay:
+        replay_into_tracker(args.directory, args.speed)
+    else:
+        metrics.start_exporter("recorder")
+        record(args.directory)
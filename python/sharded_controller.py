@@ -0,0 +1,102 @@
+import time
+import logging
+import multiprocessing
+import numpy as np
+from typing import Tuple
+import batch_controller
+from fleet_store import FleetSnapshot
+from HTCSPythonUtil import config
+
+logger = logging.getLogger(__name__)
+
+# a car in a segment sees the cars of the neighbouring segments up to this distance
+# the decisions are the same as the unsharded ones as long as no decision looks further than this
+HALO_METER = 1000
+ARRAY_NAMES = ["lane", "distance_taken", "speed", "acceleration_state", "preferred_speed", "max_speed",
+               "acceleration", "braking_power", "size"]
+
+
+def decide_segment(arrays: Tuple[np.ndarray, ...], owned: slice) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Runs in a worker process, decides for the cars of one segment with its halo zones
+    :param arrays: the columns of a FleetSnapshot (see ARRAY_NAMES) for the cars of the segment and its halo zones
+    :param owned: the part of the arrays belonging to the segment itself, only these decisions are returned
+    """
+    # the cars are only needed to map the decisions back, indexes are enough for that
+    snapshot = FleetSnapshot(list(range(len(arrays[0]))), *arrays)
+    lane_commands, speed_commands = batch_controller.decide_commands(snapshot)
+    return lane_commands[owned], speed_commands[owned]
+
+
+class ShardedController:
+    """
+    Splits the road into segments, and the decisions of every segment are made by the batch controller
+    in a pool of worker processes. Every car is owned by the segment it is in at the time of the snapshot,
+    so cars are handed off as they cross the segment boundaries, and only the owner decides for a car.
+    """
+    def __init__(self, worker_count: int, segment_count: int = None, road_length=config["position_bound"],
+                 halo_meter=HALO_METER):
+        self.worker_count = worker_count
+        self.segment_count = segment_count or worker_count
+        self.halo_meter = halo_meter
+        inner_boundaries = np.linspace(0, road_length, self.segment_count + 1)[1:-1]
+        # the first and the last segment also own the cars before and after the road
+        self.boundaries = np.concatenate(([-np.inf], inner_boundaries, [np.inf]))
+        self.pool = multiprocessing.Pool(worker_count)
+
+    def decide_commands(self, snapshot: FleetSnapshot) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Same as batch_controller.decide_commands, but the segments are decided in parallel
+        """
+        distances = snapshot.distance_taken
+        owned_edges = np.searchsorted(distances, self.boundaries)
+        halo_starts = np.searchsorted(distances, self.boundaries[:-1] - self.halo_meter)
+        halo_ends = np.searchsorted(distances, self.boundaries[1:] + self.halo_meter)
+        pending = []
+        for i in range(self.segment_count):
+            if owned_edges[i] == owned_edges[i + 1]:
+                continue
+            arrays = tuple(getattr(snapshot, name)[halo_starts[i]:halo_ends[i]] for name in ARRAY_NAMES)
+            owned = slice(owned_edges[i] - halo_starts[i], owned_edges[i + 1] - halo_starts[i])
+            pending.append(self.pool.apply_async(decide_segment, (arrays, owned)))
+        results = [result.get() for result in pending]
+        if not results:
+            return np.empty(0, dtype=int), np.empty(0, dtype=int)
+        # the segments follow each other in the order of the snapshot
+        return np.concatenate([r[0] for r in results]), np.concatenate([r[1] for r in results])
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+def benchmark(fleet_sizes=(10000, 50000), worker_counts=(1, 2, 4, 8), tick_count=20):
+    """
+    Prints the median tick latency of the sharded controller with different numbers of workers
+    """
+    from generator import generate_random_cars
+    for fleet_size in fleet_sizes:
+        snapshot = FleetSnapshot.from_cars(generate_random_cars(fleet_size, seed=fleet_size))
+        expected = batch_controller.decide_commands(snapshot)
+        latencies = []
+        for _ in range(tick_count):
+            start = time.perf_counter()
+            batch_controller.decide_commands(snapshot)
+            latencies.append(time.perf_counter() - start)
+        print(f"{fleet_size} cars, unsharded: {np.median(latencies) * 1000:.2f} ms")
+        for worker_count in worker_counts:
+            controller = ShardedController(worker_count)
+            decisions = controller.decide_commands(snapshot)
+            same = np.array_equal(decisions[0], expected[0]) and np.array_equal(decisions[1], expected[1])
+            latencies = []
+            for _ in range(tick_count):
+                start = time.perf_counter()
+                controller.decide_commands(snapshot)
+                latencies.append(time.perf_counter() - start)
+            controller.close()
+            print(f"{fleet_size} cars, {worker_count} workers: {np.median(latencies) * 1000:.2f} ms, "
+                  f"same decisions as unsharded: {same}")
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,205 @@
+import time
+import logging
+import numpy as np
+from typing import List
+from car import Car, Lane, AccelerationState, Command
+from fleet_store import ColumnarCarManager
+from HTCSPythonUtil import config
+
+logger = logging.getLogger(__name__)
+
+# see htcs-vehicle/src/options.c and htcs-vehicle/src/state.h
+UPDATE_INTERVAL_MS = 100
+LANE_CHANGE_MS = 2000
+
+# lane reached at the end of a lane change, indexed by the lane during the change
+lane_change_targets = np.array([Lane.MERGE_LANE, Lane.TRAFFIC_LANE, Lane.TRAFFIC_LANE,
+                                Lane.EXPRESS_LANE, Lane.TRAFFIC_LANE, Lane.EXPRESS_LANE], dtype=np.int8)
+# lane after a change lane command, indexed by the current lane, see processCommand in htcs-vehicle/src/command.c
+lane_after_change_command = {Lane.MERGE_LANE: Lane.MERGE_TO_TRAFFIC,
+                             Lane.TRAFFIC_LANE: Lane.TRAFFIC_TO_EXPRESS,
+                             Lane.EXPRESS_LANE: Lane.EXPRESS_TO_TRAFFIC}
+acceleration_state_of_command = {Command.MAINTAIN_SPEED: AccelerationState.MAINTAINING_SPEED,
+                                 Command.ACCELERATE: AccelerationState.ACCELERATING,
+                                 Command.BRAKE: AccelerationState.BRAKING}
+
+
+class TrafficSimulator:
+    """
+    Simulates the vehicle processes of htcs-vehicle for the whole fleet at once, without any MQTT traffic.
+    The cars are kept in a ColumnarCarManager, which can be used as local_cars by the other modules.
+    The simulator can also replace mqtt_connector.client_1, since it receives commands through publish,
+    so give_command and the terminator command the simulated cars in-process.
+    """
+    def __init__(self, update_interval_ms=UPDATE_INTERVAL_MS):
+        self.cars = ColumnarCarManager()
+        self.update_interval_ms = update_interval_ms
+        # milliseconds spent in the current lane change, for every slot of the car manager
+        self.lane_change_elapsed = np.zeros(self.cars.columns.capacity, dtype=np.int64)
+        self.command_topic_prefix = config["base_topic"] + "/"
+
+    def add_car(self, car: Car):
+        self.cars[car.id] = car
+        slot = self.cars[car.id]._slot
+        if len(self.lane_change_elapsed) < self.cars.columns.capacity:
+            self.lane_change_elapsed = np.concatenate(
+                (self.lane_change_elapsed,
+                 np.zeros(self.cars.columns.capacity - len(self.lane_change_elapsed), dtype=np.int64)))
+        self.lane_change_elapsed[slot] = 0
+
+    def add_cars(self, cars: List[Car]):
+        for car in cars:
+            self.add_car(car)
+
+    def step(self):
+        """
+        Vectorized adjustState and progressLaneChange of htcs-vehicle/src/state.c for every car
+        """
+        with self.cars.lock:
+            slots = self.cars.active_slots()
+            columns = self.cars.columns
+            elapsed_ms = self.update_interval_ms
+            lane = columns.lane[slots]
+            speed = columns.speed[slots]
+            acceleration_state = columns.acceleration_state[slots]
+
+            columns.distance_taken[slots] = columns.distance_taken[slots] + speed * (elapsed_ms / 1000.0)
+
+            accelerating = acceleration_state == AccelerationState.ACCELERATING.value
+            braking = (acceleration_state == AccelerationState.BRAKING.value) & (speed > 0.0)
+            in_express = lane == Lane.EXPRESS_LANE
+            speed = np.where(accelerating, speed + columns.acceleration[slots] * (elapsed_ms / 1000.0), speed)
+            max_speed = columns.max_speed[slots]
+            # in the express lane the speed is capped at the max speed
+            capped = accelerating & in_express & (speed > max_speed)
+            speed = np.where(capped, max_speed, speed)
+            # elsewhere the car stops accelerating above its preferred speed, but keeps the speed it reached
+            reached_preferred = accelerating & ~in_express & (speed > columns.preferred_speed[slots])
+            acceleration_state = np.where(capped | reached_preferred,
+                                          AccelerationState.MAINTAINING_SPEED.value, acceleration_state)
+            speed = np.where(braking, np.maximum(speed - columns.braking_power[slots] * (elapsed_ms / 1000.0), 0.0),
+                             speed)
+            columns.speed[slots] = speed
+            columns.acceleration_state[slots] = acceleration_state
+            columns.reported_distance_taken[slots] = columns.distance_taken[slots]
+            columns.reported_speed[slots] = speed
+
+            changing = (lane == Lane.MERGE_TO_TRAFFIC) | (lane == Lane.TRAFFIC_TO_EXPRESS) \
+                | (lane == Lane.EXPRESS_TO_TRAFFIC)
+            elapsed = self.lane_change_elapsed[slots]
+            finished = changing & (elapsed >= LANE_CHANGE_MS)
+            columns.lane[slots] = np.where(finished, lane_change_targets[lane], lane)
+            self.lane_change_elapsed[slots] = np.where(finished, 0, np.where(changing, elapsed + elapsed_ms, elapsed))
+            columns.last_state_update[slots] = time.time()
+
+    def publish(self, topic: str, payload, qos=0, retain=False):
+        """
+        Receives a command like a vehicle process would, see messageArrived in htcs-vehicle/src/main.c.
+        Messages to any other topic are ignored.
+        """
+        if not topic.startswith(self.command_topic_prefix) or not topic.endswith("/command"):
+            return
+        car_id = topic[len(self.command_topic_prefix):-len("/command")]
+        car = self.cars.get(car_id)
+        if car is None:
+            return
+        command = Command(str(payload)[0])
+        if command == Command.TERMINATE:
+            # the vehicle process exits and leaves the traffic
+            self.cars.pop(car_id)
+        elif command == Command.CHANGE_LANE:
+            if car.lane in lane_after_change_command:
+                car.lane = lane_after_change_command[car.lane]
+        else:
+            car.acceleration_state = acceleration_state_of_command[command]
+
+
+def run_experiment(car_count=50000, simulated_sec=60, seed=0):
+    """
+    Runs the batch controller and the terminator in-process on a simulated fleet, and prints their tick times
+    """
+    import mqtt_connector
+    import htcs_controller
+    import terminator
+    from generator import generate_random_cars
+
+    simulator = TrafficSimulator()
+    simulator.add_cars(generate_random_cars(car_count, seed))
+    mqtt_connector.client_1 = simulator
+    htcs_controller.local_cars = simulator.cars
+    terminator.local_cars = simulator.cars
+    control_times = []
+    terminate_times = []
+    for tick in range(int(simulated_sec * 1000 / simulator.update_interval_ms)):
+        simulator.step()
+        elapsed_ms = tick * simulator.update_interval_ms
+        if elapsed_ms % htcs_controller.INTERVAL_MS == 0:
+            start = time.perf_counter()
+            htcs_controller.control_traffic_batch()
+            control_times.append(time.perf_counter() - start)
+        if elapsed_ms % terminator.INTERVAL_MS == 0:
+            start = time.perf_counter()
+            terminator.terminate_tick()
+            terminate_times.append(time.perf_counter() - start)
+    print(f"{car_count} cars, {simulated_sec} s simulated, {len(simulator.cars.as_dict)} cars left")
+    print(f"controller tick p50: {np.percentile(control_times, 50) * 1000:.2f} ms, "
+          f"p99: {np.percentile(control_times, 99) * 1000:.2f} ms")
+    print(f"terminator tick p50: {np.percentile(terminate_times, 50) * 1000:.2f} ms, "
+          f"p99: {np.percentile(terminate_times, 99) * 1000:.2f} ms")
+
+
+def record_session(path: str, car_count=500, simulated_sec=60, seed=0):
+    """
+    Runs the batch controller and the terminator in-process on a simulated fleet, and saves the states, the specs and
+    the commands of the cars as a timeline, see fleet_timeline.FleetTimeline. The cars leaving the fleet are recorded
+    as terminated.
+    """
+    import mqtt_connector
+    import htcs_controller
+    import terminator
+    from generator import generate_random_cars
+    from fleet_timeline import TimelineRecorder
+
+    simulator = TrafficSimulator()
+    cars = generate_random_cars(car_count, seed)
+    simulator.add_cars(cars)
+    htcs_controller.local_cars = simulator.cars
+    terminator.local_cars = simulator.cars
+    recorder = TimelineRecorder()
+    for car in cars:
+        recorder.set_specs(car.id, car.specs)
+    elapsed_ms = 0
+
+    class RecordingClient:
+        # records the commands on their way to the simulated cars
+        @staticmethod
+        def publish(topic: str, payload, qos=0, retain=False):
+            if topic.startswith(simulator.command_topic_prefix) and topic.endswith("/command"):
+                car_id = topic[len(simulator.command_topic_prefix):-len("/command")]
+                recorder.command(car_id, Command(str(payload)[0]), elapsed_ms / 1000)
+            simulator.publish(topic, payload, qos, retain)
+
+    mqtt_connector.client_1 = RecordingClient()
+    for tick in range(int(simulated_sec * 1000 / simulator.update_interval_ms)):
+        simulator.step()
+        elapsed_ms = tick * simulator.update_interval_ms
+        with simulator.cars.lock:
+            slots = simulator.cars.active_slots()
+            columns = simulator.cars.columns
+            recorder.record(columns.ids[slots], columns.size[slots], columns.lane[slots],
+                            columns.distance_taken[slots], columns.speed[slots], columns.acceleration_state[slots],
+                            elapsed_ms / 1000)
+        present = set(simulator.cars.as_dict)
+        if elapsed_ms % htcs_controller.INTERVAL_MS == 0:
+            htcs_controller.control_traffic_batch()
+        if elapsed_ms % terminator.INTERVAL_MS == 0:
+            terminator.terminate_tick()
+        for car_id in present.difference(simulator.cars.as_dict):
+            recorder.terminate(car_id, elapsed_ms / 1000)
+    timeline = recorder.timeline()
+    timeline.save(path)
+    logger.info(f"{len(timeline)} states of {len(timeline.ids)} cars saved to {path}")
+
+
+if __name__ == "__main__":
+    run_experiment()
@@ -0,0 +1,62 @@
+import ast
+import time
+import numpy as np
+from typing import List, Tuple
+
+STATE_FIELD_COUNT = 4
+SPECS_FIELD_COUNT = 5
+
+
+def decode_state(payload: bytes) -> Tuple[int, float, float, int]:
+    """
+    Parses a state message, see stateToString in htcs-vehicle/src/state.c
+    :param payload: e.g. b"2,1234.5678,33.3333,1"
+    :return: lane, distance taken, speed, acceleration state
+    """
+    lane, distance_taken, speed, acceleration_state = payload.split(b',')
+    return int(lane), float(distance_taken), float(speed), int(acceleration_state)
+
+
+def decode_join(payload: bytes) -> Tuple[Tuple[float, float, float, float, float], Tuple[int, float, float, int]]:
+    """
+    Parses a non-empty join message, see attributesAndStateToString in htcs-vehicle/src/state.c
+    :param payload: e.g. b"33.3333,41.6667,9.2593,13.8889,4.5000|0,0.0000,13.8889,1"
+    :return: specs and state of the car
+    """
+    specs_part, state_part = payload.split(b'|')
+    preferred_speed, max_speed, acceleration, braking_power, size = specs_part.split(b',')
+    specs = (float(preferred_speed), float(max_speed), float(acceleration), float(braking_power), float(size))
+    return specs, decode_state(state_part)
+
+
+def decode_states(payloads: List[bytes]) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Parses many state messages at once
+    :return: arrays of lanes, distances taken, speeds and acceleration states, in the order of the payloads
+    """
+    fields = b','.join(payloads).split(b',') if payloads else []
+    if len(fields) != STATE_FIELD_COUNT * len(payloads):
+        raise ValueError("Every state message has to contain exactly 4 fields")
+    values = np.array(fields, dtype=np.float64).reshape(-1, STATE_FIELD_COUNT)
+    return values[:, 0].astype(np.int8), values[:, 1], values[:, 2], values[:, 3].astype(np.int8)
+
+
+def benchmark(message_count=200000):
+    """
+    Prints the number of state messages parsed per second by ast.literal_eval and by the functions of this module
+    """
+    payloads = [f"{i % 6},{i * 0.37:.4f},{30 + i % 20:.4f},{i % 3}".encode("utf-8") for i in range(message_count)]
+
+    def measure(name, parse):
+        start = time.perf_counter()
+        parse()
+        elapsed = time.perf_counter() - start
+        print(f"{name:<30}{message_count / elapsed:>15,.0f} messages/s")
+
+    measure("ast.literal_eval", lambda: [ast.literal_eval(p.decode("utf-8")) for p in payloads])
+    measure("decode_state", lambda: [decode_state(p) for p in payloads])
+    measure("decode_states (bulk)", lambda: decode_states(payloads))
+
+
+if __name__ == "__main__":
+    benchmark()
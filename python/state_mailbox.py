@@ -0,0 +1,55 @@
+import queue
+import threading
+from typing import Dict, List, Tuple
+from car import Car
+
+JOIN = "join"
+EXIT = "exit"
+# only queued by the ingest workers of mqtt_connector, the mailbox keeps the states apart from the events
+STATE = "state"
+
+
+class StateMailbox:
+    """
+    Buffer between the MQTT callbacks and the consumer of the cars.
+    Only the newest state message of every car is kept until the consumer takes them, the older ones are dropped.
+    Join and exit events are kept in a bounded queue, in the order of arrival, posting blocks when it is full.
+    """
+    def __init__(self, event_capacity=10000):
+        self.lock = threading.Lock()
+        self.latest_payloads: Dict[str, bytes] = {}
+        self.events = queue.Queue(maxsize=event_capacity)
+        # counters since the creation of the mailbox
+        self.received_count = 0
+        self.coalesced_count = 0
+        self.taken_count = 0
+
+    def post_state(self, car_id: str, payload: bytes):
+        with self.lock:
+            self.received_count += 1
+            if car_id in self.latest_payloads:
+                self.coalesced_count += 1
+            self.latest_payloads[car_id] = payload
+
+    def post_join(self, car_id: str, car: Car):
+        self.events.put((JOIN, car_id, car))
+
+    def post_exit(self, car_id: str):
+        self.events.put((EXIT, car_id, None))
+
+    def take(self) -> Tuple[List[Tuple[str, str, Car or None]], Dict[str, bytes]]:
+        """
+        :return: the queued events, and the newest state payload of every car, both emptied from the mailbox
+        """
+        events = []
+        # only the events already queued are taken, so a steady stream can not keep the consumer here
+        for _ in range(self.events.qsize()):
+            try:
+                events.append(self.events.get_nowait())
+            except queue.Empty:
+                break
+        with self.lock:
+            payloads = self.latest_payloads
+            self.latest_payloads = {}
+            self.taken_count += len(payloads)
+        return events, payloads
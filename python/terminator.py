@@ -1,14 +1,29 @@
 import time
+import asyncio
 import logging
-import itertools
+import numpy as np
+import metrics
 import mqtt_connector
-from car import Car, CarManager
-from typing import List
+import async_mqtt_connector
+from car import Car, CarManager, MAX_EXTRAPOLATION_SEC
+from typing import List, Tuple
 from HTCSPythonUtil import config
 
 logger = logging.getLogger(__name__)
 
 INTERVAL_MS = 500
+# estimate the current state of the cars from their last state message, see Car.extrapolated_state
+DEAD_RECKONING = bool(config.get("dead_reckoning"))
+MAX_EXTRAPOLATION_SEC = config.get("max_extrapolation_sec") or MAX_EXTRAPOLATION_SEC
+
+tick_seconds = metrics.histogram("terminator_tick_seconds", "Duration of the terminator iterations")
+tick_budget_ratio = metrics.gauge("terminator_tick_budget_ratio",
+                                  "Duration of the last terminator iteration divided by its interval")
+phase_seconds = {phase: metrics.histogram("terminator_phase_seconds",
+                                          "Duration of the phases of the terminator iterations", phase=phase)
+                 for phase in ["drain", "extrapolate", "snapshot", "sweep", "command"]}
+terminations = {reason: metrics.counter("terminator_terminations_total", "Cars terminated", reason=reason)
+                for reason in ["end_of_road", "collision"]}
 
 
 def check_collision(_c1: Car, _c2: Car):
@@ -19,6 +34,34 @@ def check_collision(_c1: Car, _c2: Car):
         return False
 
 
+def find_collisions(cars: List[Car]) -> List[Tuple[Car, Car]]:
+    """
+    Finds the same pairs as calling check_collision on every pair of cars, with sort and sweep.
+    The cars are sorted by lane, then by distance taken, and every car is only compared with the cars ahead of it
+    in the same lane that are closer than the biggest car, since only those can overlap it.
+    """
+    if len(cars) < 2:
+        return []
+    lane = np.array([int(c.lane) for c in cars])
+    distance = np.array([c.distance_taken for c in cars], dtype=np.float64)
+    size = np.array([c.specs.size for c in cars], dtype=np.float64)
+    order = np.lexsort((distance, lane))
+    lane, distance, size = lane[order], distance[order], size[order]
+    max_size = size.max()
+    collisions = []
+    # compare every car with the one that is 'shift' places ahead of it in the sorted order
+    for shift in range(1, len(cars)):
+        gap = distance[shift:] - distance[:-shift]
+        within_reach = (lane[shift:] == lane[:-shift]) & (gap < max_size)
+        # if no car is within reach at this shift, then no car can be at a greater shift either
+        if not within_reach.any():
+            break
+        # the car ahead overlaps the one behind, if the gap is smaller than the size of the car ahead
+        for i in np.flatnonzero(within_reach & (gap < size[shift:])):
+            collisions.append((cars[order[i]], cars[order[i + shift]]))
+    return collisions
+
+
 def send_terminate(_car_id: str):
     topic = config["base_topic"] + "/" + _car_id + "/command"
     message = 4
@@ -34,29 +77,67 @@ def publish_obituary(_car_id: str):
     logger.debug(f"Obituary published about {_car_id}")
 
 
-if __name__ == "__main__":
-    local_cars = CarManager()
-    mqtt_connector.setup_connector(local_cars)
-
-    # TODO find a better solution, maybe received state flag ?
-    # sleeping for 3 seconds to receive all the join messages and their first state messages
-    logger.info("The terminator is getting ready... 'I'll be back'")
-    time.sleep(3)
-    logger.info("'I'm back'")
-    interval_sec = INTERVAL_MS / 1000
-    while True:
-        time.sleep(interval_sec)
+def terminate_tick():
+    time_start = time.perf_counter()
+    with phase_seconds["drain"].time():
+        mqtt_connector.drain_mailbox()
+    if DEAD_RECKONING:
+        with phase_seconds["extrapolate"].time():
+            local_cars.extrapolate(time.time(), MAX_EXTRAPOLATION_SEC)
 
+    with phase_seconds["snapshot"].time():
         cars: List[Car] = local_cars.get_all()
-        cars_to_be_terminated = set([c.id for c in cars if c.distance_taken >= config["position_bound"]])
-        if len(cars_to_be_terminated) > 0:
-            logger.info(f"Cars reached the end of the road and will be terminated: {cars_to_be_terminated}")
-        for c1, c2 in itertools.combinations(cars, 2):
-            if check_collision(c1, c2):
-                logger.info(f"Collision detected: {c1} - {c2}")
-                cars_to_be_terminated.add(c1.id)
-                cars_to_be_terminated.add(c2.id)
+    cars_to_be_terminated = set([c.id for c in cars if c.distance_taken >= config["position_bound"]])
+    if len(cars_to_be_terminated) > 0:
+        logger.info(f"Cars reached the end of the road and will be terminated: {cars_to_be_terminated}")
+        terminations["end_of_road"].inc(len(cars_to_be_terminated))
+    with phase_seconds["sweep"].time():
+        collisions = find_collisions(cars)
+    for c1, c2 in collisions:
+        logger.info(f"Collision detected: {c1} - {c2}")
+        for car_id in (c1.id, c2.id):
+            if car_id not in cars_to_be_terminated:
+                terminations["collision"].inc()
+                cars_to_be_terminated.add(car_id)
 
+    with phase_seconds["command"].time():
         for car_id in cars_to_be_terminated:
             publish_obituary(car_id)
             send_terminate(car_id)
+    elapsed_sec = time.perf_counter() - time_start
+    tick_seconds.record(elapsed_sec)
+    tick_budget_ratio.set(elapsed_sec / (INTERVAL_MS / 1000))
+
+
+async def run_async():
+    await async_mqtt_connector.setup_connector(local_cars)
+    logger.info("The terminator is getting ready... 'I'll be back'")
+    await asyncio.sleep(3)
+    logger.info("'I'm back'")
+    await async_mqtt_connector.run_periodically(terminate_tick, INTERVAL_MS / 1000,
+                                                "Terminator is falling behind, it has no time to sleep!")
+
+
+if __name__ == "__main__":
+    local_cars = CarManager()
+    metrics.start_exporter("terminator")
+    if config.get("asyncio_connector"):
+        asyncio.run(run_async())
+    else:
+        mqtt_connector.setup_connector(local_cars)
+
+        # TODO find a better solution, maybe received state flag ?
+        # sleeping for 3 seconds to receive all the join messages and their first state messages
+        logger.info("The terminator is getting ready... 'I'll be back'")
+        time.sleep(3)
+        logger.info("'I'm back'")
+        interval_sec = INTERVAL_MS / 1000
+        while True:
+            time_start = time.time()
+            terminate_tick()
+            logger.debug(f"terminating took {time.time() - time_start} seconds")
+            remaining_sec = time_start + interval_sec - time.time()
+            if remaining_sec <= 0:
+                logger.warning("Terminator is falling behind, it has no time to sleep!")
+            else:
+                time.sleep(remaining_sec)
@@ -0,0 +1,220 @@
+import time
+import logging
+import argparse
+import numpy as np
+from typing import Dict, List, Tuple
+import recorder
+import state_codec
+from car import Lane, Command
+from fleet_store import effective_lane_table
+from batch_controller import follow_distance
+from fleet_timeline import FleetTimeline
+
+logger = logging.getLogger(__name__)
+
+# the speed of a car is below its preferred speed, if it is lower by more than this ratio
+SPEED_DEFICIT_TOLERANCE = 0.05
+command_values = [int(command.value) for command in Command]
+
+
+def timeline_of_session(directory: str) -> FleetTimeline:
+    """
+    Converts a session recorded by the recorder into a timeline: a row for every state message and every join,
+    the specs of the cars from their join messages, the commands sent to them and the time of their obituaries.
+    The state messages are collected and parsed at once, see state_codec.decode_states.
+    """
+    index_of_id: Dict[str, int] = {}
+    specs: Dict[int, Tuple[float, float, float, float, float]] = {}
+    terminated_at: Dict[int, float] = {}
+    state_cars: List[int] = []
+    state_times: List[float] = []
+    state_payloads: List[bytes] = []
+    commands: List[Tuple[int, float, int]] = []
+    for at, kind, car_id, payload in recorder.SessionReplayer(directory).records():
+        car = index_of_id.setdefault(car_id, len(index_of_id))
+        if kind == recorder.STATE:
+            state_cars.append(car)
+            state_times.append(at)
+            state_payloads.append(payload)
+        elif kind == recorder.JOIN and payload:
+            car_specs, _ = state_codec.decode_join(payload)
+            specs[car] = car_specs
+            # the state of the join message is the first state of the car
+            state_cars.append(car)
+            state_times.append(at)
+            state_payloads.append(payload.split(b'|')[1])
+        elif kind == recorder.COMMAND and payload:
+            commands.append((car, at, int(payload[:1])))
+        elif kind == recorder.OBITUARY:
+            terminated_at.setdefault(car, at)
+    lane, distance_taken, speed, acceleration_state = state_codec.decode_states(state_payloads)
+    columns = {"car": np.array(state_cars, dtype=np.int32), "time": np.array(state_times), "lane": lane,
+               "distance_taken": distance_taken, "speed": speed, "acceleration_state": acceleration_state}
+    car_count = len(index_of_id)
+    columns["terminated_at"] = np.full(car_count, np.nan)
+    columns["terminated_at"][list(terminated_at)] = list(terminated_at.values())
+    for field, name in enumerate(["preferred_speed", "max_speed", "acceleration", "braking_power", "size"]):
+        columns[name] = np.full(car_count, np.nan)
+        columns[name][list(specs)] = [car_specs[field] for car_specs in specs.values()]
+    for name, values in zip(["command_car", "command_time", "command"], zip(*commands) if commands else [(), (), ()]):
+        columns[name] = np.array(values)
+    ids = [None] * car_count
+    for car_id, car in index_of_id.items():
+        ids[car] = car_id
+    return FleetTimeline(ids, columns)
+
+
+def time_bins_of(timeline: FleetTimeline, interval_sec: float) -> np.ndarray:
+    return ((timeline.time - timeline.start) // interval_sec).astype(np.int64)
+
+
+def lane_occupancy(timeline: FleetTimeline, interval_sec=1.0) -> np.ndarray:
+    """
+    :return: the number of cars reporting a state in every lane during every interval,
+    a row for every interval from the start of the session and a column for every lane
+    """
+    bins = time_bins_of(timeline, interval_sec)
+    bin_count = int(bins.max()) + 1 if len(bins) > 0 else 0
+    lane_count = len(Lane)
+    # a car is counted once per interval and lane, however many states it reported there
+    keys = np.unique((bins * lane_count + timeline.lane) * len(timeline.ids) + timeline.car)
+    return np.bincount(keys // len(timeline.ids), minlength=bin_count * lane_count).reshape(bin_count, lane_count)
+
+
+def speed_deficits(timeline: FleetTimeline, tolerance=SPEED_DEFICIT_TOLERANCE) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    :return: the mean of the speed missing to the preferred speed of every car over its states, in m/s,
+    and the ratio of its states below its preferred speed by more than the tolerance, nan for the cars without specs
+    or states
+    """
+    preferred_speed = timeline.preferred_speed[timeline.car]
+    deficit = np.maximum(preferred_speed - timeline.speed, 0.0)
+    below = timeline.speed < preferred_speed * (1 - tolerance)
+    state_counts = np.bincount(timeline.car, minlength=len(timeline.ids))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean_deficit = np.bincount(timeline.car, weights=deficit, minlength=len(timeline.ids)) / state_counts
+        below_ratio = np.bincount(timeline.car, weights=below, minlength=len(timeline.ids)) / state_counts
+    unknown = np.isnan(timeline.preferred_speed)
+    return np.where(unknown, np.nan, mean_deficit), np.where(unknown, np.nan, below_ratio)
+
+
+def first_rows_where(timeline: FleetTimeline, condition: np.ndarray) -> np.ndarray:
+    """
+    :return: the first row of every car, where the condition holds, or -1
+    """
+    rows = np.where(condition, np.arange(len(timeline)), len(timeline))
+    first = np.full(len(timeline.ids), len(timeline))
+    has_states = timeline.car_rows[1:] > timeline.car_rows[:-1]
+    first[has_states] = np.minimum.reduceat(rows, timeline.car_rows[:-1][has_states]) if len(rows) > 0 else []
+    return np.where(first < len(timeline), first, -1)
+
+
+def merge_wait_times(timeline: FleetTimeline) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    :return: the seconds every car spent in the merge lane from its first state until it started merging into the
+    traffic, nan for the cars, which did not start in the merge lane, and whether the car merged at all,
+    the time of the cars, which did not merge, lasts until their last state
+    """
+    first_rows = timeline.car_rows[:-1]
+    has_states = timeline.car_rows[1:] > first_rows
+    started_merging = np.zeros(len(timeline.ids), dtype=bool)
+    started_merging[has_states] = timeline.lane[first_rows[has_states]] == Lane.MERGE_LANE
+    left_rows = first_rows_where(timeline, timeline.lane != Lane.MERGE_LANE)
+    merged = started_merging & (left_rows >= 0)
+    end_rows = np.where(merged, left_rows, timeline.car_rows[1:] - 1)
+    wait_sec = np.full(len(timeline.ids), np.nan)
+    wait_sec[started_merging] = timeline.time[end_rows[started_merging]] - timeline.time[first_rows[started_merging]]
+    return wait_sec, merged
+
+
+def command_rates(timeline: FleetTimeline) -> np.ndarray:
+    """
+    :return: the commands per second sent to every car while it reported its states, a row for every car and
+    a column for every command, in the order of car.Command, nan for the cars with less than two states
+    """
+    command_count = len(command_values)
+    column = np.searchsorted(command_values, timeline.command)
+    counts = np.bincount(timeline.command_car * command_count + column,
+                         minlength=len(timeline.ids) * command_count).reshape(len(timeline.ids), command_count)
+    has_states = timeline.car_rows[1:] > timeline.car_rows[:-1]
+    duration_sec = np.full(len(timeline.ids), np.nan)
+    duration_sec[has_states] = timeline.time[timeline.car_rows[1:][has_states] - 1] \
+        - timeline.time[timeline.car_rows[:-1][has_states]]
+    # no rate for the cars with a single state
+    duration_sec[duration_sec <= 0] = np.nan
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return counts / duration_sec[:, None]
+
+
+def near_misses(timeline: FleetTimeline, interval_sec=0.1, safety_factor=1.0) -> Dict[str, np.ndarray]:
+    """
+    Finds the cars closer to the car ahead of them in the same effective lane than their follow distance,
+    see Car.follow_distance, at the last state of every car in every interval
+    :return: columns of the near misses: the time of the interval, the car behind, the car ahead, the gap between them
+    and the follow distance of the car behind
+    """
+    bins = time_bins_of(timeline, interval_sec)
+    # the last state of every car in every interval, the rows of a car are ordered by time
+    last_in_bin = np.ones(len(timeline), dtype=bool)
+    last_in_bin[:-1] = (timeline.car[1:] != timeline.car[:-1]) | (bins[1:] != bins[:-1])
+    rows = np.flatnonzero(last_in_bin)
+    lanes = effective_lane_table[timeline.lane[rows]]
+    rows = rows[np.lexsort((timeline.distance_taken[rows], lanes, bins[rows]))]
+    lanes = effective_lane_table[timeline.lane[rows]]
+    behind, ahead = rows[:-1], rows[1:]
+    same_road = (bins[behind] == bins[ahead]) & (lanes[:-1] == lanes[1:])
+    behind, ahead = behind[same_road], ahead[same_road]
+    gap = timeline.distance_taken[ahead] - timeline.distance_taken[behind]
+    distance = follow_distance(timeline.speed[behind], timeline.braking_power[timeline.car[behind]], safety_factor)
+    near = gap < distance
+    behind, ahead = behind[near], ahead[near]
+    return {"time": timeline.start + bins[behind] * interval_sec, "car_behind": timeline.car[behind],
+            "car_ahead": timeline.car[ahead], "gap": gap[near], "follow_distance": distance[near]}
+
+
+def mean_of(values: np.ndarray) -> float:
+    # nan without a warning, if no value is finite
+    known = values[np.isfinite(values)]
+    return float(known.mean()) if len(known) > 0 else np.nan
+
+
+def report(timeline: FleetTimeline):
+    """
+    Logs a summary of the analytics of the timeline
+    """
+    start = time.perf_counter()
+    occupancy = lane_occupancy(timeline)
+    mean_deficit, below_ratio = speed_deficits(timeline)
+    wait_sec, merged = merge_wait_times(timeline)
+    rates = command_rates(timeline)
+    misses = near_misses(timeline)
+    elapsed_sec = time.perf_counter() - start
+    logger.info(f"{len(timeline)} states of {len(timeline.ids)} cars over {timeline.end - timeline.start:.1f} s, "
+                f"analysed in {elapsed_sec:.2f} s")
+    for lane in Lane:
+        logger.info(f"{lane.name}: {occupancy[:, lane].mean() if len(occupancy) else 0:.1f} cars on average, "
+                    f"{occupancy[:, lane].max(initial=0)} at most")
+    logger.info(f"Speed deficit: {mean_of(mean_deficit):.2f} m/s on average, "
+                f"{mean_of(below_ratio) * 100:.1f}% of the states below the preferred speed")
+    logger.info(f"Merge wait: {np.count_nonzero(merged)} cars merged after "
+                f"{np.median(wait_sec[merged]) if merged.any() else np.nan:.1f} s (median), "
+                f"{np.count_nonzero(~np.isnan(wait_sec) & ~merged)} did not merge")
+    for command, column in zip(Command, rates.T):
+        logger.info(f"{command.name}: {mean_of(column):.3f} commands per second per car")
+    logger.info(f"{len(misses['time'])} near misses of {len(np.unique(misses['car_behind']))} cars")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Converts a recorded session into a timeline and analyses it")
+    parser.add_argument("session", help="directory of a recorded session, or a saved timeline (.npz or directory)")
+    parser.add_argument("--export", help="saves the timeline to this .npz file or directory of .npy files")
+    args = parser.parse_args()
+
+    if recorder.segment_paths(args.session):
+        session_timeline = timeline_of_session(args.session)
+    else:
+        session_timeline = FleetTimeline.load(args.session)
+    if args.export:
+        session_timeline.save(args.export)
+        logger.info(f"Timeline saved to {args.export}")
+    report(session_timeline)
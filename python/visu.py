@@ -1,32 +1,57 @@
 import cv2
 import time
+import asyncio
 import logging
+import threading
 import numpy as np
+import metrics
 import mqtt_connector
+import async_mqtt_connector
 import visu_res as vis
+from HTCSPythonUtil import config
 from htcs_controller import give_command
-from car import DetailedCarTracker, AccelerationState, Command, Lane
+from fleet_snapshot import FrameSnapshot, SnapshotBuffer, read_only
+from minimap_layer import MinimapLayer
+from car import DetailedCarTracker, AccelerationState, Command, Lane, MAX_EXTRAPOLATION_SEC
 
 logger = logging.getLogger(__name__)
+# estimate the current state of the cars from their last state message, see Car.extrapolated_state
+DEAD_RECKONING = bool(config.get("dead_reckoning"))
+MAX_EXTRAPOLATION_SEC = config.get("max_extrapolation_sec") or MAX_EXTRAPOLATION_SEC
+# snapshots of the fleet are taken at SNAPSHOT_RATE_HZ, frames are rendered from them at TARGET_FPS by another thread
+SNAPSHOT_RATE_HZ = config.get("snapshot_rate_hz") or 20
+TARGET_FPS = config.get("visu_fps") or 60
+# the frames show the cars this many seconds in the past, so their positions fall between two state messages
+RENDER_DELAY_SEC = config.get("render_delay_sec") or 0.1
+# above this many cars the minimap shows the density of the cars instead of a dot for every car
+MINIMAP_DENSITY_FLEET_SIZE = config.get("minimap_density_fleet_size") or 2000
+snapshots = SnapshotBuffer()
+# held while the view variables are changed by the user or read by the render thread
+view_lock = threading.Lock()
 # view-dependent variables
 offset_meter = 0
 region_width_meter = vis.region_width_meter_start
 offset_minimap_pixel = int(offset_meter * vis.x_scale_minimap)
 region_width_minimap_pixel = int(region_width_meter * vis.x_scale_minimap)
-offset_bigmap_pixel = int(offset_meter * vis.x_scale_bigmap)
-region_width_bigmap_pixel = int(region_width_meter * vis.x_scale_bigmap)
+vis.sprite_cache.set_region_width(region_width_meter)
 current_detail_height = vis.detail_height
 minimap_point_size = int(4 * vis.window_width / 2000)
+minimap_layer = MinimapLayer(vis.lane_centers_mini, vis.minimap_length_pixel, vis.minimap_height_pixel,
+                             minimap_point_size, MINIMAP_DENSITY_FLEET_SIZE)
 # navigation variables
-focused_car: vis.CarImage or None
-x_slice_focused: slice
-image_focused: np.ndarray
+focused_car_id: str or None = None
 is_dragging = False
 drag_start_x = 0
 drag_start_offset = 0
 # text management
 text_size = 1 / (3000 / vis.window_width)
 text_pixel_height = int(33 * text_size)
+# metrics
+frame_seconds = metrics.histogram("visu_frame_seconds", "Duration of rendering a frame")
+frames_per_second = metrics.gauge("visu_frames_per_second", "Frame rate based on the duration of the last frame")
+phase_seconds = {phase: metrics.histogram("visu_phase_seconds", "Duration of the phases of drawing a frame",
+                                          phase=phase)
+                 for phase in ["drain", "snapshot", "compose", "show"]}
 # some info
 logger.info(f"Full length of the map is {vis.map_length_meter} m.")
 logger.info(f"Current visible region is {vis.region_width_meter_start} m wide.")
@@ -34,7 +59,12 @@ logger.info(f"Press <w> key to zoom in, press <s> key to zoom out.")
 
 
 def minimap_move(event, x, y, flags, param):
-    global offset_minimap_pixel, drag_start_x, drag_start_offset, is_dragging, offset_meter, offset_bigmap_pixel
+    with view_lock:
+        handle_mouse(event, x, y)
+
+
+def handle_mouse(event, x, y):
+    global offset_minimap_pixel, drag_start_x, drag_start_offset, is_dragging, offset_meter
     if event == cv2.EVENT_LBUTTONDOWN:
         set_clicked_car(x, y)
         if offset_minimap_pixel <= x <= offset_minimap_pixel + region_width_minimap_pixel \
@@ -46,41 +76,50 @@ def minimap_move(event, x, y, flags, param):
         offset_minimap_pixel = max(0, min(drag_start_offset + x - drag_start_x,
                                           vis.minimap_length_pixel - region_width_minimap_pixel))
         offset_meter = offset_minimap_pixel / vis.x_scale_minimap
-        offset_bigmap_pixel = int(offset_meter * vis.x_scale_bigmap)
     elif event == cv2.EVENT_LBUTTONUP:
         is_dragging = False
     # elif event == cv2.EVENT_MOUSEWHEEL:
     #     print(param)
 
 
+def set_offset(meter: float):
+    global offset_meter, offset_minimap_pixel
+    offset_meter = max(0, min(meter, vis.map_length_meter - region_width_meter))
+    offset_minimap_pixel = int(offset_meter * vis.x_scale_minimap)
+
+
+def set_region_width(width_meter: float):
+    global region_width_meter
+    region_width_meter = max(10, min(vis.map_length_meter, width_meter))
+    update_zoom()
+
+
 def update_zoom():
-    global current_detail_height, offset_minimap_pixel, offset_bigmap_pixel, offset_meter, region_width_meter, region_width_minimap_pixel, region_width_bigmap_pixel
-    current_detail_height = int(vis.window_width * vis.map_height_meter / region_width_meter)
+    global current_detail_height, offset_minimap_pixel, offset_meter, region_width_meter, region_width_minimap_pixel
+    current_detail_height = vis.detail_height_of(region_width_meter)
     if offset_meter + region_width_meter >= vis.map_length_meter:
         offset_meter -= offset_meter + region_width_meter - vis.map_length_meter
         offset_minimap_pixel = int(offset_meter * vis.x_scale_minimap)
-        offset_bigmap_pixel = int(offset_meter * vis.x_scale_bigmap)
     region_width_minimap_pixel = int(region_width_meter * vis.x_scale_minimap)
-    region_width_bigmap_pixel = int(region_width_meter * vis.x_scale_bigmap)
+    vis.sprite_cache.set_region_width(region_width_meter)
 
 
 def set_clicked_car(x_click, y_click):
-    global focused_car
-    if y_click < vis.minimap_height_pixel + vis.black_region_height:
-        if focused_car is not None:
-            focused_car = None
+    global focused_car_id
+    snapshot = snapshots.take()
+    if y_click < vis.minimap_height_pixel + vis.black_region_height or snapshot is None:
+        focused_car_id = None
         return
     y_real = (y_click - vis.minimap_height_pixel - vis.black_region_height) / \
         current_detail_height * vis.detail_height
     x_meter = x_click / vis.window_width * region_width_meter + offset_meter
-    for c in local_cars.get_all():
-        if c.is_in_region(offset_meter, region_width_meter):
-            y_slice: slice = c.get_y_slice()
-            if y_slice.start - 15 < y_real < y_slice.stop + 15:
-                if c.distance_taken - c.specs.size - 10 < x_meter < c.distance_taken + 10:
-                    focused_car = c
-                    return
-    focused_car = None
+    # the lanes near the click, and the cars near the click in the visible region, where they are drawn
+    lanes = [lane for lane in range(len(vis.lane_centers))
+             if vis.y_slice_of(lane).start - 15 < y_real < vis.y_slice_of(lane).stop + 15]
+    rows, _ = snapshot.rows_overlapping(max(x_meter - 10, offset_meter),
+                                        min(x_meter + 10, offset_meter + region_width_meter),
+                                        time.time() - RENDER_DELAY_SEC, lanes)
+    focused_car_id = snapshot.ids[rows[0]] if len(rows) > 0 else None
 
 
 def on_terminate(client, userdata, message):
@@ -91,167 +130,339 @@ def on_terminate(client, userdata, message):
         _car.exploded = True
 
 
-def follow_with_camera():
-    global focused_car, x_slice_focused, image_focused, offset_meter, offset_minimap_pixel, offset_bigmap_pixel
-    if focused_car is not None:
-        if focused_car.distance_taken + region_width_meter / 2 > vis.map_length_meter - 5 \
-                or focused_car.exploded:
-            focused_car = None
+def follow_with_camera(snapshot: FrameSnapshot, distance_taken: np.ndarray):
+    global focused_car_id, offset_meter, offset_minimap_pixel
+    if focused_car_id is not None:
+        row = snapshot.row_of_id.get(focused_car_id)
+        if row is None or distance_taken[row] + region_width_meter / 2 > vis.map_length_meter - 5 \
+                or snapshot.appearance[row][EXPLODED]:
+            focused_car_id = None
         else:
-            offset_meter = max(0, focused_car.distance_taken - region_width_meter / 2)
-            x_slice_focused, image_focused = focused_car.get_x_slice_and_image(offset_meter, region_width_meter)
+            offset_meter = max(0, distance_taken[row] - region_width_meter / 2)
             offset_minimap_pixel = int(offset_meter * vis.x_scale_minimap)
-            offset_bigmap_pixel = int(offset_meter * vis.x_scale_bigmap)
 
 
-def put_on_title():
+def put_on_title(image: np.ndarray):
     # put title in cone
-    canvas[vis.minimap_height_pixel: vis.minimap_height_pixel + vis.black_region_height, :, :] = vis.title
-    cv2.fillConvexPoly(canvas, np.int32(((0, vis.minimap_height_pixel),
+    image[vis.minimap_height_pixel: vis.minimap_height_pixel + vis.black_region_height, :, :] = vis.title
+    cv2.fillConvexPoly(image, np.int32(((0, vis.minimap_height_pixel),
                                          (0, vis.minimap_height_pixel + vis.black_region_height),
                                          (offset_minimap_pixel, vis.minimap_height_pixel))), (0, 0, 0))
-    cv2.fillConvexPoly(canvas, np.int32(((offset_minimap_pixel + region_width_minimap_pixel, vis.minimap_height_pixel),
+    cv2.fillConvexPoly(image, np.int32(((offset_minimap_pixel + region_width_minimap_pixel, vis.minimap_height_pixel),
                                          (vis.window_width, vis.minimap_height_pixel + vis.black_region_height),
                                          (vis.window_width, vis.minimap_height_pixel))), (0, 0, 0))
 
 
-def set_minimap():
+def set_minimap(image: np.ndarray):
     # gray out
-    canvas[:vis.minimap_height_pixel, : offset_minimap_pixel, :] = \
-        (vis.im_minimap[:, : offset_minimap_pixel, :] * 0.6).astype(np.int32)
-    canvas[:vis.minimap_height_pixel, offset_minimap_pixel + region_width_minimap_pixel:, :] = \
-        (vis.im_minimap[:, offset_minimap_pixel + region_width_minimap_pixel:, :] * 0.6).astype(np.int32)
+    image[:vis.minimap_height_pixel, : offset_minimap_pixel, :] = vis.im_minimap_dimmed[:, : offset_minimap_pixel, :]
+    image[:vis.minimap_height_pixel, offset_minimap_pixel + region_width_minimap_pixel:, :] = \
+        vis.im_minimap_dimmed[:, offset_minimap_pixel + region_width_minimap_pixel:, :]
     # zoom in
-    canvas[:vis.minimap_height_pixel, offset_minimap_pixel: offset_minimap_pixel + region_width_minimap_pixel, :] = \
-        cv2.resize(vis.im_minimap[int(vis.minimap_height_pixel * 0.05): int(vis.minimap_height_pixel * 0.94),
-                   offset_minimap_pixel: offset_minimap_pixel + region_width_minimap_pixel, :],
-                   (region_width_minimap_pixel, vis.minimap_height_pixel))
+    cv2.resize(vis.im_minimap[int(vis.minimap_height_pixel * 0.05): int(vis.minimap_height_pixel * 0.94),
+               offset_minimap_pixel: offset_minimap_pixel + region_width_minimap_pixel, :],
+               (region_width_minimap_pixel, vis.minimap_height_pixel),
+               dst=image[:vis.minimap_height_pixel,
+                         offset_minimap_pixel: offset_minimap_pixel + region_width_minimap_pixel, :])
 
 
-def draw_orange_lines():
-    cv2.line(canvas,
+def draw_orange_lines(image: np.ndarray):
+    cv2.line(image,
              (offset_minimap_pixel, 0),
              (offset_minimap_pixel, vis.minimap_height_pixel),
              (0, 211, 255),
              3)
-    cv2.line(canvas,
+    cv2.line(image,
              (offset_minimap_pixel + region_width_minimap_pixel, 0),
              (offset_minimap_pixel + region_width_minimap_pixel, vis.minimap_height_pixel),
              (0, 211, 255),
              3)
-    cv2.line(canvas,
+    cv2.line(image,
              (offset_minimap_pixel, vis.minimap_height_pixel),
              (0, vis.minimap_height_pixel + vis.black_region_height),
              (0, 211, 255),
              3)
-    cv2.line(canvas,
+    cv2.line(image,
              (offset_minimap_pixel + region_width_minimap_pixel, vis.minimap_height_pixel),
              (vis.window_width, vis.minimap_height_pixel + vis.black_region_height),
              (0, 211, 255),
              3)
 
 
-def put_on_focused_car_stats():
+def get_focused_car_stats(focused_car: vis.CarImage):
+    """
+    :return: the texts shown about the focused car, with their column, row and color,
+    it queries the neighbours of the car, so it is called when the snapshot is taken
+    """
     text_c = focused_car.text_color
-    row_1_y = canvas.shape[0] - 5 - 3 * text_pixel_height
-    row_2_y = canvas.shape[0] - 5 - 2 * text_pixel_height
-    row_3_y = canvas.shape[0] - 5 - 1 * text_pixel_height
-    row_4_y = canvas.shape[0] - 5
-    cv2.putText(canvas, f"id={focused_car.id}", (5, row_1_y), cv2.FONT_HERSHEY_SIMPLEX, text_size, text_c, 2)
-    speed_col_x = 5 + int(canvas.shape[1] * 0.07)
-    cv2.putText(canvas, f"speed={focused_car.speed} [m/s]", (speed_col_x, row_2_y), cv2.FONT_HERSHEY_SIMPLEX, text_size, text_c, 2)
-    cv2.putText(canvas, f"prefSpeed={focused_car.specs.preferred_speed}", (speed_col_x, row_3_y), cv2.FONT_HERSHEY_SIMPLEX, text_size, text_c, 2)
-    cv2.putText(canvas, f"maxSpeed={focused_car.specs.max_speed}", (speed_col_x, row_4_y), cv2.FONT_HERSHEY_SIMPLEX, text_size, text_c, 2)
-    acc_col_x = 5 + int(canvas.shape[1] * 0.21)
-    cv2.putText(canvas, f"accState={AccelerationState(focused_car.acceleration_state).name}", (acc_col_x, row_1_y), cv2.FONT_HERSHEY_SIMPLEX, text_size, text_c, 2)
-    cv2.putText(canvas, f"followDist={focused_car.follow_distance()}", (acc_col_x, row_2_y), cv2.FONT_HERSHEY_SIMPLEX, text_size, text_c, 2)
-    cv2.putText(canvas, f"brakePower={focused_car.specs.braking_power} [m/s^2]", (acc_col_x, row_3_y), cv2.FONT_HERSHEY_SIMPLEX, text_size, text_c, 2)
-    cv2.putText(canvas, f"acceleration={focused_car.specs.acceleration} [m/s^2]", (acc_col_x, row_4_y), cv2.FONT_HERSHEY_SIMPLEX, text_size, text_c, 2)
-    lane_desc_x = 5 + int(canvas.shape[1] * 0.40)
-    cv2.putText(canvas, f"eff.express", (lane_desc_x, row_2_y), cv2.FONT_HERSHEY_SIMPLEX, text_size, (255, 255, 255), 2)
-    cv2.putText(canvas, f"eff.traffic", (lane_desc_x, row_3_y), cv2.FONT_HERSHEY_SIMPLEX, text_size, (255, 255, 255), 2)
-    cv2.putText(canvas, f"eff.merge", (lane_desc_x, row_4_y), cv2.FONT_HERSHEY_SIMPLEX, text_size, (255, 255, 255), 2)
-    lane_behind_x = 5 + int(canvas.shape[1] * 0.47)
-    d_e = focused_car.signed_distance_between(local_cars.car_directly_behind_in_effective_lane(focused_car, Lane.EXPRESS_LANE))
-    d_t = focused_car.signed_distance_between(local_cars.car_directly_behind_in_effective_lane(focused_car, Lane.TRAFFIC_LANE))
-    d_m = focused_car.signed_distance_between(local_cars.car_directly_behind_in_effective_lane(focused_car, Lane.MERGE_LANE))
-    cv2.putText(canvas, f"dist. behind={np.floor(d_e)}", (lane_behind_x, row_2_y), cv2.FONT_HERSHEY_SIMPLEX, text_size, text_c, 2)
-    cv2.putText(canvas, f"dist. behind={np.floor(d_t)}", (lane_behind_x, row_3_y), cv2.FONT_HERSHEY_SIMPLEX, text_size, text_c, 2)
-    cv2.putText(canvas, f"dist. behind={np.floor(d_m)}", (lane_behind_x, row_4_y), cv2.FONT_HERSHEY_SIMPLEX, text_size, text_c, 2)
-    lane_ahead_x = 5 + int(canvas.shape[1] * 0.60)
-    d_e = focused_car.signed_distance_between(local_cars.car_directly_ahead_in_effective_lane(focused_car, Lane.EXPRESS_LANE))
-    d_t = focused_car.signed_distance_between(local_cars.car_directly_ahead_in_effective_lane(focused_car, Lane.TRAFFIC_LANE))
-    d_m = focused_car.signed_distance_between(local_cars.car_directly_ahead_in_effective_lane(focused_car, Lane.MERGE_LANE))
-    cv2.putText(canvas, f"dist. ahead={np.floor(d_e)}", (lane_ahead_x, row_2_y), cv2.FONT_HERSHEY_SIMPLEX, text_size, text_c, 2)
-    cv2.putText(canvas, f"dist. ahead={np.floor(d_t)}", (lane_ahead_x, row_3_y), cv2.FONT_HERSHEY_SIMPLEX, text_size, text_c, 2)
-    cv2.putText(canvas, f"dist. ahead={np.floor(d_m)}", (lane_ahead_x, row_4_y), cv2.FONT_HERSHEY_SIMPLEX, text_size, text_c, 2)
-    can_x = 5 + int(canvas.shape[1] * 0.75)
-    cv2.putText(canvas, f"can overtake={local_cars.can_overtake(focused_car)}", (can_x, row_2_y), cv2.FONT_HERSHEY_SIMPLEX, text_size, text_c, 2)
-    cv2.putText(canvas, f"can return={local_cars.can_return_to_traffic_lane(focused_car)}", (can_x, row_3_y), cv2.FONT_HERSHEY_SIMPLEX, text_size, text_c, 2)
-    cv2.putText(canvas, f"can merge in={local_cars.can_merge_in(focused_car)}", (can_x, row_4_y), cv2.FONT_HERSHEY_SIMPLEX, text_size, text_c, 2)
+    white = (255, 255, 255)
+    stats = [(f"id={focused_car.id}", 0.0, 1, text_c),
+             (f"speed={focused_car.speed} [m/s]", 0.07, 2, text_c),
+             (f"prefSpeed={focused_car.specs.preferred_speed}", 0.07, 3, text_c),
+             (f"maxSpeed={focused_car.specs.max_speed}", 0.07, 4, text_c),
+             (f"accState={AccelerationState(focused_car.acceleration_state).name}", 0.21, 1, text_c),
+             (f"followDist={focused_car.follow_distance()}", 0.21, 2, text_c),
+             (f"brakePower={focused_car.specs.braking_power} [m/s^2]", 0.21, 3, text_c),
+             (f"acceleration={focused_car.specs.acceleration} [m/s^2]", 0.21, 4, text_c),
+             ("eff.express", 0.40, 2, white),
+             ("eff.traffic", 0.40, 3, white),
+             ("eff.merge", 0.40, 4, white)]
+    for row, lane in [(2, Lane.EXPRESS_LANE), (3, Lane.TRAFFIC_LANE), (4, Lane.MERGE_LANE)]:
+        d = focused_car.signed_distance_between(local_cars.car_directly_behind_in_effective_lane(focused_car, lane))
+        stats.append((f"dist. behind={np.floor(d)}", 0.47, row, text_c))
+    for row, lane in [(2, Lane.EXPRESS_LANE), (3, Lane.TRAFFIC_LANE), (4, Lane.MERGE_LANE)]:
+        d = focused_car.signed_distance_between(local_cars.car_directly_ahead_in_effective_lane(focused_car, lane))
+        stats.append((f"dist. ahead={np.floor(d)}", 0.60, row, text_c))
+    stats.append((f"can overtake={local_cars.can_overtake(focused_car)}", 0.75, 2, text_c))
+    stats.append((f"can return={local_cars.can_return_to_traffic_lane(focused_car)}", 0.75, 3, text_c))
+    stats.append((f"can merge in={local_cars.can_merge_in(focused_car)}", 0.75, 4, text_c))
+    return tuple(stats)
+
+
+def put_on_focused_car_stats(stats):
+    for text, column, row, color in stats:
+        x = 5 + int(canvas.shape[1] * column)
+        y = canvas.shape[0] - 5 - (4 - row) * text_pixel_height
+        cv2.putText(canvas, text, (x, y), cv2.FONT_HERSHEY_SIMPLEX, text_size, color, 2)
+
+
+# the appearance of the cars in the snapshots
+SPRITE_KIND, COLOR, EXPLODED = range(3)
+
+
+def appearance_of(car: vis.CarImage):
+    return car.sprite_kind, car.color, car.exploded
+
+
+def take_snapshot(previous: FrameSnapshot = None) -> FrameSnapshot:
+    focused_car = local_cars.get(focused_car_id) if focused_car_id is not None else None
+    extras = {}
+    if focused_car is not None:
+        extras["focused_car_stats"] = get_focused_car_stats(focused_car)
+    # without a mailbox the state messages are applied to the cars by the connector's threads under the tracker lock,
+    # so the cars are read under the lock too, and every car is taken from a single state message;
+    # full_list is read directly, since get_all would take the lock again
+    taken_at = time.time()
+    # the snapshot interpolates between the reported states itself, the extrapolated state is only used for the cars
+    # with a single state, and it is not written back, so the tracker does not have to be sorted again
+    state_of = (lambda car: car.extrapolated_state(taken_at, MAX_EXTRAPOLATION_SEC)) if DEAD_RECKONING else None
+    with local_cars.lock:
+        cars = local_cars.full_list
+        extras["minimap_colors"] = read_only(np.array([car.color for car in cars], dtype=np.uint8).reshape(-1, 3))
+        return FrameSnapshot.of(cars, taken_at, previous, appearance_of, extras, state_of)
+
+
+def publish_snapshot():
+    """
+    Applies the received messages to the cars and publishes a new snapshot of them for the render thread
+    """
+    with phase_seconds["drain"].time():
+        mqtt_connector.drain_mailbox()
+    with phase_seconds["snapshot"].time():
+        snapshots.publish(take_snapshot(snapshots.take()))
+
+
+class FrameCompositor:
+    """
+    Keeps the images of the frame between iterations, so composing a frame allocates no images.
+    The layers depending only on the camera, the minimap with the title and the visible part of the map,
+    are redrawn only when the offset or the zoom changes, otherwise they are copied into the frame.
+    The visible part of the map is drawn at the current detail height from the map pyramid, and the cars are drawn
+    at the same scale, so the frame is not resized.
+    """
+    def __init__(self):
+        self.header_height = vis.minimap_height_pixel + vis.black_region_height
+        self.header = np.zeros((self.header_height, vis.window_width, 3), np.uint8)
+        self.header_key = None
+        self.map_layer = np.zeros((0, vis.window_width, 3), np.uint8)
+        self.map_key = None
+        # double buffered: a frame is drawn into the back canvas, while the front canvas is shown
+        self.canvases = [np.zeros((0, vis.window_width, 3), np.uint8), np.zeros((0, vis.window_width, 3), np.uint8)]
+        self.back = 0
+        self.frame_lock = threading.Lock()
+        self.presented_count = 0
+        self.shown_count = 0
+
+    def get_canvas(self) -> np.ndarray:
+        # the height of the frame changes only with the zoom
+        height = self.header_height + current_detail_height + 5 + 4 * text_pixel_height
+        if self.canvases[self.back].shape[0] != height:
+            self.canvases[self.back] = np.zeros((height, vis.window_width, 3), np.uint8)
+        return self.canvases[self.back]
+
+    def present(self):
+        # the finished frame becomes the front canvas
+        with self.frame_lock:
+            self.back = 1 - self.back
+            self.presented_count += 1
+
+    def show(self, window_name: str):
+        with self.frame_lock:
+            if self.shown_count != self.presented_count:
+                self.shown_count = self.presented_count
+                cv2.imshow(window_name, self.canvases[1 - self.back])
+
+    def update_layers(self):
+        header_key = (offset_minimap_pixel, region_width_minimap_pixel)
+        if header_key != self.header_key:
+            self.header_key = header_key
+            put_on_title(self.header)
+            set_minimap(self.header)
+            draw_orange_lines(self.header)
+        map_key = (offset_meter, region_width_meter)
+        if map_key != self.map_key:
+            self.map_key = map_key
+            if self.map_layer.shape[0] != current_detail_height:
+                self.map_layer = np.zeros((current_detail_height, vis.window_width, 3), np.uint8)
+            # get current part of the map
+            vis.map_pyramid.draw_region(offset_meter, region_width_meter, self.map_layer)
+
+
+compositor = FrameCompositor()
+
+
+def draw_car(image: np.ndarray, snapshot: FrameSnapshot, row: int, distance_taken: float, y_scale: float):
+    sprite_kind, _, exploded = snapshot.appearance[row]
+    x_slice_vis, car_im = vis.x_slice_and_image_of(sprite_kind, snapshot.lane[row], distance_taken, snapshot.size[row],
+                                                   exploded, offset_meter, region_width_meter)
+    image[vis.y_slice_of(snapshot.lane[row], y_scale), x_slice_vis, :] = car_im
+
+
+def compose_frame(snapshot: FrameSnapshot = None, at: float = None, label: str = None):
+    """
+    :param snapshot: the fleet to draw, by default a snapshot of local_cars is taken
+    :param at: time to interpolate the positions of the cars to, by default the time of the snapshot
+    :param label: text at the bottom of the frame, the frame rate by default
+    """
+    global canvas
+    frame_start = time.time()
+    if snapshot is None:
+        snapshot = take_snapshot()
+    at = snapshot.taken_at if at is None else at
+    distance_taken = snapshot.distance_at(at)
+    follow_with_camera(snapshot, distance_taken)
+    compositor.update_layers()
+    canvas = compositor.get_canvas()
+    canvas[:compositor.header_height] = compositor.header
+    detail_end = compositor.header_height + current_detail_height
+    cur_im_detail = canvas[compositor.header_height:detail_end, :, :]
+    cur_im_detail[:] = compositor.map_layer
+    # the sprites and lanes are scaled like the map
+    y_scale = current_detail_height / vis.detail_height
+    focused_row = snapshot.row_of_id.get(focused_car_id) if focused_car_id is not None else None
+    minimap_layer.draw(canvas[:vis.minimap_height_pixel], snapshot.lane, distance_taken * vis.x_scale_minimap,
+                       snapshot.extras["minimap_colors"])
+    # put on the cars in the visible region
+    visible_rows, visible_distance = snapshot.rows_overlapping(offset_meter, offset_meter + region_width_meter, at)
+    for row, distance in zip(visible_rows, visible_distance):
+        if row != focused_row:
+            draw_car(cur_im_detail, snapshot, row, distance, y_scale)
+    # the focused car is on top
+    if focused_row is not None:
+        draw_car(cur_im_detail, snapshot, focused_row, distance_taken[focused_row], y_scale)
+    canvas[detail_end:, :, :] = 0
+
+    if focused_row is not None and "focused_car_stats" in snapshot.extras:
+        put_on_focused_car_stats(snapshot.extras["focused_car_stats"])
+    # put frame time
+    if label is None:
+        label = f"FPS: {np.floor(1 / (time.time() - frame_start + 0.0001))}"
+    cv2.putText(canvas, label,
+                (5, canvas.shape[0] - 5), cv2.FONT_HERSHEY_SIMPLEX, text_size, (255, 255, 255), 2)
+    return canvas
+
+
+def render_frame():
+    """
+    Composes a frame from the latest snapshot, with the cars interpolated to RENDER_DELAY_SEC before now
+    """
+    snapshot = snapshots.take()
+    if snapshot is None:
+        return
+    time_start = time.perf_counter()
+    with phase_seconds["compose"].time(), view_lock:
+        compose_frame(snapshot, time.time() - RENDER_DELAY_SEC)
+    compositor.present()
+    elapsed_sec = time.perf_counter() - time_start
+    frame_seconds.record(elapsed_sec)
+    frames_per_second.set(1 / max(elapsed_sec, 1e-6))
+
+
+def show_frame():
+    with phase_seconds["show"].time():
+        compositor.show(vis.WINDOW_NAME)
+
+
+class PeriodicThread(threading.Thread):
+    """
+    Calls tick every interval_sec seconds, the producer of the snapshots and the render thread
+    """
+    def __init__(self, tick, interval_sec: float):
+        super().__init__(daemon=True)
+        self.tick = tick
+        self.interval_sec = interval_sec
+
+    def run(self) -> None:
+        while True:
+            time_start = time.time()
+            try:
+                self.tick()
+            except Exception as e:
+                logger.error(f"{self.tick.__name__} failed: {e}")
+            time.sleep(max(0.0, time_start + self.interval_sec - time.time()))
+
+
+def handle_key(key):
+    if key == -1:
+        return
+    focused_car = local_cars.get(focused_car_id) if focused_car_id is not None else None
+    if key == ord('w'):
+        with view_lock:
+            set_region_width(region_width_meter - 10)
+        logger.info(f"New width of visible region is {region_width_meter} meters")
+    elif key == ord('s'):
+        with view_lock:
+            set_region_width(region_width_meter + 10)
+        logger.info(f"New width of visible region is {region_width_meter} meters")
+    elif key == ord('x') and focused_car is not None:
+        focused_car.exploded = True
+        give_command(focused_car, Command.TERMINATE)
+    elif key == ord('c') and focused_car is not None:
+        give_command(focused_car, Command.CHANGE_LANE)
+
+
+async def run_async():
+    await async_mqtt_connector.setup_connector(local_cars, vis.CarImage, on_terminate)
+    # the snapshots are taken on the event loop, so the cars do not change while they are copied
+    producer = asyncio.ensure_future(async_mqtt_connector.run_periodically(
+        publish_snapshot, 1 / SNAPSHOT_RATE_HZ, "Visualizer can not take the snapshots of the fleet in time"))
+    PeriodicThread(render_frame, 1 / TARGET_FPS).start()
+    while cv2.getWindowProperty(vis.WINDOW_NAME, 0) >= 0:
+        show_frame()
+        handle_key(cv2.waitKey(2))
+        # let the connector's tasks run
+        await asyncio.sleep(0)
+    producer.cancel()
 
 
 if __name__ == "__main__":
     local_cars = DetailedCarTracker()
-    focused_car = None
-    mqtt_connector.setup_connector(local_cars, vis.CarImage, on_terminate)
+    metrics.start_exporter("visu")
 
     cv2.namedWindow(vis.WINDOW_NAME)
     cv2.moveWindow(vis.WINDOW_NAME, 0, 0)
     cv2.setMouseCallback(vis.WINDOW_NAME, minimap_move)
 
-    while cv2.getWindowProperty(vis.WINDOW_NAME, 0) >= 0:
-        frame_start = time.time()
-        canvas = np.zeros((vis.minimap_height_pixel + vis.black_region_height + current_detail_height + 5 + 4 * text_pixel_height,
-                           vis.window_width, 3),
-                          np.uint8)
-        follow_with_camera()
-        put_on_title()
-        set_minimap()
-        draw_orange_lines()
-        # get current part of the map
-        cur_im_detail = cv2.resize(vis.im_bigmap[:, offset_bigmap_pixel:offset_bigmap_pixel + region_width_bigmap_pixel, :],
-                                   (vis.window_width, vis.detail_height),
-                                   interpolation=cv2.INTER_NEAREST)
-        # put on cars
-        for car in local_cars.get_all():
-            x, y = car.get_point_on_minimap()
-            cv2.circle(canvas, (x, y), minimap_point_size, car.color, cv2.FILLED)
-            if car.is_in_region(offset_meter, region_width_meter) and car != focused_car:
-                x_slice_vis, car_im = car.get_x_slice_and_image(offset_meter, region_width_meter)
-                cur_im_detail[car.get_y_slice(), x_slice_vis, :] = car_im
-        if focused_car is not None:
-            cur_im_detail[focused_car.get_y_slice(), x_slice_focused, :] = image_focused
-
-        # set correct height
-        canvas[vis.minimap_height_pixel + vis.black_region_height:
-               vis.minimap_height_pixel + vis.black_region_height + current_detail_height, :, :] = \
-            cv2.resize(cur_im_detail, (vis.window_width, current_detail_height))
-
-        if focused_car is not None:
-            put_on_focused_car_stats()
-        # put frame time
-        cv2.putText(canvas, f"FPS: {np.floor(1 / (time.time() - frame_start + 0.0001))}",
-                    (5, canvas.shape[0] - 5), cv2.FONT_HERSHEY_SIMPLEX, text_size, (255, 255, 255), 2)
-
-        cv2.imshow(vis.WINDOW_NAME, canvas)
-        key = cv2.waitKey(2)
-        if key == -1:
-            continue
-        elif key == ord('w'):
-            region_width_meter = max(10, region_width_meter - 10)
-            logger.info(f"New width of visible region is {region_width_meter} meters")
-            update_zoom()
-        elif key == ord('s'):
-            region_width_meter = min(vis.map_length_meter, region_width_meter + 10)
-            logger.info(f"New width of visible region is {region_width_meter} meters")
-            update_zoom()
-        elif key == ord('x') and focused_car is not None:
-            focused_car.exploded = True
-            give_command(focused_car, Command.TERMINATE)
-        elif key == ord('c') and focused_car is not None:
-            give_command(focused_car, Command.CHANGE_LANE)
-
-    cv2.destroyAllWindows()
-    mqtt_connector.cleanup_connector()
-
+    if config.get("asyncio_connector"):
+        asyncio.run(run_async())
+        cv2.destroyAllWindows()
+        async_mqtt_connector.cleanup_connector()
+    else:
+        mqtt_connector.setup_connector(local_cars, vis.CarImage, on_terminate)
+        PeriodicThread(publish_snapshot, 1 / SNAPSHOT_RATE_HZ).start()
+        PeriodicThread(render_frame, 1 / TARGET_FPS).start()
+        while cv2.getWindowProperty(vis.WINDOW_NAME, 0) >= 0:
+            show_frame()
+            handle_key(cv2.waitKey(2))
+        cv2.destroyAllWindows()
+        mqtt_connector.cleanup_connector()
@@ -2,8 +2,11 @@ import os
 import cv2
 import random
 import logging
-from tkinter import Tk
+from collections import OrderedDict
+from typing import Tuple
+from tkinter import Tk, TclError
 from car import Car, CarSpecs
+from map_pyramid import load_map_pyramid
 from HTCSPythonUtil import config
 
 if os.name == "nt":
@@ -16,8 +19,24 @@ if os.name == "nt":
 
 
 logger = logging.getLogger(__name__)
-tk = Tk()
-window_width = tk.winfo_screenwidth()
+# width of the window, when it is not configured and there is no display to measure the screen (e.g. rendering headless)
+DEFAULT_WINDOW_WIDTH = 1920
+
+
+def screen_width() -> int:
+    """
+    :return: the configured window_width, or the width of the screen
+    """
+    if config.get("window_width"):
+        return int(config["window_width"])
+    try:
+        return Tk().winfo_screenwidth()
+    except TclError as e:
+        logger.warning(f"Could not measure the screen, the window width will be {DEFAULT_WINDOW_WIDTH} pixels: {e}")
+        return DEFAULT_WINDOW_WIDTH
+
+
+window_width = screen_width()
 black_region_height = 100
 # image resources
 WINDOW_NAME = "Highway Traffic Control System Visualization"
@@ -41,6 +60,8 @@ except AttributeError:
 # to fit screen
 im_minimap = cv2.resize(im_minimap, (window_width, im_minimap.shape[0]))
 title = cv2.resize(title, (window_width, black_region_height))
+# the grayed out minimap, outside of the visible region
+im_minimap_dimmed = (im_minimap * 0.6).astype(im_minimap.dtype)
 logger.info(f"Window width will be set to {window_width} pixels.")
 # measure
 minimap_length_pixel = im_minimap.shape[1]
@@ -61,35 +82,100 @@ center_merge_lane = 164 * y_stretch
 car_height = int((center_slow_lane - center_fast_lane) * 0.8)
 x_scale_minimap = minimap_length_pixel / map_length_meter
 x_scale_bigmap = bigmap_length_pixel / map_length_meter
+# the map at every zoom level is drawn from its pyramid
+map_pyramid = load_map_pyramid(os.path.dirname(os.path.abspath(__file__)) + "/res/map.png", map_length_meter,
+                               config.get("map_cache_directory")
+                               or os.path.dirname(os.path.abspath(__file__)) + "/res/cache")
+
+
+def detail_height_of(region_width_meter: float) -> int:
+    """
+    :return: height of the detailed view in pixels, when the visible region is region_width_meter wide
+    """
+    return int(window_width * map_height_meter / region_width_meter)
+
+
+def sprite_height_of(y_scale: float) -> int:
+    """
+    :param y_scale: ratio of the height of the detailed view to detail_height
+    """
+    return max(1, int(car_height * y_scale))
+
+
+# sprites of every kind of vehicle, by orientation
+STRAIGHT = "straight"
+LEFT = "left"
+RIGHT = "right"
+sprites = {("truck", STRAIGHT): truck, ("truck", LEFT): truck, ("truck", RIGHT): truck,
+           ("red", STRAIGHT): red_car_straight, ("red", LEFT): red_car_left, ("red", RIGHT): red_car_right,
+           ("blue", STRAIGHT): blue_car_straight, ("blue", LEFT): blue_car_left, ("blue", RIGHT): blue_car_right,
+           ("explosion", STRAIGHT): explosion}
+
+
+class SpriteCache:
+    """
+    The sprites resized to the height of the cars at the current zoom and to a pixel width, shared by every car.
+    The least recently used sprites are evicted above max_bytes, and every sprite is dropped when the width of the
+    visible region changes, since the pixel widths of the cars change with it.
+    The returned images are read-only, they must not be drawn on.
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.images: OrderedDict = OrderedDict()
+        self.size_bytes = 0
+        self.region_width_meter = None
+        self.sprite_height = car_height
+        self.hits = 0
+        self.misses = 0
+
+    def set_region_width(self, region_width_meter: float):
+        if region_width_meter != self.region_width_meter:
+            self.region_width_meter = region_width_meter
+            self.sprite_height = sprite_height_of(detail_height_of(region_width_meter) / detail_height)
+            self.images.clear()
+            self.size_bytes = 0
+
+    def get(self, kind: str, orientation: str, width_pixel: int):
+        key = (kind, orientation, width_pixel)
+        image = self.images.get(key)
+        if image is not None:
+            self.hits += 1
+            self.images.move_to_end(key)
+            return image
+        self.misses += 1
+        image = cv2.resize(sprites[(kind, orientation)], (width_pixel, self.sprite_height))
+        image.flags.writeable = False
+        self.images[key] = image
+        self.size_bytes += image.nbytes
+        while self.size_bytes > self.max_bytes and len(self.images) > 1:
+            _, evicted = self.images.popitem(last=False)
+            self.size_bytes -= evicted.nbytes
+        return image
+
+
+sprite_cache = SpriteCache(int((config.get("sprite_cache_mb") or 64) * 1024 * 1024))
+
+
+# the color on the minimap and the color of the texts of every kind of vehicle, BGR
+colors_of_kind = {"truck": ((11, 195, 255), (11, 195, 255)),
+                  "red": ((0, 0, 255), (0, 0, 255)),
+                  "blue": ((255, 0, 0), (253, 177, 0))}
+
+
+def sprite_kind_of(car_id: str, size: float) -> str:
+    # red or blue, chosen by the id, so a car looks the same in every window and in every rendering of a recording
+    if size > 7.5:
+        return "truck"
+    return "red" if random.Random(car_id).getrandbits(1) else "blue"
 
 
 class CarImage(Car):
     def __init__(self, car_id, specs: CarSpecs, state):
         # Create Car
         super().__init__(car_id, specs, state)
-        if specs.size > 7.5:
-            self.straight = truck
-            self.left = truck
-            self.right = truck
-            self.color = (11, 195, 255)
-            self.text_color = self.color
-        # Red or Blue
-        elif bool(random.getrandbits(1)):
-            self.straight = red_car_straight
-            self.left = red_car_left
-            self.right = red_car_right
-            self.color = (0, 0, 255) # BGR
-            self.text_color = self.color
-        else:
-            self.straight = blue_car_straight
-            self.left = blue_car_left
-            self.right = blue_car_right
-            self.color = (255, 0, 0) # BGR
-            self.text_color = (253, 177, 0) # BGR
-        # At least we set the height, but width will be dependent on the region's width in meter
-        self.straight = cv2.resize(self.straight, (self.straight.shape[0], car_height))
-        self.left = cv2.resize(self.left, (self.left.shape[0], car_height))
-        self.right = cv2.resize(self.right, (self.right.shape[0], car_height))
+        self.sprite_kind = sprite_kind_of(car_id, specs.size)
+        self.color, self.text_color = colors_of_kind[self.sprite_kind]
+        # the sprites are resized by the sprite cache, their width depends on the region's width in meter
         self.exploded = False
 
     def __str__(self):
@@ -99,63 +185,76 @@ class CarImage(Car):
         return super().__repr__()
 
     def get_point_on_minimap(self):
-        cy = 0
-        if self.lane == 0:
-            cy = center_merge_lane_mini
-        elif self.lane == 1:
-            cy = int((center_merge_lane_mini + center_slow_lane_mini) / 2)
-        elif self.lane == 2:
-            cy = center_slow_lane_mini
-        elif self.lane in [3, 4]:
-            cy = int((center_slow_lane_mini + center_fast_lane_mini) / 2)
-        elif self.lane == 5:
-            cy = center_fast_lane_mini
-        cx = int(self.distance_taken * x_scale_minimap)
-        return cx, cy
+        return point_on_minimap(self.lane, self.distance_taken)
 
     def is_in_region(self, region_offset, region_width):
         return self.distance_taken > region_offset and \
                self.distance_taken - self.specs.size < region_offset + region_width
 
-    def get_y_slice(self):
-        start = 0
-        if self.lane == 0:
-            start = int(center_merge_lane - self.straight.shape[0] / 2)
-        elif self.lane == 1:
-            start = int((center_merge_lane + center_slow_lane) / 2 - self.straight.shape[0] / 2)
-        elif self.lane == 2:
-            start = int(center_slow_lane - self.straight.shape[0] / 2)
-        elif self.lane in [3, 4]:
-            start = int((center_slow_lane + center_fast_lane) / 2 - self.straight.shape[0] / 2)
-        elif self.lane == 5:
-            start = int(center_fast_lane - self.straight.shape[0] / 2)
-        return slice(start, start + self.straight.shape[0])
+    def get_y_slice(self, y_scale=1.0):
+        return y_slice_of(self.lane, y_scale)
 
     def width_pixel(self, region_width_meter):
-        return int(self.specs.size / region_width_meter * window_width)
+        return width_pixel_of(self.specs.size, region_width_meter)
 
     def get_x_slice_and_image(self, offset_region, width_region):
-        w_px_car = self.width_pixel(width_region)
-        on_vis_slice_x_end = int((self.distance_taken - offset_region) / width_region * window_width)
-        on_vis_slice_x_start = on_vis_slice_x_end - w_px_car
-        on_car_slice_x_start = 0
-        on_car_slice_x_end = w_px_car
-        if on_vis_slice_x_end > window_width:
-            on_car_slice_x_end -= on_vis_slice_x_end - window_width
-            on_vis_slice_x_end = window_width
-        elif on_vis_slice_x_start < 0:
-            on_car_slice_x_start -= on_vis_slice_x_start
-            on_vis_slice_x_start = 0
-        car_x_slice = slice(on_car_slice_x_start, on_car_slice_x_end)
-        return slice(on_vis_slice_x_start, on_vis_slice_x_end), self.get_image(w_px_car, car_x_slice)
-
-    def get_image(self, car_width_pixel, x_slice):
-        if self.distance_taken > map_length_meter - 30 or self.exploded:
-            im = explosion
-        elif self.lane in [1, 3]:
-            im = self.left
-        elif self.lane == 4:
-            im = self.right
-        else:
-            im = self.straight
-        return cv2.resize(im, (car_width_pixel, car_height))[:, x_slice, :]
+        return x_slice_and_image_of(self.sprite_kind, self.lane, self.distance_taken, self.specs.size, self.exploded,
+                                    offset_region, width_region)
+
+    def get_sprite_key(self) -> Tuple[str, str]:
+        return sprite_key_of(self.sprite_kind, self.lane, self.distance_taken, self.exploded)
+
+
+# the drawing of a car from its values, so a car can also be drawn from a snapshot of the fleet
+# the centers of the lanes and the orientation of the sprites, indexed by the lane
+lane_centers_mini = [center_merge_lane_mini, int((center_merge_lane_mini + center_slow_lane_mini) / 2),
+                     center_slow_lane_mini, int((center_slow_lane_mini + center_fast_lane_mini) / 2),
+                     int((center_slow_lane_mini + center_fast_lane_mini) / 2), center_fast_lane_mini]
+lane_centers = [center_merge_lane, (center_merge_lane + center_slow_lane) / 2, center_slow_lane,
+                (center_slow_lane + center_fast_lane) / 2, (center_slow_lane + center_fast_lane) / 2, center_fast_lane]
+lane_orientations = [STRAIGHT, LEFT, STRAIGHT, LEFT, RIGHT, STRAIGHT]
+
+
+def point_on_minimap(lane: int, distance_taken: float) -> Tuple[int, int]:
+    return int(distance_taken * x_scale_minimap), lane_centers_mini[lane]
+
+
+def y_slice_of(lane: int, y_scale=1.0) -> slice:
+    """
+    :param y_scale: ratio of the height of the detailed view to detail_height
+    """
+    height = sprite_height_of(y_scale)
+    start = int(lane_centers[lane] * y_scale - height / 2)
+    return slice(start, start + height)
+
+
+def width_pixel_of(size: float, region_width_meter: float) -> int:
+    # at least a pixel wide, so the cars are still shown when zoomed out to the whole map
+    return max(1, int(size / region_width_meter * window_width))
+
+
+def sprite_key_of(sprite_kind: str, lane: int, distance_taken: float, exploded: bool) -> Tuple[str, str]:
+    if distance_taken > map_length_meter - 30 or exploded:
+        return "explosion", STRAIGHT
+    return sprite_kind, lane_orientations[lane]
+
+
+def x_slice_and_image_of(sprite_kind: str, lane: int, distance_taken: float, size: float, exploded: bool,
+                         offset_region: float, width_region: float):
+    """
+    :return: the columns of the detailed view covered by the car, and the part of its sprite to put there
+    """
+    w_px_car = width_pixel_of(size, width_region)
+    on_vis_slice_x_end = int((distance_taken - offset_region) / width_region * window_width)
+    on_vis_slice_x_start = on_vis_slice_x_end - w_px_car
+    on_car_slice_x_start = 0
+    on_car_slice_x_end = w_px_car
+    if on_vis_slice_x_end > window_width:
+        on_car_slice_x_end -= on_vis_slice_x_end - window_width
+        on_vis_slice_x_end = window_width
+    elif on_vis_slice_x_start < 0:
+        on_car_slice_x_start -= on_vis_slice_x_start
+        on_vis_slice_x_start = 0
+    kind, orientation = sprite_key_of(sprite_kind, lane, distance_taken, exploded)
+    image = sprite_cache.get(kind, orientation, w_px_car)[:, on_car_slice_x_start:on_car_slice_x_end, :]
+    return slice(on_vis_slice_x_start, on_vis_slice_x_end), image